@@ -31,7 +31,13 @@ public class RabbitMqService : IDisposable, IRabbitMqService
     {
         var json = JsonSerializer.Serialize(message);
         var body = Encoding.UTF8.GetBytes(json);
-        await _channel.BasicPublishAsync(exchange: "", routingKey: queueName, mandatory: madatory, basicProperties: properties ?? new BasicProperties(), body: body);
+        properties ??= new BasicProperties();
+        // judge-service dung timestamp de biet lenh huy (cancel) co ap dung cho message nay khong
+        if (!properties.IsTimestampPresent())
+        {
+            properties.Timestamp = new AmqpTimestamp(DateTimeOffset.UtcNow.ToUnixTimeSeconds());
+        }
+        await _channel.BasicPublishAsync(exchange: "", routingKey: queueName, mandatory: madatory, basicProperties: properties, body: body);
     }
 
     void IDisposable.Dispose()
@@ -1,20 +1,78 @@
 """
 Async Adaptive Consumer - Xử lý nhiều messages song song
 Dùng aio-pika để kết nối RabbitMQ và gọi MessageHandler (an toàn với isolate)
+(hoặc InMemoryTransport trong broker_transport.py để chạy test/benchmark không cần RabbitMQ)
 """
 import asyncio
+import contextlib
 import json
 import os
+import time
 import aio_pika
-from message_handler import MessageHandler  # ✅ import đúng file
+from message_handler import MessageHandler, cancellations, MAX_RETRY_COUNT, CANCEL_GRACE_SECONDS  # ✅ import đúng file
+from dispatch_queue import PriorityDispatchQueue, LatencyStats, parse_weights
+from result_publisher import ResultPublisher
+from broker_transport import AmqpTransport
+from message_codec import negotiate_encoding, encode_reply, get_codec, JsonCodec
+from traffic_replay import recorder as traffic_recorder
+from metrics import start_metrics_server, QUEUE_WAIT, SUBMISSION_DURATION, INFLIGHT, PENDING, RETRIES
+import tracing
+from profiler import profiler
+from node_speed import node_speed
 
 MAX_CONCURRENT_SUBMISSIONS = int(os.getenv("MAX_CONCURRENT_SUBMISSIONS", "4"))
+# Prefetch nhiều hơn số slot để hàng đợi nội bộ có thể sắp xếp lại theo priority
+PREFETCH_COUNT = int(os.getenv("PREFETCH_COUNT", str(MAX_CONCURRENT_SUBMISSIONS * 2)))
+# > 0 thì declare submission_queue với x-max-priority (phải khớp với phía publisher)
+SUBMISSION_QUEUE_MAX_PRIORITY = int(os.getenv("SUBMISSION_QUEUE_MAX_PRIORITY", "0"))
+DEFAULT_SUBMISSION_PRIORITY = int(os.getenv("DEFAULT_SUBMISSION_PRIORITY", "0"))
+# Chống đói: cứ mỗi PRIORITY_AGING_SECONDS chờ thì được cộng thêm 1 mức priority
+PRIORITY_AGING_SECONDS = float(os.getenv("PRIORITY_AGING_SECONDS", "30"))
+LATENCY_LOG_INTERVAL = int(os.getenv("LATENCY_LOG_INTERVAL", "60"))
+# Fair-share: số submission tối đa chạy đồng thời của 1 user (0 = không giới hạn)
+MAX_CONCURRENT_PER_USER = int(os.getenv("MAX_CONCURRENT_PER_USER", "0"))
+# Trọng số round-robin theo class của user (header x-user-class), ví dụ "teacher=2,student=1"
+FAIR_SHARE_WEIGHTS = parse_weights(os.getenv("FAIR_SHARE_WEIGHTS", ""))
+# Fanout exchange nhận control message (cancel) - mọi judge node đều nhận
+JUDGE_CONTROL_EXCHANGE = os.getenv("JUDGE_CONTROL_EXCHANGE", "judge_control")
+# Bài nộp mới của cùng user + problem (header x-user-id, x-problem-id) huỷ các bài cũ còn chờ
+SUPERSEDE_PENDING = os.getenv("SUPERSEDE_PENDING", "false").lower() == "true"
+# Retry có backoff: lần retry thứ n chờ RETRY_BASE_DELAY × 2^(n-1) giây (tối đa RETRY_MAX_DELAY)
+# trong delay queue (TTL + dead-letter về submission_queue). 0 = requeue ngay như cũ
+RETRY_BASE_DELAY = float(os.getenv("RETRY_BASE_DELAY", "5"))
+RETRY_MAX_DELAY = float(os.getenv("RETRY_MAX_DELAY", "300"))
+# Message hết lượt retry được chuyển vào đây (mặc định <SUBMISSION_QUEUE>.dlq)
+DEAD_LETTER_QUEUE = os.getenv("DEAD_LETTER_QUEUE", "")
+# Khi shutdown: chờ tối đa N giây cho các submission đang chạy, quá thì kill runner và để message redeliver
+SHUTDOWN_GRACE_SECONDS = float(os.getenv("SHUTDOWN_GRACE_SECONDS", "60"))
+# Supervisor (CONSUMER_PROCESSES > 1) truyền file heartbeat cho từng consumer process
+CONSUMER_HEARTBEAT_FILE = os.getenv("CONSUMER_HEARTBEAT_FILE", "")
+CONSUMER_HEARTBEAT_INTERVAL = float(os.getenv("CONSUMER_HEARTBEAT_INTERVAL", "5"))
 
 class AsyncAdaptiveConsumer:
-    def __init__(self):
+    def __init__(self, transport=None):
+        self.transport = transport or AmqpTransport()
         self.connection = None
         self.channel = None
+        self.publisher = None
         self.should_stop = False
+        self.dispatch_queue = PriorityDispatchQueue(
+            aging_seconds=PRIORITY_AGING_SECONDS,
+            max_per_user=MAX_CONCURRENT_PER_USER
+        )
+        self.latency_stats = LatencyStats()
+        self._tasks = []
+        self._seq = 0
+        self._latest_by_owner = {}  # (user_id, problem_id) -> seq của message mới nhất
+        self._stop_event = asyncio.Event()
+        self._inflight = 0
+        self._dispatch_open = asyncio.Event()  # clear = worker không nhận submission mới (đang calibration)
+        self._dispatch_open.set()
+        self._settling = set()  # task chờ confirm kết quả rồi mới ACK message nguồn
+        self.submission_queue_name = "submission_queue"
+        self.dead_letter_queue_name = None
+        self.retry_stats = {"retried": 0, "dead_lettered": 0}
+        self.metrics_server = None
 
     async def start(self):
         """Khởi động async consumer"""
@@ -22,18 +80,28 @@ class AsyncAdaptiveConsumer:
         rabbit_user = os.getenv("RABBITMQ_USER", "guest")
         rabbit_pass = os.getenv("RABBITMQ_PASS", "guest")
         submission_queue_name = os.getenv("SUBMISSION_QUEUE", "submission_queue")
+        self.submission_queue_name = submission_queue_name
+        self.dead_letter_queue_name = DEAD_LETTER_QUEUE or f"{submission_queue_name}.dlq"
+
+        # Heartbeat chạy cả trong lúc chờ RabbitMQ để supervisor không kill nhầm
+        if CONSUMER_HEARTBEAT_FILE:
+            self._tasks.append(asyncio.create_task(self._heartbeat_loop()))
 
         # Retry connect
         max_retries = 30
         retry_delay = 2
         for attempt in range(1, max_retries + 1):
+            if self._stop_event.is_set():
+                print("[*] Shutdown requested before connecting to RabbitMQ.")
+                await self._cleanup()
+                return
             try:
-                print(f"[*] Connecting to RabbitMQ ({attempt}/{max_retries})...")
-                self.connection = await aio_pika.connect_robust(
+                print(f"[*] Connecting to {self.transport.name} ({attempt}/{max_retries})...")
+                self.connection = await self.transport.connect(
                     f"amqp://{rabbit_user}:{rabbit_pass}@{rabbit_host}/",
                     heartbeat=600,
                 )
-                print(f"[✓] Connected to RabbitMQ at {rabbit_host}")
+                print(f"[✓] Connected to {self.transport.name} at {rabbit_host}")
                 break
             except Exception as e:
                 if attempt == max_retries:
@@ -43,59 +111,369 @@ class AsyncAdaptiveConsumer:
 
         # Tạo channel và declare queue
         self.channel = await self.connection.channel()
-        await self.channel.set_qos(prefetch_count=MAX_CONCURRENT_SUBMISSIONS)
-        submission_queue = await self.channel.declare_queue(submission_queue_name, durable=True)
+        await self.channel.set_qos(prefetch_count=max(PREFETCH_COUNT, MAX_CONCURRENT_SUBMISSIONS))
+        queue_arguments = None
+        if SUBMISSION_QUEUE_MAX_PRIORITY > 0:
+            queue_arguments = {"x-max-priority": SUBMISSION_QUEUE_MAX_PRIORITY}
+        submission_queue = await self.channel.declare_queue(
+            submission_queue_name, durable=True, arguments=queue_arguments
+        )
         await self.channel.declare_queue("result_queue", durable=True)
+        await self.channel.declare_queue(self.dead_letter_queue_name, durable=True)
+        # Mỗi mức delay 1 queue với TTL cố định (TTL theo message sẽ bị chặn bởi message đầu queue)
+        delays = {self._retry_delay_ms(n) for n in range(1, MAX_RETRY_COUNT)}
+        if MAX_CONCURRENT_PER_USER > 0:
+            delays.add(self._retry_delay_ms(1))  # message của user đã chạm giới hạn được hoãn qua đây
+        for delay_ms in sorted(delays):
+            if delay_ms > 0:
+                await self.channel.declare_queue(
+                    self._retry_queue_name(delay_ms), durable=True,
+                    arguments={
+                        "x-message-ttl": delay_ms,
+                        "x-dead-letter-exchange": "",
+                        "x-dead-letter-routing-key": submission_queue_name
+                    }
+                )
+        # Publish kết quả/requeue trên channel riêng, không chặn worker
+        self.publisher = ResultPublisher(self.connection)
+        await self.publisher.start()
+
+        # Control channel: queue tạm (exclusive) bind vào fanout exchange
+        control_exchange = await self.channel.declare_exchange(
+            JUDGE_CONTROL_EXCHANGE, aio_pika.ExchangeType.FANOUT, durable=True
+        )
+        control_queue = await self.channel.declare_queue(exclusive=True, auto_delete=True)
+        await control_queue.bind(control_exchange)
+        await control_queue.consume(self._control_callback, no_ack=True)
+
+        # /metrics (METRICS_PORT > 0)
+        PENDING.callback = lambda: len(self.dispatch_queue)
+        self.metrics_server = await start_metrics_server()
+
+        # Hệ số tốc độ node (scale time limit) đo trước khi nhận submission đầu tiên, sau đó định kỳ lúc rảnh
+        await node_speed.calibrate()
+        self._tasks.append(asyncio.create_task(
+            node_speed.run_periodic(lambda: self._inflight == 0, pause=self._paused_dispatch)
+        ))
+
+        # Worker lấy message từ hàng đợi nội bộ, mỗi worker = 1 slot chạy
+        for i in range(MAX_CONCURRENT_SUBMISSIONS):
+            self._tasks.append(asyncio.create_task(self._worker_loop(i)))
+        self._tasks.append(asyncio.create_task(self._latency_report_loop()))
 
-        print(f"[✓] Consumer ready - processing up to {MAX_CONCURRENT_SUBMISSIONS} submissions concurrently")
+        print(f"[✓] Consumer ready - processing up to {MAX_CONCURRENT_SUBMISSIONS} submissions concurrently (prefetch={PREFETCH_COUNT})")
 
         # Bắt đầu consume
-        await submission_queue.consume(self._message_callback)
+        consumer_tag = await submission_queue.consume(self._message_callback)
         print("[✓] Waiting for submissions... Press CTRL+C to stop.")
         try:
-            await asyncio.Future()  # chạy vô hạn
+            await self._stop_event.wait()  # chạy tới khi request_stop()
+            await self._drain(submission_queue, consumer_tag)
         except asyncio.CancelledError:
             print("\n[*] Shutting down consumer gracefully...")
         finally:
             await self._cleanup()
 
+    def request_stop(self):
+        """Dừng nhận submission mới, chấm nốt các submission đang chạy rồi thoát (gọi từ signal handler)"""
+        if not self._stop_event.is_set():
+            print("\n[*] Shutdown requested, draining in-flight submissions...")
+            self._stop_event.set()
+
+    async def _drain(self, submission_queue, consumer_tag):
+        """Graceful shutdown: ngừng consume, trả message chưa chạy về broker, chờ message đang chạy"""
+        self.should_stop = True
+        await submission_queue.cancel(consumer_tag)
+        # Worker lấy nốt các message đã prefetch và NACK(requeue) để node khác nhận ngay
+        deadline = time.monotonic() + SHUTDOWN_GRACE_SECONDS
+        while (len(self.dispatch_queue) or self._inflight or self._settling) and time.monotonic() < deadline:
+            await asyncio.sleep(0.2)
+        if self._inflight:
+            # Quá thời gian chờ: kill runner, message của các submission này được NACK(requeue)
+            # (không gửi kết quả) để node khác chấm lại, testcase đã xong lấy từ journal
+            killed = cancellations.terminate_all()
+            print(f"[WARNING] Shutdown grace period exceeded, terminated {killed} sandbox runner(s)")
+            # Chờ runner thoát (SIGKILL sau CANCEL_GRACE_SECONDS) để worker kịp NACK message
+            deadline = time.monotonic() + CANCEL_GRACE_SECONDS + 2
+            while (self._inflight or self._settling) and time.monotonic() < deadline:
+                await asyncio.sleep(0.2)
+        else:
+            print("[✓] All in-flight submissions finished.")
+
     async def _message_callback(self, message: aio_pika.IncomingMessage):
+        """Nhận message và đưa vào hàng đợi nội bộ theo priority và user"""
+        traffic_recorder.record(message)
+        fair_key, weight = self._get_fair_key(message)
+        self._seq += 1
+        owner = self._get_owner(message)
+        if owner:
+            self._latest_by_owner[owner] = self._seq
+        priority = await self.dispatch_queue.put(
+            (message, time.monotonic(), owner, self._seq),
+            self._get_priority(message),
+            fair_key=fair_key,
+            weight=weight
+        )
+        print(f"[+] Queued message (priority={priority}, user={fair_key}, pending={len(self.dispatch_queue)})")
+        await self._defer_blocked()
+
+    async def _defer_blocked(self):
+        """
+        Message của user đã chạm MAX_CONCURRENT_PER_USER vẫn chiếm chỗ prefetch. Chỉ giữ lại tối đa
+        (prefetch - số slot) message như vậy, phần còn lại (mới nhất) được hoãn qua delay queue để
+        broker còn giao message của user khác cho worker rảnh (không head-of-line blocking).
+        """
+        if MAX_CONCURRENT_PER_USER <= 0 or self.should_stop:
+            return
+        keep = max(PREFETCH_COUNT, MAX_CONCURRENT_SUBMISSIONS) - MAX_CONCURRENT_SUBMISSIONS
+        delay_ms = self._retry_delay_ms(1)
+        for (message, _, owner, seq), _, fair_key in await self.dispatch_queue.evict_blocked(keep):
+            if owner and self._latest_by_owner.get(owner) == seq:
+                del self._latest_by_owner[owner]
+            if delay_ms <= 0:
+                await message.nack(requeue=True)
+                continue
+            print(f"[↷] Deferred message of {fair_key} for {delay_ms / 1000:.0f}s "
+                  f"(user at MAX_CONCURRENT_PER_USER={MAX_CONCURRENT_PER_USER})")
+            headers = dict(message.headers or {})
+            headers["x-deferred-count"] = int(headers.get("x-deferred-count", 0)) + 1
+            confirm = self._republish(message, headers, self._retry_queue_name(delay_ms))
+            task = asyncio.create_task(self._settle(message, [confirm], True))
+            self._settling.add(task)
+            task.add_done_callback(self._settling.discard)
+
+    @staticmethod
+    def _get_priority(message: aio_pika.IncomingMessage):
+        """
+        Priority của submission: AMQP priority property, nếu không có thì header x-priority.
+        Contest nên publish với priority cao hơn practice.
+        """
+        if message.priority is not None:
+            return message.priority
+        if message.headers and message.headers.get("x-priority") is not None:
+            return message.headers.get("x-priority")
+        return DEFAULT_SUBMISSION_PRIORITY
+
+    @staticmethod
+    def _get_owner(message: aio_pika.IncomingMessage):
+        """(user_id, problem_id) từ header, dùng cho rule supersede"""
+        if not SUPERSEDE_PENDING or not message.headers:
+            return None
+        user_id = message.headers.get("x-user-id")
+        problem_id = message.headers.get("x-problem-id")
+        if not user_id or not problem_id:
+            return None
+        return (str(user_id), str(problem_id))
+
+    @staticmethod
+    def _get_fair_key(message: aio_pika.IncomingMessage):
+        """
+        Khoá fair-share và trọng số: header x-user-id (fallback x-user-class),
+        trọng số lấy từ FAIR_SHARE_WEIGHTS theo x-user-class.
+        Message không có 2 header này được xếp riêng (giữ nguyên thứ tự FIFO, không bị cap).
+        """
+        headers = message.headers or {}
+        user_class = headers.get("x-user-class")
+        if isinstance(user_class, bytes):
+            user_class = user_class.decode()
+        fair_key = headers.get("x-user-id") or user_class
+        if isinstance(fair_key, bytes):
+            fair_key = fair_key.decode()
+        if not fair_key:
+            fair_key = f"msg:{message.message_id or message.correlation_id or id(message)}"
+        return str(fair_key), FAIR_SHARE_WEIGHTS.get(user_class, 1)
+
+    async def _worker_loop(self, worker_id):
+        """Lấy message ưu tiên cao nhất khi có slot rảnh"""
+        while True:
+            (message, received_at, owner, seq), priority, fair_key, waited = await self.dispatch_queue.get()
+            # User vừa chạm giới hạn: các message còn chờ của user này giờ bị chặn
+            await self._defer_blocked()
+            self.latency_stats.observe("queue_wait", priority, waited)
+            QUEUE_WAIT.observe(waited, priority=priority)
+            if self.should_stop:
+                await message.nack(requeue=True)
+                if owner and self._latest_by_owner.get(owner) == seq:
+                    del self._latest_by_owner[owner]
+                await self.dispatch_queue.task_done(fair_key)
+                continue
+            # Đang calibration tốc độ node: chờ đo xong mới chạy (không có await nào tới _inflight += 1)
+            await self._dispatch_open.wait()
+            cancel_reason = None
+            if owner and self._latest_by_owner.get(owner, seq) > seq:
+                cancel_reason = "Superseded by a newer submission"
+            self._inflight += 1
+            INFLIGHT.inc()
+            try:
+                await self._traced_process_message(message, cancel_reason, priority, received_at)
+            finally:
+                self._inflight -= 1
+                INFLIGHT.dec()
+                self.latency_stats.observe("total", priority, time.monotonic() - received_at)
+                SUBMISSION_DURATION.observe(time.monotonic() - received_at, priority=priority)
+                if owner and self._latest_by_owner.get(owner) == seq:
+                    del self._latest_by_owner[owner]
+                await self.dispatch_queue.task_done(fair_key)
+
+    @contextlib.asynccontextmanager
+    async def _paused_dispatch(self):
+        """Worker không bắt đầu submission mới trong khối này (submission đang chạy vẫn chạy tiếp)"""
+        self._dispatch_open.clear()
+        try:
+            yield
+        finally:
+            self._dispatch_open.set()
+
+    async def _heartbeat_loop(self):
+        """Cập nhật mtime của file heartbeat để supervisor biết event loop còn chạy"""
+        while True:
+            with open(CONSUMER_HEARTBEAT_FILE, "a"):
+                os.utime(CONSUMER_HEARTBEAT_FILE, None)
+            await asyncio.sleep(CONSUMER_HEARTBEAT_INTERVAL)
+
+    @staticmethod
+    def _retry_delay_ms(retry_count):
+        """Delay trước lần retry thứ retry_count (exponential backoff)"""
+        if RETRY_BASE_DELAY <= 0:
+            return 0
+        return int(min(RETRY_BASE_DELAY * (2 ** max(retry_count - 1, 0)), RETRY_MAX_DELAY) * 1000)
+
+    def _retry_queue_name(self, delay_ms):
+        return f"{self.submission_queue_name}.retry.{delay_ms}ms"
+
+    async def _latency_report_loop(self):
+        """In thống kê latency theo priority và số lần retry định kỳ"""
+        last_retry_stats = dict(self.retry_stats)
+        while LATENCY_LOG_INTERVAL > 0:
+            await asyncio.sleep(LATENCY_LOG_INTERVAL)
+            summary = self.latency_stats.format_summary()
+            if summary:
+                print(f"[i] Latency by priority (pending={len(self.dispatch_queue)}):\n{summary}")
+            retried = self.retry_stats["retried"] - last_retry_stats["retried"]
+            dead_lettered = self.retry_stats["dead_lettered"] - last_retry_stats["dead_lettered"]
+            if retried or dead_lettered:
+                print(f"[i] Retries in last {LATENCY_LOG_INTERVAL}s: scheduled={retried} "
+                      f"({retried * 60 / LATENCY_LOG_INTERVAL:.1f}/min), dead-lettered={dead_lettered} "
+                      f"(total: {self.retry_stats['retried']} retried, {self.retry_stats['dead_lettered']} dead-lettered)")
+            last_retry_stats = dict(self.retry_stats)
+
+    async def _control_callback(self, message: aio_pika.IncomingMessage):
+        """
+        Control message: {"Type": "Cancel", "SubmissionId": "...", "AttemptId": "...", "Reason": "..."}
+        Submission đang chờ sẽ bị bỏ qua khi tới lượt, đang chạy thì bị kill ngay
+        (chỉ attempt khớp AttemptId, xem CancellationRegistry).
+        {"Type": "Profile", "Seconds": 30, "Mode": "sample|cprofile"}: profile consumer + runner (profiler.py)
+        """
+        try:
+            data = json.loads(message.body)
+        except ValueError as e:
+            print(f"[WARNING] Invalid control message: {e}")
+            return
+        if not isinstance(data, dict):
+            print(f"[WARNING] Invalid control message (expected a JSON object): {data!r}")
+            return
+        if str(data.get("Type", "")).lower() == "profile":
+            profiler.start(data.get("Seconds"), data.get("Mode"))
+            return
+        if str(data.get("Type", "")).lower() != "cancel" or not data.get("SubmissionId"):
+            print(f"[WARNING] Unknown control message: {data}")
+            return
+        running = cancellations.cancel(data["SubmissionId"], data.get("Reason"), data.get("AttemptId"))
+        print(f"[✗] Cancel requested for {data['SubmissionId']} ({'running' if running else 'pending'})")
+
+    async def _traced_process_message(self, message, cancel_reason, priority, received_at):
+        """_process_message trong root span của trace (broker → queue nội bộ → chấm → publish)"""
+        now_ns = time.time_ns()
+        received_ns = now_ns - int((time.monotonic() - received_at) * 1e9)
+        headers = message.headers or {}
+        with tracing.start_trace(
+            "judge submission",
+            traceparent=headers.get("traceparent"),
+            start_ns=received_ns,
+            correlation_id=message.correlation_id,
+            priority=priority,
+            retry_count=headers.get("x-retry-count", 0),
+            redelivered=bool(message.redelivered)
+        ):
+            # AMQP timestamp (nếu bên gửi set): thời gian message nằm trong RabbitMQ
+            if message.timestamp is not None:
+                published_ns = int(message.timestamp.timestamp() * 1e9)
+                tracing.record_span("broker", published_ns, received_ns, queue=self.submission_queue_name)
+            tracing.record_span("queue_wait", received_ns, now_ns, pending=len(self.dispatch_queue))
+            await self._process_message(message, cancel_reason)
+
+    async def _process_message(self, message: aio_pika.IncomingMessage, cancel_reason=None):
         """Xử lý từng message"""
         retry_count = 0
         if message.headers:
             retry_count = message.headers.get('x-retry-count', 0)
 
+        # Progress message (opt-in theo từng submission) đi cùng reply_to với kết quả cuối
+        # Reply được nén nếu bên gửi chấp nhận (x-accept-encoding hoặc submission đã nén)
+        reply_encoding = negotiate_encoding(message.headers, message.content_encoding)
+        # Reply dùng cùng codec (content_type) với submission, mặc định JSON
+        try:
+            reply_codec = get_codec(message.content_type)
+        except ValueError:
+            reply_codec = JsonCodec
+
+        publish_progress = None
+        if message.reply_to:
+            async def publish_progress(body):
+                await self._send_progress(body, message.reply_to, message.correlation_id, reply_codec, reply_encoding)
+
         try:
             result = await MessageHandler.handle_message(
                 message.body,
                 message,
-                retry_count
+                retry_count,
+                cancel_reason=cancel_reason,
+                publish_progress=publish_progress
             )
 
-            # 1️⃣ Requeue nếu cần
-            if result["should_requeue"] and result["new_body"] and result["new_headers"]:
-                await self.channel.default_exchange.publish(
-                    aio_pika.Message(
-                        body=result["new_body"],
-                        delivery_mode=aio_pika.DeliveryMode.PERSISTENT,
-                        headers=result["new_headers"],
-                        reply_to=message.reply_to,
-                        correlation_id=message.correlation_id
-                    ),
-                    routing_key="submission_queue"
-                )
-                print(f"[↻] Requeued message for retry (count={result['new_headers'].get('x-retry-count', 1)})")
+            if result.get("requeue"):
+                # Bị dừng giữa chừng khi shutdown: trả về queue, không gửi kết quả
+                await message.nack(requeue=True)
+                print(f"[↻] NACK message (requeued, interrupted by shutdown).")
+                return
+
+            confirms = []
+            # 1️⃣ Requeue nếu cần (qua delay queue), hoặc chuyển sang dead-letter queue khi hết lượt
+            if (result["should_requeue"] or result.get("dead_letter")) and result["new_body"] and result["new_headers"]:
+                if result.get("dead_letter"):
+                    routing_key = self.dead_letter_queue_name
+                    self.retry_stats["dead_lettered"] += 1
+                    RETRIES.inc(outcome="dead_lettered")
+                    reason = result["new_headers"].get("x-dead-letter-reason")
+                    if reason:
+                        print(f"[✗] Moved message to {routing_key} ({reason})")
+                    else:
+                        print(f"[✗] Moved message to {routing_key} after {result['new_headers'].get('x-retry-count', 0)} retries")
+                else:
+                    count = result["new_headers"].get("x-retry-count", 1)
+                    delay_ms = self._retry_delay_ms(count)
+                    routing_key = self._retry_queue_name(delay_ms) if delay_ms > 0 else self.submission_queue_name
+                    self.retry_stats["retried"] += 1
+                    RETRIES.inc(outcome="retried")
+                    print(f"[↻] Requeued message for retry (count={count}, delay={delay_ms / 1000:.0f}s)")
+                confirms.append(self._republish(message, result["new_headers"], routing_key))
 
             # 2️⃣ Gửi kết quả về queue reply_to (nếu có)
             if result["response"] and message.reply_to:
-                await self._send_response(
+                confirms.append(self._send_response(
                     result["response"],
                     message.reply_to,
-                    message.correlation_id
-                )
+                    message.correlation_id,
+                    reply_codec,
+                    reply_encoding
+                ))
 
-            # 3️⃣ ACK message
-            if result["should_ack"]:
+            # 3️⃣ ACK message (nếu có publish thì ACK sau khi broker confirm, worker nhận message mới ngay)
+            if confirms:
+                task = asyncio.create_task(self._settle(message, confirms, result["should_ack"]))
+                self._settling.add(task)
+                task.add_done_callback(self._settling.discard)
+            elif result["should_ack"]:
                 await message.ack()
                 print(f"[✓] ACK message for submission done.")
             else:
@@ -106,23 +484,111 @@ class AsyncAdaptiveConsumer:
             print(f"[ERROR] Fatal exception in message callback: {e}")
             await message.nack(requeue=True)
 
-    async def _send_response(self, response_body, reply_queue, correlation_id):
-        """Gửi kết quả về lại server qua reply_to"""
+    async def _settle(self, message, confirms, should_ack):
+        """ACK/NACK message nguồn khi các message publish ra đã được confirm"""
         try:
-            await self.channel.default_exchange.publish(
-                aio_pika.Message(
-                    body=json.dumps(response_body).encode(),
-                    delivery_mode=aio_pika.DeliveryMode.PERSISTENT,
-                    correlation_id=correlation_id
-                ),
-                routing_key=reply_queue
-            )
-            print(f"[→] Sent response to {reply_queue} (CID={correlation_id})")
+            if not all(await asyncio.gather(*confirms)):
+                # Không publish được kết quả (publisher đã hết lượt retry): chấm lại qua delay queue
+                # như lỗi tạm thời, hết lượt thì dead-letter (reply_to không route được sẽ không lặp mãi)
+                await self._retry_unpublished(message)
+            elif should_ack:
+                await message.ack()
+                print(f"[✓] ACK message for submission done.")
+            else:
+                await message.nack(requeue=False)
+                print(f"[✗] NACK message (not requeued).")
         except Exception as e:
-            print(f"[ERROR] Failed to send response: {e}")
+            print(f"[ERROR] Failed to settle message: {e}")
+
+    async def _retry_unpublished(self, message):
+        """Message nguồn có kết quả không publish được → delay queue (x-retry-count + 1) hoặc dead-letter queue"""
+        headers = dict(message.headers or {})
+        count = int(headers.get("x-retry-count", 0)) + 1
+        headers["x-retry-count"] = count
+        if count >= MAX_RETRY_COUNT:
+            routing_key = self.dead_letter_queue_name
+            self.retry_stats["dead_lettered"] += 1
+            RETRIES.inc(outcome="dead_lettered")
+            print(f"[✗] Result could not be published, moved message to {routing_key} after {count} attempts")
+        else:
+            delay_ms = self._retry_delay_ms(count)
+            routing_key = self._retry_queue_name(delay_ms) if delay_ms > 0 else self.submission_queue_name
+            self.retry_stats["retried"] += 1
+            RETRIES.inc(outcome="retried")
+            print(f"[↻] Result could not be published, requeued message for retry "
+                  f"(count={count}, delay={delay_ms / 1000:.0f}s)")
+        if await self._republish(message, headers, routing_key):
+            await message.ack()
+        else:
+            # Broker không nhận cả bản retry: bỏ message thay vì requeue vô hạn
+            await message.nack(requeue=False)
+            print(f"[✗] NACK message (not requeued, could not be republished to {routing_key}).")
+
+    def _republish(self, message, headers, routing_key):
+        """Publish lại message nguồn với headers mới, trả về Future confirm"""
+        # Handler không sửa body → gửi lại nguyên bản (vẫn nén nếu message gốc nén)
+        return self.publisher.publish(
+            aio_pika.Message(
+                body=message.body,
+                content_type=message.content_type,
+                content_encoding=message.content_encoding,
+                delivery_mode=aio_pika.DeliveryMode.PERSISTENT,
+                headers=headers,
+                priority=message.priority,
+                reply_to=message.reply_to,
+                correlation_id=message.correlation_id
+            ),
+            routing_key
+        )
+
+    def _send_response(self, response_body, reply_queue, correlation_id, codec=JsonCodec, encoding=None):
+        """Gửi kết quả về lại server qua reply_to, trả về Future (True khi broker đã confirm)"""
+        print(f"[→] Sending response to {reply_queue} (CID={correlation_id})")
+        body, content_encoding = encode_reply(codec.dumps(response_body), encoding)
+        return self.publisher.publish(
+            aio_pika.Message(
+                body=body,
+                content_type=codec.content_type,
+                content_encoding=content_encoding,
+                delivery_mode=aio_pika.DeliveryMode.PERSISTENT,
+                correlation_id=correlation_id
+            ),
+            reply_queue
+        )
+
+    async def _send_progress(self, progress_body, reply_queue, correlation_id, codec=JsonCodec, encoding=None):
+        """
+        Gửi progress message (không persistent). Phân biệt với kết quả cuối bằng
+        type="progress" và header x-message-type=progress.
+        """
+        # Best-effort: không retry, không chờ confirm
+        body, content_encoding = encode_reply(codec.dumps(progress_body), encoding)
+        self.publisher.publish(
+            aio_pika.Message(
+                body=body,
+                content_type=codec.content_type,
+                content_encoding=content_encoding,
+                delivery_mode=aio_pika.DeliveryMode.NOT_PERSISTENT,
+                correlation_id=correlation_id,
+                type="progress",
+                headers={"x-message-type": "progress"}
+            ),
+            reply_queue,
+            retries=0
+        )
 
     async def _cleanup(self):
         """Đóng kết nối gọn gàng"""
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks.clear()
+        if self.metrics_server:
+            self.metrics_server.close()
+        if self.publisher:
+            # Gửi nốt kết quả còn chờ, sau đó ACK/NACK message nguồn trên channel consume
+            await self.publisher.close()
+            await asyncio.gather(*self._settling, return_exceptions=True)
         if self.channel and not self.channel.is_closed:
             await self.channel.close()
         if self.connection and not self.connection.is_closed:
@@ -0,0 +1,364 @@
+"""
+Benchmark - Đo throughput/latency của judge pipeline với workload tổng hợp, kết quả ghi ra JSON để so sánh giữa các commit
+
+Workload (tái lập được theo --seed): tỉ lệ ngôn ngữ, số testcase, kích thước output,
+tỉ lệ bài TLE / WA. Submission tới theo --rate (Poisson hoặc đều), không chờ bài trước xong.
+
+Mode:
+    executor  gọi execute_in_sandbox trực tiếp (đo sandbox + scheduler testcase)
+    consumer  AsyncAdaptiveConsumer + InMemoryTransport (đo cả handler, sandbox runner, publish reply)
+
+Ví dụ (không cần root / RabbitMQ):
+    SANDBOX_BACKEND=local python3 src/benchmark.py --mode consumer --count 200 --rate 10 -o bench.json
+    SANDBOX_BACKEND=local python3 src/benchmark.py --mode consumer --count 200 --rate 10 --compare bench.json
+"""
+import argparse
+import asyncio
+import contextlib
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import time
+import uuid
+from collections import Counter
+
+RESULT_VERSION = 1
+
+PROGRAMS = {
+    # ok: in n dòng i*i; wa: sai mọi dòng; tle: vòng lặp vô hạn
+    ("python", "ok"): "n = int(input())\nprint('\\n'.join(str(i * i) for i in range(n)))\n",
+    ("python", "wa"): "n = int(input())\nprint('\\n'.join(str(i * i + 1) for i in range(n)))\n",
+    ("python", "tle"): "while True:\n    pass\n",
+    ("cpp", "ok"): "#include <cstdio>\nint main(){long long n;scanf(\"%lld\",&n);"
+                   "for(long long i=0;i<n;i++)printf(\"%lld\\n\",i*i);}\n",
+    ("cpp", "wa"): "#include <cstdio>\nint main(){long long n;scanf(\"%lld\",&n);"
+                   "for(long long i=0;i<n;i++)printf(\"%lld\\n\",i*i+1);}\n",
+    ("cpp", "tle"): "int main(){volatile long long x=0;for(;;)x++;}\n",
+}
+EXPECTED = {"ok": "Passed", "wa": "Failed", "tle": "Failed"}
+
+
+def parse_mix(s):
+    """'python=0.7,cpp=0.3' -> {'python': 0.7, 'cpp': 0.3}"""
+    mix = {}
+    for part in s.split(","):
+        if "=" in part:
+            name, weight = part.split("=", 1)
+            mix[name.strip()] = float(weight)
+    return mix
+
+
+def parse_range(s):
+    """'5-20' -> (5, 20), '8' -> (8, 8)"""
+    low, _, high = s.partition("-")
+    return int(low), int(high or low)
+
+
+def _lines_for_bytes(target):
+    """Số dòng i*i (i = 0..n-1) có tổng độ dài xấp xỉ target byte"""
+    n, size = 0, 0
+    while size < target:
+        size += len(str(n * n)) + 1
+        n += 1
+    return max(n, 1)
+
+
+def generate_workload(args):
+    """Danh sách (arrival offset giây, kind, message) tái lập được theo seed"""
+    rnd = random.Random(args.seed)
+    languages = parse_mix(args.languages)
+    tc_low, tc_high = parse_range(args.testcases)
+    workload = []
+    offset = 0.0
+    for i in range(args.count):
+        language = rnd.choices(list(languages), weights=list(languages.values()))[0]
+        roll = rnd.random()
+        kind = "tle" if roll < args.tle_ratio else "wa" if roll < args.tle_ratio + args.wa_ratio else "ok"
+        testcases = []
+        for j in range(rnd.randint(tc_low, tc_high)):
+            n = _lines_for_bytes(max(1, int(rnd.uniform(0.5, 1.5) * args.output_bytes)))
+            testcases.append({
+                "TestCaseId": f"bench-{i}-{j}",
+                "InputRef": str(n),
+                "OutputRef": "\n".join(str(k * k) for k in range(n)),
+                "IndexNo": j,
+            })
+        message = {
+            "SubmissionId": f"bench-{args.seed}-{i}",
+            "Language": language,
+            "Code": PROGRAMS[(language, kind)],
+            "TimeLimit": args.timelimit * 1000,
+            "MemoryLimit": args.memorylimit,
+            "Testcases": testcases,
+            "NoCache": True,
+        }
+        workload.append((offset, kind, message))
+        if args.rate > 0:
+            offset += rnd.expovariate(args.rate) if args.arrival == "poisson" else 1.0 / args.rate
+    return workload
+
+
+def percentile(values, p):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    k = (len(ordered) - 1) * p / 100
+    low = int(k)
+    high = min(low + 1, len(ordered) - 1)
+    return ordered[low] + (ordered[high] - ordered[low]) * (k - low)
+
+
+class BoxSampler:
+    """Lấy mẫu số box đang dùng (box_ids của sandbox backend) mỗi interval giây"""
+
+    def __init__(self, capacity, interval=0.1):
+        from sandbox_backend import get_backend
+
+        self.backend = get_backend()
+        self.capacity = max(1, capacity)
+        self.interval = interval
+        self.samples = []
+        self._task = None
+
+    async def _loop(self):
+        while True:
+            self.samples.append(len(self.backend.box_ids()))
+            await asyncio.sleep(self.interval)
+
+    def start(self):
+        self._task = asyncio.create_task(self._loop())
+
+    async def stop(self):
+        self._task.cancel()
+        await asyncio.gather(self._task, return_exceptions=True)
+        if not self.samples:
+            return {"mean": 0.0, "max": 0.0, "capacity": self.capacity}
+        return {
+            "mean": round(sum(self.samples) / len(self.samples) / self.capacity, 4),
+            "max": round(max(self.samples) / self.capacity, 4),
+            "capacity": self.capacity,
+        }
+
+
+async def _paced(workload, submit):
+    """Gửi từng submission đúng thời điểm arrival (open loop); trả về list kết quả của submit"""
+    start = time.monotonic()
+    tasks = []
+    for offset, kind, message in workload:
+        delay = start + offset - time.monotonic()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        tasks.append(asyncio.create_task(submit(kind, message)))
+    return await asyncio.gather(*tasks)
+
+
+async def run_executor(workload, args):
+    from executor_isolate_async import execute_in_sandbox
+
+    slots = asyncio.Semaphore(args.concurrency)
+
+    async def submit(kind, message):
+        arrived = time.monotonic()
+        async with slots:
+            results = await execute_in_sandbox(
+                message["Language"], message["Code"], message["Testcases"],
+                args.timelimit, args.memorylimit
+            )
+        statuses = [r.get("status") for r in results]
+        verdict = "Passed" if statuses and all(s == "Passed" for s in statuses) else "Failed"
+        return kind, message["Language"], verdict, time.monotonic() - arrived
+
+    return await _paced(workload, submit)
+
+
+@contextlib.asynccontextmanager
+async def in_memory_judge():
+    """
+    AsyncAdaptiveConsumer trên InMemoryTransport trong cùng process.
+    Yield submit(body, **properties) → (reply đã decode, số giây từ lúc publish tới lúc có reply)
+    """
+    from broker_transport import InMemoryBroker, InMemoryTransport
+    from adaptive_consumer import AsyncAdaptiveConsumer
+    from message_codec import decompress_body, get_codec
+
+    broker = InMemoryBroker()
+    consumer = AsyncAdaptiveConsumer(transport=InMemoryTransport(broker))
+    consumer_task = asyncio.create_task(consumer.start())
+    await broker.wait_for_consumer(consumer.submission_queue_name)
+    reply_queue = f"bench-{uuid.uuid4().hex[:8]}"
+    pending = {}  # correlation_id -> future
+
+    async def collect_replies():
+        while True:
+            reply = await broker.get(reply_queue)
+            future = pending.pop(reply.correlation_id, None)
+            if future is None or future.done():
+                continue
+            try:
+                body = decompress_body(reply.body, reply.content_encoding)
+                future.set_result(get_codec(reply.content_type).loads(body))
+            except Exception:
+                future.set_result({})
+
+    async def submit(body, **properties):
+        correlation_id = uuid.uuid4().hex
+        future = asyncio.get_running_loop().create_future()
+        pending[correlation_id] = future
+        sent = time.monotonic()
+        broker.publish(consumer.submission_queue_name, body, reply_to=reply_queue,
+                       correlation_id=correlation_id, **properties)
+        response = await future
+        return response, time.monotonic() - sent
+
+    collector = asyncio.create_task(collect_replies())
+    try:
+        yield submit
+    finally:
+        collector.cancel()
+        consumer.request_stop()
+        await asyncio.gather(collector, consumer_task, return_exceptions=True)
+
+
+async def run_consumer(workload, args):
+    async with in_memory_judge() as judge:
+        async def submit(kind, message):
+            response, seconds = await judge(json.dumps(message).encode(), content_type="application/json")
+            return kind, message["Language"], response.get("ErrorCode"), seconds
+
+        return await _paced(workload, submit)
+
+
+async def run_benchmark(args):
+    workload = generate_workload(args)
+    parallel = int(os.getenv("MAX_PARALLEL_TESTCASES", "4"))
+    sampler = BoxSampler(args.concurrency * parallel)
+    runner = run_executor if args.mode == "executor" else run_consumer
+    sampler.start()
+    started = time.monotonic()
+    # Log của consumer/executor không lẫn vào kết quả benchmark
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(sys.stdout if args.verbose else devnull):
+        outcomes = await runner(workload, args)
+    duration = time.monotonic() - started
+    utilization = await sampler.stop()
+
+    latencies = [o[3] * 1000 for o in outcomes]
+    by_language = {}
+    for language in sorted({o[1] for o in outcomes}):
+        values = [o[3] * 1000 for o in outcomes if o[1] == language]
+        by_language[language] = {
+            "count": len(values),
+            "p50": round(percentile(values, 50), 1),
+            "p95": round(percentile(values, 95), 1),
+        }
+    return {
+        "submitted": len(workload),
+        "completed": len(outcomes),
+        "unexpected_verdicts": sum(1 for kind, _, verdict, _ in outcomes if verdict != EXPECTED[kind]),
+        "duration_s": round(duration, 3),
+        "throughput_sps": round(len(outcomes) / duration, 3) if duration else 0.0,
+        "testcases_per_s": round(sum(len(m["Testcases"]) for _, _, m in workload) / duration, 3) if duration else 0.0,
+        "latency_ms": {
+            "p50": round(percentile(latencies, 50), 1),
+            "p95": round(percentile(latencies, 95), 1),
+            "p99": round(percentile(latencies, 99), 1),
+            "mean": round(sum(latencies) / len(latencies), 1) if latencies else 0.0,
+            "max": round(max(latencies), 1) if latencies else 0.0,
+        },
+        "by_language": by_language,
+        "verdicts": dict(Counter(o[2] for o in outcomes)),
+        "box_utilization": utilization,
+    }
+
+
+def _git_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+            cwd=os.path.dirname(os.path.abspath(__file__)), timeout=5
+        ).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+
+def print_summary(report, baseline=None):
+    r = report["results"]
+    lat = r["latency_ms"]
+    print(f"{report['config']['mode']} mode, {r['completed']}/{r['submitted']} submissions in {r['duration_s']:.1f}s "
+          f"(backend={report['sandbox_backend']}, commit={report['git_commit']})")
+    print(f"  throughput  {r['throughput_sps']:.2f} submissions/s, {r['testcases_per_s']:.1f} testcases/s")
+    print(f"  latency     p50={lat['p50']:.0f}ms p95={lat['p95']:.0f}ms p99={lat['p99']:.0f}ms max={lat['max']:.0f}ms")
+    print(f"  boxes       mean={r['box_utilization']['mean'] * 100:.0f}% max={r['box_utilization']['max'] * 100:.0f}% "
+          f"of {r['box_utilization']['capacity']}")
+    print(f"  verdicts    {r['verdicts']} (unexpected: {r['unexpected_verdicts']})")
+    if baseline:
+        b = baseline["results"]
+
+        def delta(new, old):
+            return f"{(new - old) / old * 100:+.1f}%" if old else "n/a"
+
+        print(f"  vs {baseline.get('git_commit') or 'baseline'}: "
+              f"throughput {delta(r['throughput_sps'], b['throughput_sps'])}, "
+              + ", ".join(f"{p} {delta(lat[p], b['latency_ms'][p])}" for p in ("p50", "p95", "p99")))
+        if baseline.get("config") != report["config"]:
+            print("  [WARNING] baseline was recorded with a different workload/config")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Throughput/latency benchmark of the judge pipeline")
+    parser.add_argument("--mode", choices=("executor", "consumer"), default="consumer")
+    parser.add_argument("--count", type=int, default=100, help="Number of submissions")
+    parser.add_argument("--rate", type=float, default=5, help="Arrival rate (submissions/s), 0 = all at once")
+    parser.add_argument("--arrival", choices=("poisson", "uniform"), default="poisson")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--languages", default="python=0.6,cpp=0.4", help="Language mix, e.g. python=0.6,cpp=0.4")
+    parser.add_argument("--testcases", default="5-20", help="Testcases per submission (range)")
+    parser.add_argument("--output-bytes", type=int, default=1000, help="Mean expected output size per testcase")
+    parser.add_argument("--tle-ratio", type=float, default=0.05)
+    parser.add_argument("--wa-ratio", type=float, default=0.15)
+    parser.add_argument("--timelimit", type=int, default=1, help="Time limit (seconds)")
+    parser.add_argument("--memorylimit", type=int, default=262144, help="Memory limit (KB)")
+    parser.add_argument("--concurrency", type=int, default=int(os.getenv("MAX_CONCURRENT_SUBMISSIONS", "4")),
+                        help="Concurrent submissions (MAX_CONCURRENT_SUBMISSIONS)")
+    parser.add_argument("-o", "--output", help="Write machine-readable results (JSON)")
+    parser.add_argument("--compare", help="Baseline result file to compare against")
+    parser.add_argument("-v", "--verbose", action="store_true", help="Show consumer logs")
+    args = parser.parse_args()
+
+    # Consumer đọc cấu hình từ env lúc import
+    os.environ["MAX_CONCURRENT_SUBMISSIONS"] = str(args.concurrency)
+    os.environ.setdefault("LATENCY_LOG_INTERVAL", "0")
+    if not args.verbose:
+        import logging
+        logging.disable(logging.INFO)
+
+    config = {k: v for k, v in vars(args).items() if k not in ("output", "compare", "verbose")}
+    config["max_parallel_testcases"] = int(os.getenv("MAX_PARALLEL_TESTCASES", "4"))
+    results = asyncio.run(run_benchmark(args))
+    report = {
+        "version": RESULT_VERSION,
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+        "git_commit": _git_commit(),
+        "host": platform.node(),
+        "cpu_count": os.cpu_count(),
+        "python": platform.python_version(),
+        "sandbox_backend": os.getenv("SANDBOX_BACKEND", "isolate"),
+        "config": config,
+        "results": results,
+    }
+
+    baseline = None
+    if args.compare:
+        with open(args.compare, "r", encoding="utf-8") as f:
+            baseline = json.load(f)
+    print_summary(report, baseline)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+        print(f"Results written to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,396 @@
+"""
+Broker Transport - Kết nối tới message broker cho AsyncAdaptiveConsumer
+- AmqpTransport: RabbitMQ thật qua aio_pika.connect_robust (production)
+- InMemoryTransport: broker giả trong cùng process, cùng API (phần consumer/publisher dùng) và cùng
+  ngữ nghĩa ack / nack(requeue) / prefetch / priority / TTL + dead-letter / fanout / reply_to.
+  Dùng cho test end-to-end và benchmark consumer → response trong 1 process, không cần RabbitMQ.
+
+Ví dụ:
+    broker = InMemoryBroker()
+    consumer = AsyncAdaptiveConsumer(transport=InMemoryTransport(broker))
+    asyncio.create_task(consumer.start())
+    await broker.wait_for_consumer("submission_queue")
+    broker.publish("submission_queue", json.dumps(submission).encode(),
+                   reply_to="result_queue", correlation_id="1")
+    reply = await broker.get("result_queue", timeout=30)
+"""
+import asyncio
+import heapq
+import itertools
+import time
+import uuid
+from datetime import datetime, timezone
+
+import aio_pika
+from pamqp.commands import Basic
+
+
+class AmqpTransport:
+    name = "RabbitMQ"
+
+    async def connect(self, url, **kwargs):
+        return await aio_pika.connect_robust(url, **kwargs)
+
+
+class InMemoryTransport:
+    name = "in-memory broker"
+
+    def __init__(self, broker=None):
+        self.broker = broker or InMemoryBroker()
+
+    async def connect(self, url=None, **kwargs):
+        return InMemoryConnection(self.broker)
+
+
+# ----------------------------------------------------------------------------
+# In-memory broker
+# ----------------------------------------------------------------------------
+_PROPERTIES = (
+    "content_type", "content_encoding", "delivery_mode", "priority", "correlation_id", "reply_to",
+    "expiration", "message_id", "timestamp", "type", "user_id", "app_id",
+)
+
+
+class InMemoryMessage:
+    """Message đã được giao cho consumer (tương đương aio_pika.IncomingMessage)"""
+
+    def __init__(self, body, headers=None, routing_key="", exchange="", **properties):
+        self.body = body
+        self.headers = dict(headers or {})
+        self.routing_key = routing_key
+        self.exchange = exchange
+        for name in _PROPERTIES:
+            setattr(self, name, properties.get(name))
+        if self.timestamp is None:
+            self.timestamp = datetime.now(timezone.utc)
+        self.redelivered = False
+        self.delivery_tag = None
+        self.processed = False
+        self._consumer = None
+
+    @classmethod
+    def from_message(cls, message, routing_key="", exchange=""):
+        """Copy từ aio_pika.Message / InMemoryMessage (mỗi queue giữ 1 bản riêng)"""
+        return cls(
+            message.body, message.headers, routing_key, exchange,
+            **{name: getattr(message, name, None) for name in _PROPERTIES}
+        )
+
+    def _settle(self):
+        if self.processed:
+            raise RuntimeError("Message already processed")
+        self.processed = True
+        consumer, self._consumer = self._consumer, None
+        return consumer
+
+    async def ack(self):
+        consumer = self._settle()
+        if consumer:
+            consumer.settled(self)
+
+    async def nack(self, requeue=True):
+        consumer = self._settle()
+        if consumer:
+            # Trả message về vị trí cũ trước khi slot prefetch được giải phóng (giao lại trước message sau nó)
+            consumer.unacked.pop(self.delivery_tag, None)
+            consumer.queue.return_message(self, requeue)
+            consumer.queue.dispatch()
+
+    async def reject(self, requeue=False):
+        await self.nack(requeue)
+
+
+class _Consumer:
+    def __init__(self, queue, channel, callback, no_ack, tag):
+        self.queue = queue
+        self.channel = channel
+        self.callback = callback
+        self.no_ack = no_ack
+        self.tag = tag
+        self.unacked = {}  # delivery_tag -> message
+
+    def has_capacity(self):
+        prefetch = self.channel.prefetch_count
+        return self.no_ack or not prefetch or len(self.unacked) < prefetch
+
+    def deliver(self, message):
+        message.delivery_tag = next(self.channel.delivery_tags)
+        message.processed = False
+        if self.no_ack:
+            message.processed = True
+        else:
+            message._consumer = self
+            self.unacked[message.delivery_tag] = message
+        task = asyncio.ensure_future(self.callback(message))
+        self.channel.callbacks.add(task)
+        task.add_done_callback(self.channel.callbacks.discard)
+
+    def settled(self, message):
+        self.unacked.pop(message.delivery_tag, None)
+        self.queue.dispatch()
+
+    def requeue_unacked(self):
+        """Channel đóng: message chưa ACK quay lại queue (redelivered)"""
+        for message in list(self.unacked.values()):
+            message._consumer = None
+            message.processed = True
+            self.queue.return_message(message, True)
+        self.unacked.clear()
+
+
+class _Queue:
+    def __init__(self, broker, name, arguments=None, exclusive=False, auto_delete=False):
+        self.broker = broker
+        self.name = name
+        self.arguments = dict(arguments or {})
+        self.exclusive = exclusive
+        self.auto_delete = auto_delete
+        self.max_priority = int(self.arguments.get("x-max-priority", 0) or 0)
+        self.ttl_ms = self.arguments.get("x-message-ttl")
+        self._heap = []  # (-priority, seq, message)
+        self._seq = itertools.count()
+        self._consumers = []
+        self._waiters = []  # future của get()
+        self._round_robin = 0
+
+    def __len__(self):
+        return len(self._heap)
+
+    def _priority(self, message):
+        if not self.max_priority:
+            return 0
+        return min(int(message.priority or 0), self.max_priority)
+
+    def put(self, message, seq=None):
+        seq = next(self._seq) if seq is None else seq
+        message._seq = seq
+        heapq.heappush(self._heap, (-self._priority(message), seq, message))
+        if self.ttl_ms is not None and not message.redelivered:
+            asyncio.get_event_loop().call_later(int(self.ttl_ms) / 1000, self._expire, message)
+        self.dispatch()
+
+    def return_message(self, message, requeue):
+        if requeue:
+            # Giữ vị trí cũ trong queue (như RabbitMQ), đánh dấu redelivered
+            message.redelivered = True
+            self.put(message, getattr(message, "_seq", None))
+        else:
+            self._dead_letter(message, "rejected")
+
+    def _expire(self, message):
+        for i, (_, _, queued) in enumerate(self._heap):
+            if queued is message:
+                self._heap.pop(i)
+                heapq.heapify(self._heap)
+                self._dead_letter(message, "expired")
+                return
+
+    def _dead_letter(self, message, reason):
+        if "x-dead-letter-exchange" not in self.arguments:
+            return
+        exchange = self.arguments["x-dead-letter-exchange"]
+        routing_key = self.arguments.get("x-dead-letter-routing-key", message.routing_key)
+        dead = InMemoryMessage.from_message(message)
+        deaths = list(dead.headers.get("x-death") or [])
+        deaths.insert(0, {"queue": self.name, "reason": reason, "count": 1,
+                          "exchange": message.exchange, "routing-keys": [message.routing_key]})
+        dead.headers["x-death"] = deaths
+        self.broker.route(exchange, routing_key, dead)
+
+    def _pop(self):
+        return heapq.heappop(self._heap)[2]
+
+    def dispatch(self):
+        """Giao message cho get() đang chờ, sau đó cho consumer còn slot (round-robin)"""
+        while self._heap and self._waiters:
+            waiter = self._waiters.pop(0)
+            if not waiter.done():
+                waiter.set_result(self._pop())
+        while self._heap and self._consumers:
+            for offset in range(len(self._consumers)):
+                consumer = self._consumers[(self._round_robin + offset) % len(self._consumers)]
+                if consumer.has_capacity():
+                    self._round_robin = (self._round_robin + offset + 1) % len(self._consumers)
+                    consumer.deliver(self._pop())
+                    break
+            else:
+                return
+
+    def add_consumer(self, consumer):
+        self._consumers.append(consumer)
+        self.dispatch()
+
+    def remove_consumer(self, consumer):
+        if consumer in self._consumers:
+            self._consumers.remove(consumer)
+        if self.auto_delete and not self._consumers:
+            self.broker.queues.pop(self.name, None)
+
+    async def get(self, timeout=None):
+        if self._heap:
+            return self._pop()
+        waiter = asyncio.get_event_loop().create_future()
+        self._waiters.append(waiter)
+        try:
+            return await asyncio.wait_for(waiter, timeout)
+        finally:
+            if waiter in self._waiters:
+                self._waiters.remove(waiter)
+
+
+class _Exchange:
+    def __init__(self, name, type_="direct"):
+        self.name = name
+        self.type = getattr(type_, "value", type_)
+        self.bindings = []  # (queue name, routing key)
+
+
+class InMemoryBroker:
+    """Trạng thái broker (queue, exchange) dùng chung cho mọi connection trong process"""
+
+    def __init__(self):
+        self.queues = {}
+        self.exchanges = {"": _Exchange("", "direct")}
+        self._consumer_tags = itertools.count(1)
+
+    def declare_queue(self, name=None, arguments=None, exclusive=False, auto_delete=False):
+        name = name or f"amq.gen-{uuid.uuid4().hex[:22]}"
+        queue = self.queues.get(name)
+        if queue is None:
+            queue = self.queues[name] = _Queue(self, name, arguments, exclusive, auto_delete)
+        elif dict(arguments or {}) != queue.arguments:
+            raise ValueError(f"PRECONDITION_FAILED - inequivalent arguments for queue '{name}'")
+        return queue
+
+    def declare_exchange(self, name, type_="direct"):
+        if name not in self.exchanges:
+            self.exchanges[name] = _Exchange(name, type_)
+        return self.exchanges[name]
+
+    def route(self, exchange_name, routing_key, message):
+        """Default exchange: theo tên queue; fanout: mọi queue đã bind; direct: theo routing key"""
+        if exchange_name == "":
+            targets = [routing_key]
+        else:
+            exchange = self.exchanges.get(exchange_name)
+            if exchange is None:
+                return
+            targets = [q for q, key in exchange.bindings if exchange.type == "fanout" or key == routing_key]
+        for name in targets:
+            queue = self.queues.get(name)
+            if queue is not None:
+                # Message không route được bị bỏ (như RabbitMQ khi không có mandatory)
+                queue.put(InMemoryMessage.from_message(message, routing_key, exchange_name))
+
+    # --- Helper cho phía client (test / benchmark) ---------------------------
+    def publish(self, routing_key, body, headers=None, exchange="", **properties):
+        """Publish như backend (properties: reply_to, correlation_id, priority, content_type, ...)"""
+        if exchange == "" and routing_key not in self.queues:
+            self.declare_queue(routing_key)
+        self.route(exchange, routing_key, InMemoryMessage(body, headers, routing_key, exchange, **properties))
+
+    async def get(self, queue_name, timeout=None):
+        """Lấy 1 message (no-ack) - ví dụ đọc reply trong result_queue; raise asyncio.TimeoutError"""
+        queue = self.queues.get(queue_name) or self.declare_queue(queue_name)
+        return await queue.get(timeout)
+
+    async def wait_for_consumer(self, queue_name, timeout=30):
+        deadline = time.monotonic() + timeout
+        while not (queue_name in self.queues and self.queues[queue_name]._consumers):
+            if time.monotonic() > deadline:
+                raise asyncio.TimeoutError(f"No consumer on '{queue_name}' after {timeout}s")
+            await asyncio.sleep(0.01)
+
+    def depth(self, queue_name):
+        queue = self.queues.get(queue_name)
+        return len(queue) if queue is not None else 0
+
+
+class InMemoryQueue:
+    """Queue handle của 1 channel (tương đương aio_pika.Queue)"""
+
+    def __init__(self, channel, queue):
+        self.channel = channel
+        self.queue = queue
+        self.name = queue.name
+
+    async def consume(self, callback, no_ack=False):
+        tag = f"ctag-{next(self.channel.broker._consumer_tags)}"
+        consumer = _Consumer(self.queue, self.channel, callback, no_ack, tag)
+        self.channel.consumers[tag] = consumer
+        self.queue.add_consumer(consumer)
+        return tag
+
+    async def cancel(self, consumer_tag):
+        """Ngừng nhận message mới; message đã giao vẫn ACK/NACK được"""
+        consumer = self.channel.consumers.get(consumer_tag)
+        if consumer:
+            self.queue.remove_consumer(consumer)
+
+    async def bind(self, exchange, routing_key=""):
+        name = exchange if isinstance(exchange, str) else exchange.name
+        self.channel.broker.exchanges[name].bindings.append((self.queue.name, routing_key))
+
+    async def get(self, timeout=None):
+        return await self.queue.get(timeout)
+
+
+class InMemoryExchange:
+    def __init__(self, channel, name):
+        self.channel = channel
+        self.name = name
+
+    async def publish(self, message, routing_key):
+        if self.channel.is_closed:
+            raise RuntimeError("Channel is closed")
+        self.channel.broker.route(self.name, routing_key, message)
+        return Basic.Ack()  # publisher confirm
+
+
+class InMemoryChannel:
+    def __init__(self, connection):
+        self.connection = connection
+        self.broker = connection.broker
+        self.prefetch_count = 0
+        self.consumers = {}
+        self.callbacks = set()
+        self.delivery_tags = itertools.count(1)
+        self.is_closed = False
+        self.default_exchange = InMemoryExchange(self, "")
+
+    async def set_qos(self, prefetch_count=0, **kwargs):
+        self.prefetch_count = prefetch_count
+
+    async def declare_queue(self, name=None, durable=False, exclusive=False, auto_delete=False,
+                            arguments=None, **kwargs):
+        return InMemoryQueue(self, self.broker.declare_queue(name, arguments, exclusive, auto_delete))
+
+    async def declare_exchange(self, name, type=aio_pika.ExchangeType.DIRECT, durable=False, **kwargs):
+        self.broker.declare_exchange(name, type)
+        return InMemoryExchange(self, name)
+
+    async def close(self):
+        if self.is_closed:
+            return
+        self.is_closed = True
+        for consumer in self.consumers.values():
+            consumer.queue.remove_consumer(consumer)
+            consumer.requeue_unacked()
+        self.consumers.clear()
+
+
+class InMemoryConnection:
+    def __init__(self, broker):
+        self.broker = broker
+        self.channels = []
+        self.is_closed = False
+
+    async def channel(self, publisher_confirms=True, **kwargs):
+        channel = InMemoryChannel(self)
+        self.channels.append(channel)
+        return channel
+
+    async def close(self):
+        for channel in self.channels:
+            await channel.close()
+        self.is_closed = True
@@ -0,0 +1,182 @@
+"""
+Bulk Judge CLI - Chấm lại hàng loạt submission từ file JSONL (không cần RabbitMQ)
+Mỗi dòng input có cùng format với message trong submission_queue.
+Chạy trực tiếp execute_in_sandbox (cần quyền isolate như main.py, hoặc SANDBOX_BACKEND=local để chạy không cần root).
+
+Ví dụ:
+    python3 src/bulk_judge.py submissions.jsonl -o results.jsonl --concurrency 4
+"""
+import argparse
+import asyncio
+import hashlib
+import json
+import os
+import sys
+import time
+
+from executor_isolate_async import execute_in_sandbox
+from message_handler import MessageHandler, TESTCASE_STATUS_CODE
+from verdict_cache import VerdictCache, submission_cache_key
+from node_speed import node_speed
+
+
+def _group_key(data):
+    """Nhóm theo ProblemId, nếu không có thì theo bộ testcase"""
+    if data.get("ProblemId"):
+        return str(data["ProblemId"])
+    ids = sorted(str(tc.get("TestCaseId") or tc.get("testcaseId", "")) for tc in data.get("Testcases", []))
+    return hashlib.sha256("\0".join(ids).encode("utf-8")).hexdigest()
+
+
+def index_input(path):
+    """
+    Đọc lướt file input, chỉ giữ (offset, SubmissionId, group) để không giữ cả
+    file trong bộ nhớ. Trả về list đã sort theo group (giữ thứ tự trong group).
+    """
+    entries = []
+    with open(path, "rb") as f:
+        offset = 0
+        for line_no, line in enumerate(f, 1):
+            if line.strip():
+                try:
+                    data = json.loads(line)
+                    entries.append((offset, str(data.get("SubmissionId", f"line-{line_no}")), _group_key(data)))
+                except json.JSONDecodeError as e:
+                    print(f"[WARNING] Skipping invalid JSON at line {line_no}: {e}", file=sys.stderr)
+            offset += len(line)
+    first_seen = {}
+    for i, (_, _, group) in enumerate(entries):
+        first_seen.setdefault(group, i)
+    entries.sort(key=lambda e: first_seen[e[2]])
+    return entries
+
+
+def load_done_ids(path):
+    """SubmissionId đã có trong file output (để resume)"""
+    done = set()
+    if not os.path.exists(path):
+        return done
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            try:
+                done.add(str(json.loads(line)["SubmissionId"]))
+            except (json.JSONDecodeError, KeyError):
+                continue  # dòng ghi dở do bị ngắt giữa chừng
+    return done
+
+
+def _build_response(submission_id, results):
+    """Tạo response giống MessageHandler (CompileResult, TotalTime, ...)"""
+    if not isinstance(results, list) or not results:
+        return MessageHandler._create_error_response(submission_id, "InternalError", "Invalid result from isolate executor", "4")
+    first_status = results[0].get("status")
+    if first_status in ("CompilationError", "InternalError"):
+        return MessageHandler._create_error_response(
+            submission_id, first_status, results[0].get("error"), TESTCASE_STATUS_CODE.get(first_status, "4")
+        )
+    return MessageHandler._create_success_response(submission_id, results)
+
+
+class BulkJudge:
+    def __init__(self, input_path, output_path, concurrency, details, use_cache):
+        self.input_path = input_path
+        self.output_path = output_path
+        self.concurrency = concurrency
+        self.details = details
+        self.cache = VerdictCache() if use_cache else VerdictCache(max_entries=0)
+        self.done = 0
+        self.testcases = 0
+        self.cache_hits = 0
+        self.started_at = None
+
+    async def run(self, overwrite=False):
+        entries = index_input(self.input_path)
+        if overwrite and os.path.exists(self.output_path):
+            os.remove(self.output_path)
+        done_ids = load_done_ids(self.output_path)
+        pending = [e for e in entries if e[1] not in done_ids]
+        total = len(pending)
+        groups = len({e[2] for e in pending})
+        print(f"[*] {len(entries)} submissions in input, {len(entries) - total} already judged, "
+              f"{total} to judge in {groups} problem groups", file=sys.stderr)
+
+        # Rejudge trên node khác vẫn cho cùng verdict: limit theo hệ số tốc độ của node này
+        await node_speed.calibrate()
+        self.started_at = time.monotonic()
+        queue = iter(pending)  # dùng chung giữa các worker, mỗi worker lấy lần lượt
+
+        with open(self.input_path, "rb") as src, open(self.output_path, "a", encoding="utf-8") as out:
+            async def worker():
+                for offset, _, _ in queue:
+                    # Chỉ đọc payload khi tới lượt, không giữ cả file trong bộ nhớ
+                    src.seek(offset)
+                    data = json.loads(src.readline())
+                    line = await self._judge_one(data)
+                    out.write(json.dumps(line, ensure_ascii=False) + "\n")
+                    out.flush()
+                    self.done += 1
+                    self._report_progress(total)
+
+            await asyncio.gather(*(worker() for _ in range(self.concurrency)))
+
+        self._report_progress(total, final=True)
+
+    async def _judge_one(self, data):
+        submission_id = data.get("SubmissionId", "N/A")
+        language = data.get("Language")
+        code = data.get("Code")
+        testcases = data.get("Testcases", [])
+        if not language or not code or not testcases:
+            return MessageHandler._create_error_response(submission_id, "MISSING_REQUIRED_FIELDS")
+
+        timelimit, memorylimit = MessageHandler._parse_limits(data)
+        key = submission_cache_key(language, code, timelimit, memorylimit, testcases)
+        results = None if data.get("NoCache") else self.cache.get(key)
+        if results is not None:
+            self.cache_hits += 1
+        else:
+            results = await execute_in_sandbox(language, code, testcases, timelimit, memorylimit,
+                                               speed_factor=node_speed.factor)
+            if not any(r.get("status") == "InternalError" for r in results):
+                self.cache.put(key, results)
+        self.testcases += len(testcases)
+
+        response = _build_response(submission_id, results)
+        if self.details:
+            response["Results"] = results
+        return response
+
+    def _report_progress(self, total, final=False):
+        if not final and (self.done % 10 or self.done == total):
+            return
+        elapsed = max(time.monotonic() - self.started_at, 1e-9)
+        label = "[✓] Done" if final else "[→] Progress"
+        print(
+            f"{label}: {self.done}/{total} submissions in {elapsed:.1f}s "
+            f"({self.done / elapsed:.2f} subs/s, {self.testcases / elapsed:.1f} testcases/s, "
+            f"cache hits={self.cache_hits})",
+            file=sys.stderr, flush=True
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Judge submissions from a JSONL file directly with isolate")
+    parser.add_argument("input", help="JSONL file, one submission message per line")
+    parser.add_argument("-o", "--output", default="results.jsonl", help="JSONL result file (appended, used to resume)")
+    parser.add_argument("-c", "--concurrency", type=int,
+                        default=int(os.getenv("MAX_CONCURRENT_SUBMISSIONS", "4")),
+                        help="Submissions judged at the same time")
+    parser.add_argument("--details", action="store_true", help="Include per-testcase results")
+    parser.add_argument("--no-cache", action="store_true", help="Do not reuse verdicts of identical submissions")
+    parser.add_argument("--overwrite", action="store_true", help="Start from scratch instead of resuming")
+    args = parser.parse_args()
+
+    judge = BulkJudge(args.input, args.output, max(1, args.concurrency), args.details, not args.no_cache)
+    asyncio.run(judge.run(overwrite=args.overwrite))
+
+
+if __name__ == "__main__":
+    try:
+        main()
+    except KeyboardInterrupt:
+        print("\n[*] Interrupted, rerun the same command to resume.", file=sys.stderr)
@@ -0,0 +1,103 @@
+"""
+Codec Benchmark - Đo CPU serialize/deserialize cho 1 submission theo từng codec
+Mô phỏng các bước encode/decode của 1 submission:
+broker body → payload cho sandbox_runner → runner đọc payload → runner ghi results → handler đọc results → response.
+
+Ví dụ:
+    python3 src/codec_benchmark.py --testcases 50 --size 10000 --repeat 50
+"""
+import argparse
+import json
+import random
+import string
+import time
+
+from message_codec import JsonCodec, MsgpackCodec, msgpack, orjson
+
+
+class StdlibJsonCodec:
+    """Baseline: json của thư viện chuẩn (như trước khi có codec)"""
+    name = "json (stdlib)"
+
+    @staticmethod
+    def dumps(obj):
+        return json.dumps(obj).encode("utf-8")
+
+    @staticmethod
+    def loads(data):
+        return json.loads(data)
+
+
+def make_submission(testcases, size):
+    rnd = random.Random(42)
+
+    def blob():
+        return "".join(rnd.choices(string.digits + " \n", k=size))
+
+    message = {
+        "SubmissionId": "bench",
+        "Language": "cpp",
+        "Code": "#include <bits/stdc++.h>\nint main(){}\n" * 20,
+        "TimeLimit": 1000,
+        "MemoryLimit": 262144,
+        "Testcases": [
+            {"TestCaseId": f"tc-{i}", "InputRef": blob(), "OutputRef": blob(), "IndexNo": i}
+            for i in range(testcases)
+        ],
+    }
+    results = [
+        {"testcaseId": f"tc-{i}", "indexNo": i, "status": "Passed", "time": 12, "memory": 3400,
+         "output": blob()[:256], "error": ""}
+        for i in range(testcases)
+    ]
+    response = {"SubmissionId": "bench", "CompileResult": "0" * testcases, "TotalTime": 12 * testcases,
+                "TotalMemory": 3400 * testcases, "ErrorCode": "Passed", "ErrorMessage": ""}
+    return message, results, response
+
+
+def judge_pipeline(codec, body, message, results, response):
+    """Các bước encode/decode của 1 submission (không tính thời gian chạy sandbox)"""
+    data = codec.loads(body)
+    payload = codec.dumps({"language": data["Language"], "code": data["Code"],
+                           "testcases": data["Testcases"], "timelimit": 1.0, "memorylimit": 262144})
+    codec.loads(payload)
+    out = codec.dumps(results)
+    codec.loads(out)
+    codec.dumps(response)
+
+
+def bench(codec, message, results, response, repeat):
+    body = codec.dumps(message)
+    judge_pipeline(codec, body, message, results, response)  # warm-up
+    start = time.process_time()
+    for _ in range(repeat):
+        judge_pipeline(codec, body, message, results, response)
+    return (time.process_time() - start) / repeat, len(body)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure codec CPU time per submission")
+    parser.add_argument("--testcases", type=int, default=50, help="Testcases per submission")
+    parser.add_argument("--size", type=int, default=10000, help="Bytes of input/expected output per testcase")
+    parser.add_argument("--repeat", type=int, default=30, help="Iterations per codec")
+    args = parser.parse_args()
+
+    message, results, response = make_submission(args.testcases, args.size)
+    codecs = [StdlibJsonCodec]
+    if orjson is not None:
+        codecs.append(JsonCodec)
+    if msgpack is not None:
+        codecs.append(MsgpackCodec)
+
+    print(f"{args.testcases} testcases × {args.size} bytes, {args.repeat} iterations")
+    baseline = None
+    for codec in codecs:
+        seconds, body_size = bench(codec, message, results, response, args.repeat)
+        baseline = baseline or seconds
+        name = "json (orjson)" if codec is JsonCodec else codec.name
+        print(f"{name:<15} {seconds * 1000:8.2f} ms CPU/submission  body={body_size / 1024:8.1f} KB  "
+              f"saved={(1 - seconds / baseline) * 100:5.1f}%")
+
+
+if __name__ == "__main__":
+    main()
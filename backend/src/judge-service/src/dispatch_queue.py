@@ -0,0 +1,252 @@
+"""
+Dispatch Queue - Hàng đợi nội bộ giữa RabbitMQ consumer và các worker chấm bài
+Message được lấy về (prefetch) nhiều hơn số slot chạy, sau đó worker rảnh sẽ lấy
+message có độ ưu tiên cao nhất trước (contest > practice), và chia đều giữa các user.
+"""
+import asyncio
+import time
+from collections import deque
+
+MAX_SUBMISSION_PRIORITY = 9
+
+
+class _FairLevel:
+    """
+    Một mức priority: mỗi user (fair key) có deque riêng, chọn theo weighted round-robin.
+    User có weight w được lấy tối đa w item liên tiếp rồi mới tới lượt user khác.
+    """
+
+    def __init__(self):
+        self.queues = {}  # fair_key -> deque[(enqueued_at, item, weight)]
+        self.rotation = deque()  # thứ tự round-robin các fair_key đang có item
+        self.credits = {}
+
+    def append(self, fair_key, entry):
+        if fair_key not in self.queues:
+            self.queues[fair_key] = deque()
+            self.rotation.append(fair_key)
+            self.credits[fair_key] = entry[2]
+        self.queues[fair_key].append(entry)
+
+    def oldest_eligible(self, is_eligible):
+        """Thời điểm enqueue sớm nhất trong các user còn được chạy (None nếu không có)"""
+        heads = [q[0][0] for key, q in self.queues.items() if is_eligible(key)]
+        return min(heads) if heads else None
+
+    def pop(self, is_eligible):
+        for _ in range(len(self.rotation)):
+            fair_key = self.rotation[0]
+            if not is_eligible(fair_key):
+                self.rotation.rotate(-1)
+                continue
+            queue = self.queues[fair_key]
+            entry = queue.popleft()
+            self.credits[fair_key] -= 1
+            if not queue:
+                self.rotation.popleft()
+                del self.queues[fair_key]
+                del self.credits[fair_key]
+            elif self.credits[fair_key] <= 0:
+                self.rotation.rotate(-1)
+                self.credits[fair_key] = queue[0][2]
+            return fair_key, entry
+        return None, None
+
+    def pop_newest(self, fair_key):
+        """Lấy ra item mới nhất của fair_key (không tính vào lượt round-robin)"""
+        queue = self.queues[fair_key]
+        entry = queue.pop()
+        if not queue:
+            self.rotation.remove(fair_key)
+            del self.queues[fair_key]
+            del self.credits[fair_key]
+        return entry
+
+
+class PriorityDispatchQueue:
+    """
+    Hàng đợi ưu tiên + fair-share theo user, có chống đói (aging).
+
+    - Giữa các mức priority: độ ưu tiên hiệu dụng = priority + thời_gian_chờ / aging_seconds
+      (tính trên item chờ lâu nhất của mức đó), nên submission practice chờ đủ lâu
+      vẫn được chạy dù contest liên tục đổ về.
+    - Trong một mức: weighted round-robin giữa các user, 1 user spam 200 bài
+      không chặn các user khác phía sau.
+    - max_per_user > 0: giới hạn số submission đang chạy đồng thời của 1 user.
+      Caller phải gọi task_done(fair_key) khi xử lý xong. Item của user đã chạm giới hạn vẫn
+      chiếm chỗ prefetch: caller dùng evict_blocked() để không giữ quá nhiều item như vậy.
+    """
+
+    def __init__(self, max_priority=MAX_SUBMISSION_PRIORITY, aging_seconds=30.0, max_per_user=0):
+        self.max_priority = max_priority
+        self.aging_seconds = aging_seconds
+        self.max_per_user = max_per_user
+        self._levels = {}  # priority -> _FairLevel
+        self._running = {}  # fair_key -> số submission đang chạy
+        self._size = 0
+        self._cond = asyncio.Condition()
+
+    def __len__(self):
+        return self._size
+
+    def clamp_priority(self, priority):
+        """Đưa priority về khoảng [0, max_priority]"""
+        try:
+            priority = int(priority)
+        except (TypeError, ValueError):
+            return 0
+        return max(0, min(priority, self.max_priority))
+
+    async def put(self, item, priority=0, fair_key=None, weight=1):
+        """Thêm item vào hàng đợi, trả về priority đã chuẩn hoá"""
+        priority = self.clamp_priority(priority)
+        weight = max(1, int(weight))
+        async with self._cond:
+            level = self._levels.setdefault(priority, _FairLevel())
+            level.append(fair_key, (time.monotonic(), item, weight))
+            self._size += 1
+            self._cond.notify()
+        return priority
+
+    async def get(self):
+        """
+        Chờ và lấy item kế tiếp (bỏ qua user đã chạm giới hạn đồng thời).
+
+        Returns:
+            Tuple: (item, priority, fair_key, wait_seconds)
+        """
+        async with self._cond:
+            while True:
+                picked = self._pop(time.monotonic())
+                if picked is not None:
+                    return picked
+                await self._cond.wait()
+
+    async def task_done(self, fair_key):
+        """Báo đã xử lý xong 1 item của fair_key, giải phóng slot của user đó"""
+        async with self._cond:
+            count = self._running.get(fair_key, 0) - 1
+            if count > 0:
+                self._running[fair_key] = count
+            else:
+                self._running.pop(fair_key, None)
+            self._cond.notify_all()
+
+    def running_count(self, fair_key):
+        return self._running.get(fair_key, 0)
+
+    def blocked_count(self):
+        """Số item đang chờ của các user đã chạm giới hạn đồng thời"""
+        return sum(
+            len(queue) for level in self._levels.values()
+            for key, queue in level.queues.items() if not self._is_eligible(key)
+        )
+
+    async def evict_blocked(self, keep):
+        """
+        Lấy ra các item mới nhất của user đã chạm giới hạn, chỉ giữ lại tối đa `keep` item bị chặn
+        (để prefetch còn chỗ nhận message của user khác thay vì worker ngồi chờ).
+
+        Returns:
+            List[(item, priority, fair_key)]
+        """
+        async with self._cond:
+            blocked = [
+                (entry[0], priority, key)
+                for priority, level in self._levels.items()
+                for key, queue in level.queues.items() if not self._is_eligible(key)
+                for entry in queue
+            ]
+            evicted = []
+            for _, priority, key in sorted(blocked, key=lambda b: b[0], reverse=True)[:max(0, len(blocked) - keep)]:
+                level = self._levels[priority]
+                _, item, _ = level.pop_newest(key)
+                if not level.queues:
+                    del self._levels[priority]
+                self._size -= 1
+                evicted.append((item, priority, key))
+            return evicted
+
+    def _is_eligible(self, fair_key):
+        return self.max_per_user <= 0 or self._running.get(fair_key, 0) < self.max_per_user
+
+    def _pop(self, now):
+        best_level = None
+        best_score = None
+        for priority, level in self._levels.items():
+            oldest = level.oldest_eligible(self._is_eligible)
+            if oldest is None:
+                continue
+            waited = now - oldest
+            score = priority + (waited / self.aging_seconds if self.aging_seconds > 0 else 0)
+            # Bằng điểm thì ưu tiên mức gốc cao hơn
+            if best_score is None or (score, priority) > (best_score, best_level):
+                best_level, best_score = priority, score
+        if best_level is None:
+            return None
+
+        level = self._levels[best_level]
+        fair_key, (enqueued_at, item, _) = level.pop(self._is_eligible)
+        if not level.queues:
+            del self._levels[best_level]
+        self._size -= 1
+        self._running[fair_key] = self._running.get(fair_key, 0) + 1
+        return item, best_level, fair_key, now - enqueued_at
+
+
+def parse_weights(spec):
+    """Parse "contest=4,teacher=2,student=1" -> {"contest": 4, ...}"""
+    weights = {}
+    for part in (spec or "").split(","):
+        if "=" not in part:
+            continue
+        name, value = part.split("=", 1)
+        try:
+            weights[name.strip()] = max(1, int(value))
+        except ValueError:
+            continue
+    return weights
+
+
+class LatencyStats:
+    """Thống kê latency (queue wait / tổng thời gian) theo từng mức priority"""
+
+    def __init__(self, sample_size=1000):
+        self.sample_size = sample_size
+        self._samples = {}  # (metric, priority) -> deque[seconds]
+        self._counts = {}
+
+    def observe(self, metric, priority, seconds):
+        key = (metric, priority)
+        self._samples.setdefault(key, deque(maxlen=self.sample_size)).append(seconds)
+        self._counts[key] = self._counts.get(key, 0) + 1
+
+    def summary(self):
+        """Trả về dict {metric: {priority: {count, p50, p95, max}}} (giây)"""
+        out = {}
+        for (metric, priority), samples in sorted(self._samples.items()):
+            ordered = sorted(samples)
+            out.setdefault(metric, {})[priority] = {
+                "count": self._counts[(metric, priority)],
+                "p50": _percentile(ordered, 0.50),
+                "p95": _percentile(ordered, 0.95),
+                "max": ordered[-1] if ordered else 0.0,
+            }
+        return out
+
+    def format_summary(self):
+        lines = []
+        for metric, levels in self.summary().items():
+            for priority, s in levels.items():
+                lines.append(
+                    f"    {metric} P{priority}: n={s['count']} "
+                    f"p50={s['p50'] * 1000:.0f}ms p95={s['p95'] * 1000:.0f}ms max={s['max'] * 1000:.0f}ms"
+                )
+        return "\n".join(lines)
+
+
+def _percentile(ordered, q):
+    if not ordered:
+        return 0.0
+    idx = min(len(ordered) - 1, int(round(q * (len(ordered) - 1))))
+    return ordered[idx]
@@ -1,19 +1,23 @@
 """
-Async Executor sử dụng Isolate sandbox cho code execution.
+Async Executor chạy code trong sandbox (isolate, hoặc local process qua SANDBOX_BACKEND).
 Cho phép chạy nhiều testcases song song để tăng performance.
 """
 
 import asyncio
-import subprocess
 import os
 import time
 import uuid
-import json
-import base64
+import hashlib
+import shutil
 import py_compile
 import tempfile
 import sys
-from concurrent.futures import ThreadPoolExecutor
+import fcntl
+from metrics import BOX_INIT_TIME, BOX_CLEANUP_TIME, COMPILE_TIME, TESTCASE_RUN_TIME, COMPARE_TIME
+from tracing import span, start_span
+from sandbox_backend import get_backend
+from resource_usage import ResourceUsage
+from node_speed import scale_limit, normalize_ms
 
 # Đọc default limits từ environment variables
 # DEFAULT_MEMORY_LIMIT: Memory limit in KB (default: 262144 KB = 256 MB)
@@ -21,6 +25,11 @@ from concurrent.futures import ThreadPoolExecutor
 DEFAULT_MEMORY_LIMIT = int(os.getenv("DEFAULT_MEMORY_LIMIT", "262144"))
 DEFAULT_TIME_LIMIT = int(os.getenv("DEFAULT_TIME_LIMIT", "3"))
 MAX_PARALLEL_TESTCASES = int(os.getenv("MAX_PARALLEL_TESTCASES", "4"))
+# Dải box id được dùng (supervisor chia dải riêng cho từng consumer process để không đụng box)
+ISOLATE_BOX_ID_START = int(os.getenv("ISOLATE_BOX_ID_START", "0"))
+ISOLATE_BOX_ID_COUNT = max(1, int(os.getenv("ISOLATE_BOX_ID_COUNT", "1000")))
+# File lock cho từng box id: mỗi submission chạy trong 1 sandbox_runner process riêng, không được chọn trùng box
+BOX_LOCK_DIR = os.getenv("BOX_LOCK_DIR", os.path.join(tempfile.gettempdir(), "judge-box-locks"))
 
 class TESTCASE_STATUS:
     Pending = "Pending"
@@ -33,44 +42,15 @@ class TESTCASE_STATUS:
     CompilationError = "CompilationError"
     Skipped = "Skipped"
 
-# Thread pool for running subprocess commands
-executor = ThreadPoolExecutor(max_workers=MAX_PARALLEL_TESTCASES * 2)
-
-LOW_PRIORITY_NICE = int(os.getenv("ISOLATE_NICE", "10"))
-ISOLATE_CPU_AFFINITY = os.getenv("ISOLATE_CPU_AFFINITY", "").strip()  # ví dụ: "1-7" hoặc "2,3,4"
-
-def _parse_affinity(s: str):
-    cpus = set()
-    for part in s.split(","):
-        part = part.strip()
-        if not part:
-            continue
-        if "-" in part:
-            a, b = part.split("-", 1)
-            cpus.update(range(int(a), int(b) + 1))
-        else:
-            cpus.add(int(part))
-    return sorted(cpus)
-
-def _set_low_priority():
-    try:
-        # Hạ ưu tiên CPU cho process con (giá trị nice lớn hơn = kém ưu tiên hơn)
-        os.nice(LOW_PRIORITY_NICE)
-    except Exception:
-        pass
-    if ISOLATE_CPU_AFFINITY:
-        try:
-            cpus = _parse_affinity(ISOLATE_CPU_AFFINITY)
-            if cpus:
-                os.sched_setaffinity(0, cpus)
-        except Exception:
-            pass
+# Sandbox (isolate hoặc local process), xem sandbox_backend.py
+sandbox = get_backend()
 
 def debug_log(msg):
     """Print debug message to stderr to avoid polluting stdout JSON output"""
     print(msg, file=sys.stderr, flush=True)
 
-async def execute_in_sandbox(language, code, testcases, timelimit=None, memorylimit=None, mem_keys=None):
+async def execute_in_sandbox(language, code, testcases, timelimit=None, memorylimit=None, on_result=None,
+                             speed_factor=1.0):
     """
     Execute code against multiple testcases using Isolate sandbox (ASYNC).
     Each testcase gets its own isolate box for parallel execution.
@@ -81,7 +61,9 @@ async def execute_in_sandbox(language, code, testcases, timelimit=None, memoryli
         testcases: List of testcase dicts theo format C#
         timelimit: Time limit in seconds
         memorylimit: Memory limit in KB (kilobytes)
-        mem_keys: Optional list of meta keys for memory measurement
+        on_result: Optional async callback(tc, result), gọi ngay khi mỗi testcase chạy xong
+        speed_factor: Hệ số tốc độ của node (node_speed.py): limit thật = timelimit × speed_factor,
+            time báo về được quy đổi về node tham chiếu
         
     Returns:
         List of results sorted by IndexNo
@@ -91,9 +73,6 @@ async def execute_in_sandbox(language, code, testcases, timelimit=None, memoryli
     if memorylimit is None:
         memorylimit = DEFAULT_MEMORY_LIMIT
 
-    if mem_keys is None:
-        mem_keys = ["cg-mem", "max-rss", "measured", "memory", "mem", "rss"]
-
     # Sort testcases by IndexNo
     sorted_testcases = sorted(testcases, key=lambda tc: tc.get("IndexNo", 0))
     
@@ -109,9 +88,17 @@ async def execute_in_sandbox(language, code, testcases, timelimit=None, memoryli
     
     debug_log(f"[DEBUG] Compilation successful, run command: {run_cmd}")
     
+    #  DEDUP INPUT: Testcase có input giống hệt nhau chỉ chạy 1 lần,
+    # output được so sánh lại với expected output riêng của từng testcase
+    unique_testcases = _unique_by_input(sorted_testcases)
+    # on_result báo cả testcase trùng input khi testcase đại diện chạy xong
+    duplicates = _duplicates_by_input(sorted_testcases, unique_testcases)
+    if len(unique_testcases) < len(sorted_testcases):
+        debug_log(f"[DEBUG] {len(sorted_testcases) - len(unique_testcases)} testcases share input with another testcase, running {len(unique_testcases)} distinct inputs")
+    
     #  BATCH EXECUTION: Trong batch chạy song song, giữa các batch chạy tuần tự
     # Early stopping: Nếu TẤT CẢ testcases trong batch đều TLE → dừng các batch sau
-    debug_log(f"[DEBUG] Running {len(sorted_testcases)} testcases in batches")
+    debug_log(f"[DEBUG] Running {len(unique_testcases)} testcases in batches")
     debug_log(f"[DEBUG] Batch size: {MAX_PARALLEL_TESTCASES} (parallel within batch, sequential between batches)")
     debug_log(f"[DEBUG] Early stopping: If ALL testcases in a batch are TLE → stop")
     
@@ -120,27 +107,31 @@ async def execute_in_sandbox(language, code, testcases, timelimit=None, memoryli
     
     try:
         # Chia testcases thành các batch
-        num_batches = (len(sorted_testcases) + MAX_PARALLEL_TESTCASES - 1) // MAX_PARALLEL_TESTCASES
+        num_batches = (len(unique_testcases) + MAX_PARALLEL_TESTCASES - 1) // MAX_PARALLEL_TESTCASES
         
         for batch_idx in range(num_batches):
             # Lấy batch hiện tại
             start_idx = batch_idx * MAX_PARALLEL_TESTCASES
-            end_idx = min(start_idx + MAX_PARALLEL_TESTCASES, len(sorted_testcases))
-            batch = sorted_testcases[start_idx:end_idx]
+            end_idx = min(start_idx + MAX_PARALLEL_TESTCASES, len(unique_testcases))
+            batch = unique_testcases[start_idx:end_idx]
             
             # Nếu đã early stop, skip batch này
             if stop_execution:
                 for tc in batch:
                     debug_log(f"[PAUSE] Skipping testcase (IndexNo={tc.get('IndexNo')}) - Early stopped")
-                    results.append({
+                    skipped = {
                         "testcaseId": tc.get("TestCaseId") or tc.get("testcaseId", "unknown"),
                         "indexNo": tc.get("IndexNo", tc.get("indexNo", 0)),
                         "status": TESTCASE_STATUS.TimeLimitExceeded,
                         "time": 0,
                         "memory": 0,
                         "output": "",
-                        "error": "Skipped due to early stopping (previous batch was all TLE)"
-                    })
+                        "error": "Skipped due to early stopping (previous batch was all TLE)",
+                        "earlyStopped": True
+                    }
+                    results.append(skipped)
+                    if on_result is not None:
+                        await _notify_result(tc, skipped, on_result, duplicates.get(id(tc), ()))
                 continue  # Skip batch này, chuyển sang batch tiếp theo
             
             # Chạy batch hiện tại
@@ -153,8 +144,10 @@ async def execute_in_sandbox(language, code, testcases, timelimit=None, memoryli
             for tc in batch:
                 task = _run_single_testcase_with_own_box(
                     tc, language, code, run_cmd,
-                    timelimit, memorylimit, mem_keys
+                    timelimit, memorylimit, speed_factor
                 )
+                if on_result is not None:
+                    task = _report_result(tc, task, on_result, duplicates.get(id(tc), ()))
                 batch_tasks.append(task)
             
             batch_results = await asyncio.gather(*batch_tasks)
@@ -173,7 +166,7 @@ async def execute_in_sandbox(language, code, testcases, timelimit=None, memoryli
                 debug_log(f"[STOP] EARLY STOPPING: ALL {total_in_batch} testcases in batch {batch_idx + 1} are TLE!")
                 remaining_batches = num_batches - batch_idx - 1
                 if remaining_batches > 0:
-                    remaining_testcases = len(sorted_testcases) - end_idx
+                    remaining_testcases = len(unique_testcases) - end_idx
                     debug_log(f"[STOP] Stopping {remaining_batches} remaining batches ({remaining_testcases} testcases)")
                     stop_execution = True
             else:
@@ -182,7 +175,7 @@ async def execute_in_sandbox(language, code, testcases, timelimit=None, memoryli
                 other = total_in_batch - tle_count - passed
                 debug_log(f"[RESULT] Batch {batch_idx + 1} has non-TLE results: {passed} Passed, {other} Other → Continue")
         
-        return results
+        return _expand_shared_results(sorted_testcases, unique_testcases, results)
         
     except Exception as e:
         debug_log(f"[ERROR] Critical error in execute_in_sandbox: {e}")
@@ -191,30 +184,84 @@ async def execute_in_sandbox(language, code, testcases, timelimit=None, memoryli
         return _error_result(testcases, TESTCASE_STATUS.InternalError, f"Critical error: {e}")
 
 
+async def _report_result(tc, task, on_result, duplicates=()):
+    """Chờ testcase chạy xong rồi báo kết quả qua on_result"""
+    result = await task
+    await _notify_result(tc, result, on_result, duplicates)
+    return result
+
+
+async def _notify_result(tc, result, on_result, duplicates=()):
+    """Báo kết quả của tc và của các testcase trùng input với nó (lỗi callback không làm hỏng kết quả)"""
+    for target, target_result in [(tc, result)] + [(dup, _shared_result(result, dup)) for dup in duplicates]:
+        try:
+            await on_result(target, target_result)
+        except Exception as e:
+            debug_log(f"[WARNING] on_result callback failed for testcase #{target_result.get('indexNo')}: {e}")
+
+
+_box_locks = {}  # box_id -> fd đang giữ flock
+
+
+def _new_box_id():
+    """Box id chưa bị process nào giữ (flock, kernel tự nhả khi process chết); nhả bằng _release_box_id"""
+    os.makedirs(BOX_LOCK_DIR, exist_ok=True)
+    for _ in range(ISOLATE_BOX_ID_COUNT * 2):
+        box_id = ISOLATE_BOX_ID_START + int(uuid.uuid4().hex[:6], 16) % ISOLATE_BOX_ID_COUNT
+        if box_id in _box_locks:
+            continue
+        fd = os.open(os.path.join(BOX_LOCK_DIR, f"{box_id}.lock"), os.O_RDWR | os.O_CREAT, 0o666)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            os.close(fd)
+            continue
+        _box_locks[box_id] = fd
+        return box_id
+    raise RuntimeError(f"No free sandbox box id in {ISOLATE_BOX_ID_START}+{ISOLATE_BOX_ID_COUNT}")
+
+
+def _release_box_id(box_id):
+    fd = _box_locks.pop(box_id, None)
+    if fd is not None:
+        os.close(fd)
+
+
+async def _compile_cpp(box_id):
+    """g++ trong box, stdout/stderr của compiler ghi vào compile_out.txt/compile_err.txt"""
+    return await sandbox.run(
+        box_id,
+        ["/usr/bin/g++", "-std=c++17", "-O2", "-Wall", "-Wextra", "-o", "main", "main.cpp"],
+        stdout="compile_out.txt", stderr="compile_err.txt",
+        time_limit=10, wall_time=15, memory_kb=512000, full_env=True,
+        timeout=20, capture_output=True
+    )
+
+
 async def _compile_code_once(language, code, timelimit, memorylimit):
     """
     Compile/check code CHỈ 1 LẦN cho tất cả testcases.
     Trả về run_cmd hoặc raise ValueError nếu lỗi.
     """
     # Tạo temporary box để compile
-    temp_box_id = int(uuid.uuid4().hex[:3], 16) % 1000
-    temp_box_path = f"/var/local/lib/isolate/{temp_box_id}/box"
+    temp_box_id = _new_box_id()
+    temp_box_path = sandbox.box_path(temp_box_id)
+    compile_span = start_span("compile", language=language, box_id=temp_box_id)
     
     try:
         # Init temporary box
-        await _run_command(["isolate", "--box-id", str(temp_box_id), "--cleanup"], timeout=5)
-        await _run_command(["isolate", "--box-id", str(temp_box_id), "--init"], timeout=5)
+        with BOX_INIT_TIME.time(), span("box.init", box_id=temp_box_id):
+            await sandbox.init(temp_box_id)
         
         if language == "python":
-            code_file = f"{temp_box_path}/main.py"
-            
             # Write code to file
             loop = asyncio.get_event_loop()
-            await loop.run_in_executor(None, _write_file, code_file, code)
+            code_file = await loop.run_in_executor(None, sandbox.stage_file, temp_box_id, "main.py", code)
             
             # Check syntax CHỈ 1 LẦN
             try:
-                await loop.run_in_executor(None, _check_python_syntax, code_file, temp_box_path)
+                with COMPILE_TIME.time(language=language), span("compile.syntax_check"):
+                    await loop.run_in_executor(None, _check_python_syntax, code_file, temp_box_path)
                 debug_log(f"[✓] Python syntax check passed")
             except Exception as e:
                 error_msg = str(e)
@@ -224,27 +271,17 @@ async def _compile_code_once(language, code, timelimit, memorylimit):
             return run_cmd
 
         elif language == "cpp":
-            code_file = f"{temp_box_path}/main.cpp"
             compile_stdout_file = f"{temp_box_path}/compile_out.txt"
             compile_stderr_file = f"{temp_box_path}/compile_err.txt"
             
             # Write code to file
             loop = asyncio.get_event_loop()
-            await loop.run_in_executor(None, _write_file, code_file, code)
+            await loop.run_in_executor(None, sandbox.stage_file, temp_box_id, "main.cpp", code)
             
             # Compile CHỈ 1 LẦN - Capture BOTH stdout và stderr
             debug_log(f"[DEBUG] Compiling C++ code...")
-            compile_cmd = [
-                "isolate", "--box-id", str(temp_box_id),
-                "--time=10", "--wall-time=15", "--mem=512000", "--processes", "--full-env",
-                "--stdout=compile_out.txt",  #  Capture stdout
-                "--stderr=compile_err.txt",  #  Capture stderr
-                "--run", "--",
-                "/usr/bin/g++", "-std=c++17", "-O2", "-Wall", "-Wextra",  #  Thêm -Wall -Wextra để có nhiều warning
-                "-o", "main", "main.cpp"
-            ]
-            
-            compile_result = await _run_command(compile_cmd, timeout=20, capture_output=True)
+            with COMPILE_TIME.time(language=language), span("compile.gcc"):
+                compile_result = await _compile_cpp(temp_box_id)
             
             if compile_result.returncode != 0:
                 #  ĐỌC ĐẦY ĐỦ cả stdout và stderr từ file
@@ -287,12 +324,16 @@ async def _compile_code_once(language, code, timelimit, memorylimit):
     finally:
         # Cleanup temporary box
         try:
-            await _run_command(["isolate", "--box-id", str(temp_box_id), "--cleanup"], timeout=5)
+            with BOX_CLEANUP_TIME.time(), span("box.cleanup", box_id=temp_box_id):
+                await sandbox.cleanup(temp_box_id)
         except Exception as cleanup_err:
             debug_log(f"[WARNING] Failed to cleanup temp box {temp_box_id}: {cleanup_err}")
+        _release_box_id(temp_box_id)
+        # Lỗi compile (ValueError) được ghi vào status của span
+        compile_span.end(error=sys.exc_info()[1])
 
 
-async def _run_single_testcase_with_own_box(tc, language, code, run_cmd, timelimit, memorylimit, mem_keys):
+async def _run_single_testcase_with_own_box(tc, language, code, run_cmd, timelimit, memorylimit, speed_factor=1.0):
     """
     Chạy một testcase với isolate box riêng biệt.
     Mỗi testcase có box độc lập để tránh xung đột khi chạy song song.
@@ -300,12 +341,9 @@ async def _run_single_testcase_with_own_box(tc, language, code, run_cmd, timelim
     # Extract testcase info
     tc_id = tc.get("TestCaseId") or tc.get("testcaseId", "unknown")
     index_no = tc.get("IndexNo", tc.get("indexNo", 0))
-    input_ref = str(tc.get("InputRef") or tc.get("inputRef", "")).strip()
-    output_ref = str(tc.get("OutputRef") or tc.get("outputRef", "")).strip()
-
     # Tạo box ID duy nhất cho testcase này
-    box_id = int(uuid.uuid4().hex[:3], 16) % 1000
-    box_path = f"/var/local/lib/isolate/{box_id}/box"
+    box_id = _new_box_id()
+    box_path = sandbox.box_path(box_id)
     
     # File paths
     input_file = f"{box_path}/input.txt"
@@ -324,37 +362,28 @@ async def _run_single_testcase_with_own_box(tc, language, code, run_cmd, timelim
         "output": "",
         "error": ""
     }
+    testcase_span = start_span("testcase", index=index_no, testcase_id=tc_id, box_id=box_id)
 
     try:
         # Cleanup & init box
-        await _run_command(["isolate", "--box-id", str(box_id), "--cleanup"], timeout=5)
-        await _run_command(["isolate", "--box-id", str(box_id), "--init"], timeout=5)
+        with BOX_INIT_TIME.time(), span("box.init", box_id=box_id):
+            await sandbox.init(box_id)
         
         # CHỈ COPY CODE, KHÔNG COMPILE LẠI (đã compile ở _compile_code_once)
         loop = asyncio.get_event_loop()
         
         if language == "python":
-            code_file = f"{box_path}/main.py"
-            await loop.run_in_executor(None, _write_file, code_file, code)
+            await loop.run_in_executor(None, sandbox.stage_file, box_id, "main.py", code)
         elif language == "cpp":
             # C++ đã compile kiểm tra syntax rồi, nhưng mỗi box cần binary riêng
             # (Isolate không share files giữa các boxes)
-            code_file = f"{box_path}/main.cpp"
             compile_stdout_file = f"{box_path}/compile_out.txt"  #  Thêm stdout file
             compile_stderr_file = f"{box_path}/compile_err.txt"
-            await loop.run_in_executor(None, _write_file, code_file, code)
+            await loop.run_in_executor(None, sandbox.stage_file, box_id, "main.cpp", code)
             
             # Re-compile trong box này
-            compile_cmd = [
-                "isolate", "--box-id", str(box_id),
-                "--time=10", "--wall-time=15", "--mem=512000", "--processes", "--full-env",
-                "--stdout=compile_out.txt",  #  Capture stdout
-                "--stderr=compile_err.txt",  #  Capture stderr
-                "--run", "--",
-                "/usr/bin/g++", "-std=c++17", "-O2", "-Wall", "-Wextra",
-                "-o", "main", "main.cpp"
-            ]
-            compile_result = await _run_command(compile_cmd, timeout=20, capture_output=True)
+            with COMPILE_TIME.time(language=language), span("compile.gcc"):
+                compile_result = await _compile_cpp(box_id)
             
             if compile_result.returncode != 0:
                 #  ĐỌC ĐẦY ĐỦ compile error
@@ -376,34 +405,42 @@ async def _run_single_testcase_with_own_box(tc, language, code, run_cmd, timelim
                 return result
 
         # Write input file
-        await loop.run_in_executor(None, _write_file, input_file, input_ref)
-
-        # Run isolate
-        isolate_cmd = [
-            "isolate", "--box-id", str(box_id),
-            f"--stdin=input.txt", 
-            f"--stdout=output.txt", 
-            f"--stderr=error.txt",
-            f"--time={timelimit}", f"--wall-time={timelimit + 2}",
-            f"--mem={memorylimit}", "--processes",  # memorylimit đã là KB, dùng trực tiếp
-            "--meta", meta_file,
-            "--run", "--"
-        ] + run_cmd
+        with span("write_input"):
+            await loop.run_in_executor(None, _write_input, tc, input_file)
 
+        # Run trong sandbox (limit theo tốc độ của node)
+        node_timelimit = scale_limit(timelimit, speed_factor)
         start_time = time.time()
-        exec_result = await _run_command(isolate_cmd, timeout=timelimit + 5, capture_output=True)
+        with span("run"):
+            exec_result = await sandbox.run(
+                box_id, run_cmd,
+                stdin="input.txt", stdout="output.txt", stderr="error.txt",
+                time_limit=node_timelimit, wall_time=node_timelimit + 2,
+                memory_kb=memorylimit,  # memorylimit đã là KB, dùng trực tiếp
+                meta_file=meta_file,
+                timeout=node_timelimit + 5, capture_output=True
+            )
         exec_time_ms = int((time.time() - start_time) * 1000)
+        TESTCASE_RUN_TIME.observe(exec_time_ms / 1000, language=language)
 
         # Read meta and error
-        meta = await loop.run_in_executor(None, _read_meta, meta_file)
+        meta = await loop.run_in_executor(None, sandbox.read_meta, meta_file)
         err = await loop.run_in_executor(None, _read_file, error_file)
         
-        # Get time and memory
-        result["time"] = int(float(meta.get("time", exec_time_ms / 1000)) * 1000)
-        result["memory"] = _get_memory_kb_from_meta(meta, mem_keys) or int(meta.get("cg-mem", "0") or meta.get("max-rss", "0") or 0)
+        # Time và tài nguyên (CPU user/sys, wall, peak memory, context switch, IO) từ meta.
+        # time quy đổi về node tham chiếu, usage giữ số đo thật của node
+        usage = ResourceUsage.from_meta(meta)
+        result["time"] = normalize_ms(usage.cpu_ms if "time" in meta else exec_time_ms, speed_factor)
+        result["memory"] = usage.peak_memory_kb
+        result["usage"] = usage.to_dict()
 
         # Check isolate status
         status = meta.get("status", "")
+        if meta.get("cg-oom-killed") == "1":
+            # isolate --cg: cgroup bị OOM kill → chắc chắn vượt memory limit
+            result["status"] = TESTCASE_STATUS.MemoryLimitExceeded
+            result["error"] = f"Memory limit exceeded ({memorylimit} KB)"
+            return result
         if status == "TO":
             result["status"] = TESTCASE_STATUS.TimeLimitExceeded
             result["error"] = f"Time limit exceeded ({timelimit}s)"
@@ -431,18 +468,11 @@ async def _run_single_testcase_with_own_box(tc, language, code, run_cmd, timelim
             return result
 
         # Read output and compare
-        actual_output = await loop.run_in_executor(None, _read_file, output_file)
-        actual_output = actual_output.strip()
-        result["output"] = actual_output
-        
-        expected = output_ref.strip()
-        if actual_output == expected:
-            result["status"] = TESTCASE_STATUS.Passed
-            debug_log(f"[RESULT] Testcase #{index_no} ({tc_id}) passed (box {box_id})")
-        else:
-            result["status"] = TESTCASE_STATUS.WrongAnswer
-            result["error"] = f"Expected: {expected[:100]}... | Got: {actual_output[:100]}..."
-            debug_log(f"[RESULT] Testcase #{index_no} ({tc_id}) wrong answer (box {box_id})")
+        with span("compare"):
+            actual_output = await loop.run_in_executor(None, _read_file, output_file)
+            expected_output = await loop.run_in_executor(None, _expected_output, tc)
+            _compare_output(result, actual_output.strip(), expected_output)
+        debug_log(f"[RESULT] Testcase #{index_no} ({tc_id}) {result['status']} (box {box_id})")
         return result
 
     except asyncio.TimeoutError:
@@ -460,40 +490,23 @@ async def _run_single_testcase_with_own_box(tc, language, code, run_cmd, timelim
     finally:
         # Cleanup box
         try:
-            await _run_command(["isolate", "--box-id", str(box_id), "--cleanup"], timeout=5)
+            with BOX_CLEANUP_TIME.time(), span("box.cleanup", box_id=box_id):
+                await sandbox.cleanup(box_id)
         except Exception as cleanup_err:
             debug_log(f"[WARNING] Failed to cleanup box {box_id}: {cleanup_err}")
+        _release_box_id(box_id)
+        usage = result.get("usage") or {}
+        testcase_span.set(status=result["status"], time_ms=result["time"], memory_kb=result["memory"],
+                          cpu_user_ms=usage.get("cpuUserMs"), cpu_sys_ms=usage.get("cpuSysMs"),
+                          wall_ms=usage.get("wallMs"), csw_forced=usage.get("cswForced"),
+                          io_read_bytes=usage.get("ioReadBytes"), io_write_bytes=usage.get("ioWriteBytes"))
+        testcase_span.end()
 
 
 # ============================================================================
 # HELPER FUNCTIONS
 # ============================================================================
 
-async def _run_command(cmd, timeout=None, capture_output=False):
-    """
-    Chạy subprocess command trong async context.
-    """
-    loop = asyncio.get_event_loop()
-    
-    def _run():
-        if capture_output:
-            return subprocess.run(
-                cmd,
-                capture_output=True,
-                timeout=timeout,
-                preexec_fn=_set_low_priority
-            )
-        else:
-            return subprocess.run(
-                cmd,
-                timeout=timeout,
-                stdout=subprocess.DEVNULL,
-                stderr=subprocess.DEVNULL,
-                preexec_fn=_set_low_priority
-            )
-    
-    return await loop.run_in_executor(executor, _run)
-
 def _write_file(filepath, content):
     """Write content to file (sync)"""
     with open(filepath, "w", encoding="utf-8") as f:
@@ -527,65 +540,95 @@ def _check_python_syntax(code_file, box_path):
         shutil.rmtree(pycache_dir)
 
 
-def _read_meta(meta_path):
-    """Read isolate meta file (sync)"""
-    meta = {}
-    if os.path.exists(meta_path):
-        with open(meta_path, "r") as f:
-            for line in f:
-                if ':' in line:
-                    k, v = line.strip().split(':', 1)
-                    meta[k] = v
-    return meta
-
-
-def _parse_memory_to_kb(val):
-    """Parse memory value to KB"""
-    if val is None:
-        return 0
-    s = str(val).strip()
-    if s == "":
-        return 0
-    s = s.strip('"').strip("'")
-    try:
-        low = s.lower()
-        if low.endswith("kb"):
-            return int(float(low[:-2]) * 1)
-        if low.endswith("k"):
-            return int(float(low[:-1]) * 1)
-        if low.endswith("mb"):
-            return int(float(low[:-2]) * 1024)
-        if low.endswith("m"):
-            return int(float(low[:-1]) * 1024)
-        if low.endswith("b"):
-            return int(float(low[:-1]) / 1024)
-        v = float(low)
-        if v > 1024 * 1024:
-            return int(v // 1024)
-        if v > 1024 * 10:
-            return int(v // 1024)
-        return int(v)
-    except Exception:
-        return 0
-
-
-def _get_memory_kb_from_meta(meta, keys_order=None):
-    """Extract memory from meta dict"""
-    if not meta:
-        return 0
-    if keys_order is None:
-        keys_order = ["cg-mem", "max-rss", "measured", "memory", "mem", "rss"]
-
-    for k in keys_order:
-        if k in meta and meta[k] is not None and meta[k] != "":
-            kb = _parse_memory_to_kb(meta[k])
-            if kb > 0:
-                return kb
-    for v in meta.values():
-        kb = _parse_memory_to_kb(v)
-        if kb > 0:
-            return kb
-    return 0
+def _compare_output(result, actual_output, output_ref):
+    """So sánh output thực tế với expected output, cập nhật status/error của result"""
+    start = time.monotonic()
+    result["output"] = actual_output
+    expected = output_ref.strip()
+    if actual_output == expected:
+        result["status"] = TESTCASE_STATUS.Passed
+        result["error"] = ""
+    else:
+        result["status"] = TESTCASE_STATUS.WrongAnswer
+        result["error"] = f"Expected: {expected[:100]}... | Got: {actual_output[:100]}..."
+    COMPARE_TIME.observe(time.monotonic() - start)
+    return result
+
+
+def _write_input(tc, input_file):
+    """Ghi input của testcase vào box (testcase đã spool thì copy file)"""
+    if tc.get("InputFile"):
+        shutil.copyfile(tc["InputFile"], input_file)
+    else:
+        _write_file(input_file, str(tc.get("InputRef") or tc.get("inputRef", "")).strip())
+
+
+def _expected_output(tc):
+    if tc.get("OutputFile"):
+        return _read_file(tc["OutputFile"])
+    return str(tc.get("OutputRef") or tc.get("outputRef", "")).strip()
+
+
+def _input_key(tc):
+    """Hash của input (đúng nội dung được ghi vào input.txt)"""
+    if tc.get("InputHash"):
+        return tc["InputHash"]
+    input_ref = str(tc.get("InputRef") or tc.get("inputRef", "")).strip()
+    return hashlib.sha256(input_ref.encode("utf-8")).hexdigest()
+
+
+def _unique_by_input(sorted_testcases):
+    """Giữ testcase đầu tiên (theo IndexNo) của mỗi input khác nhau"""
+    seen = set()
+    unique = []
+    for tc in sorted_testcases:
+        key = _input_key(tc)
+        if key not in seen:
+            seen.add(key)
+            unique.append(tc)
+    return unique
+
+
+def _duplicates_by_input(sorted_testcases, unique_testcases):
+    """id(testcase đại diện) -> các testcase khác có cùng input"""
+    representative = {_input_key(tc): tc for tc in unique_testcases}
+    duplicates = {}
+    for tc in sorted_testcases:
+        source_tc = representative[_input_key(tc)]
+        if tc is not source_tc:
+            duplicates.setdefault(id(source_tc), []).append(tc)
+    return duplicates
+
+
+def _shared_result(source_result, tc):
+    """Kết quả của tc từ kết quả của testcase cùng input (so sánh với expected output của tc)"""
+    shared = dict(source_result)
+    shared["testcaseId"] = tc.get("TestCaseId") or tc.get("testcaseId", "unknown")
+    shared["indexNo"] = tc.get("IndexNo", tc.get("indexNo", 0))
+    # Chỉ kết quả đã chạy xong bình thường mới cần so sánh lại; TLE/RE/... dùng chung
+    if source_result.get("status") in (TESTCASE_STATUS.Passed, TESTCASE_STATUS.WrongAnswer):
+        _compare_output(shared, source_result.get("output", ""), _expected_output(tc))
+    return shared
+
+
+def _expand_shared_results(sorted_testcases, unique_testcases, unique_results):
+    """
+    Tạo kết quả cho mọi testcase từ kết quả của các input đã chạy.
+    Testcase trùng input dùng lại time/memory/output, nhưng status được so sánh
+    với expected output của chính nó và báo cáo dưới testcaseId/indexNo riêng.
+    """
+    if len(unique_testcases) == len(sorted_testcases):
+        return unique_results
+
+    by_input = {
+        _input_key(tc): (tc, res)
+        for tc, res in zip(unique_testcases, unique_results)
+    }
+    results = []
+    for tc in sorted_testcases:
+        source_tc, source_result = by_input[_input_key(tc)]
+        results.append(source_result if tc is source_tc else _shared_result(source_result, tc))
+    return results
 
 
 def _error_result(testcases, error_code, error_msg):
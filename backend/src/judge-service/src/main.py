@@ -1,13 +1,27 @@
 """
 Main entry point của hệ thống
 Khởi chạy AsyncAdaptiveConsumer để xử lý submissions từ RabbitMQ
+(CONSUMER_PROCESSES > 1: chạy supervisor quản lý nhiều consumer process)
 """
 import asyncio
+import signal
 from adaptive_consumer import AsyncAdaptiveConsumer
+from supervisor import ConsumerSupervisor, CONSUMER_PROCESSES
+from profiler import profiler
 
 async def main():
     """Hàm main async"""
+    if CONSUMER_PROCESSES > 1:
+        await ConsumerSupervisor().run()
+        return
+
     consumer = AsyncAdaptiveConsumer()
+    loop = asyncio.get_running_loop()
+    # SIGTERM (docker stop / supervisor) và CTRL+C: ngừng nhận message, chấm nốt rồi thoát
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(sig, consumer.request_stop)
+    # SIGUSR1: profile consumer (và sandbox runner mới) trong PROFILE_SECONDS giây
+    loop.add_signal_handler(signal.SIGUSR1, profiler.start)
     await consumer.start()
 
 if __name__ == "__main__":
@@ -0,0 +1,220 @@
+"""
+Message Codec - Serialize và nén body của message
+- content_type chọn codec: application/json (orjson nếu có) hoặc application/msgpack.
+  Reply dùng cùng codec với submission; không có content_type = JSON như cũ.
+- content_encoding chọn nén: gzip | zstd. Kết quả trả về chỉ được nén khi bên gửi chấp nhận
+  (header x-accept-encoding, hoặc chính submission đã được nén).
+Codec cũng được dùng cho payload/kết quả giữa MessageHandler và sandbox_runner (RUNNER_CODEC).
+"""
+import gzip
+import json
+import os
+import zlib
+
+try:
+    import zstandard
+except ImportError:  # zstd là tuỳ chọn, thiếu thư viện thì chỉ dùng gzip
+    zstandard = None
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+# Thứ tự ưu tiên khi chọn encoding cho message gửi đi (rỗng = không bao giờ nén kết quả)
+MESSAGE_COMPRESSION = [
+    e.strip().lower() for e in os.getenv("MESSAGE_COMPRESSION", "zstd,gzip").split(",") if e.strip()
+]
+# Body nhỏ hơn N byte gửi nguyên bản (nén không đáng)
+COMPRESS_MIN_BYTES = int(os.getenv("COMPRESS_MIN_BYTES", "4096"))
+COMPRESS_LEVEL = int(os.getenv("COMPRESS_LEVEL", "3"))
+# Kích thước tối đa của body sau khi giải nén (chặn decompression bomb), 0 = không giới hạn
+MAX_MESSAGE_BODY_BYTES = int(os.getenv("MAX_MESSAGE_BODY_BYTES", str(256 * 1024 * 1024)))
+
+IDENTITY = ("", "identity")
+
+
+class JsonCodec:
+    name = "json"
+    content_type = "application/json"
+
+    @staticmethod
+    def dumps(obj):
+        if orjson is not None:
+            return orjson.dumps(obj)
+        return json.dumps(obj).encode("utf-8")
+
+    @staticmethod
+    def loads(data):
+        # orjson.JSONDecodeError kế thừa json.JSONDecodeError (ValueError)
+        if orjson is not None:
+            return orjson.loads(data)
+        return json.loads(data)
+
+
+class MsgpackCodec:
+    name = "msgpack"
+    content_type = "application/msgpack"
+
+    @staticmethod
+    def dumps(obj):
+        return msgpack.packb(obj, use_bin_type=True)
+
+    @staticmethod
+    def loads(data):
+        return msgpack.unpackb(data, raw=False)
+
+
+CODECS = {"json": JsonCodec, "msgpack": MsgpackCodec}
+CONTENT_TYPES = {
+    "application/json": JsonCodec,
+    "text/json": JsonCodec,
+    "application/msgpack": MsgpackCodec,
+    "application/x-msgpack": MsgpackCodec,
+}
+
+
+def _available(codec):
+    return codec is not MsgpackCodec or msgpack is not None
+
+
+def get_codec(content_type):
+    """Codec theo AMQP content_type (rỗng = JSON), raise ValueError nếu không hỗ trợ"""
+    if not content_type:
+        return JsonCodec
+    codec = CONTENT_TYPES.get(content_type.split(";")[0].strip().lower())
+    if codec is None or not _available(codec):
+        raise ValueError(f"Unsupported content_type: {content_type}")
+    return codec
+
+
+def codec_by_name(name):
+    """Codec theo tên (json | msgpack); không có thư viện thì về JSON"""
+    codec = CODECS.get((name or "").strip().lower(), JsonCodec)
+    return codec if _available(codec) else JsonCodec
+
+
+# Codec cho IPC giữa MessageHandler và sandbox_runner (payload qua stdin, kết quả qua stdout)
+RUNNER_CODEC = codec_by_name(os.getenv("RUNNER_CODEC", "msgpack"))
+
+
+def supported_encodings():
+    encodings = ["gzip"]
+    if zstandard is not None:
+        encodings.append("zstd")
+    return encodings
+
+
+class MessageTooLarge(ValueError):
+    """Body (sau khi giải nén) vượt MAX_MESSAGE_BODY_BYTES"""
+
+
+def _too_large(limit):
+    return MessageTooLarge(f"Message body exceeds MAX_MESSAGE_BODY_BYTES ({limit} bytes)")
+
+
+def _gunzip(body, limit):
+    """gzip.decompress nhưng dừng ngay khi output vượt limit (0 = không giới hạn)"""
+    out = bytearray()
+    data = body
+    while data:  # gzip có thể gồm nhiều member nối nhau
+        decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        try:
+            out += decompressor.decompress(data, limit + 1 - len(out) if limit else 0)
+        except zlib.error as e:
+            raise ValueError(f"Invalid gzip body: {e}") from e
+        if limit and len(out) > limit:
+            raise _too_large(limit)
+        if not decompressor.eof:
+            raise ValueError("Invalid gzip body: truncated stream")
+        data = decompressor.unused_data
+    return bytes(out)
+
+
+def _unzstd(body, limit):
+    """Giải nén zstd (frame có thể không ghi content size) với output tối đa limit byte"""
+    reader = zstandard.ZstdDecompressor().stream_reader(body)
+    try:
+        if not limit:
+            return reader.readall()
+        out = bytearray()
+        while len(out) <= limit:
+            chunk = reader.read(min(limit + 1 - len(out), 1024 * 1024))
+            if not chunk:
+                return bytes(out)
+            out += chunk
+    except zstandard.ZstdError as e:
+        raise ValueError(f"Invalid zstd body: {e}") from e
+    finally:
+        reader.close()
+    raise _too_large(limit)
+
+
+def decompress_body(body, content_encoding, max_size=None):
+    """
+    Giải nén body theo content_encoding.
+
+    Raise MessageTooLarge nếu body sau giải nén lớn hơn max_size (mặc định MAX_MESSAGE_BODY_BYTES),
+    ValueError nếu encoding không hỗ trợ hoặc dữ liệu nén hỏng.
+    """
+    limit = MAX_MESSAGE_BODY_BYTES if max_size is None else max_size
+    encoding = (content_encoding or "").strip().lower()
+    if encoding in IDENTITY:
+        if limit and len(body) > limit:
+            raise _too_large(limit)
+        return body
+    if encoding == "gzip":
+        return _gunzip(body, limit)
+    if encoding == "zstd" and zstandard is not None:
+        return _unzstd(body, limit)
+    raise ValueError(f"Unsupported content_encoding: {content_encoding}")
+
+
+def compress_body(body, content_encoding):
+    encoding = (content_encoding or "").strip().lower()
+    if encoding in IDENTITY:
+        return body
+    if encoding == "gzip":
+        return gzip.compress(body, compresslevel=min(max(COMPRESS_LEVEL, 1), 9))
+    if encoding == "zstd" and zstandard is not None:
+        return zstandard.ZstdCompressor(level=COMPRESS_LEVEL).compress(body)
+    raise ValueError(f"Unsupported content_encoding: {content_encoding}")
+
+
+def negotiate_encoding(headers, content_encoding):
+    """
+    Chọn encoding cho reply của 1 submission.
+
+    Args:
+        headers: Header của submission (x-accept-encoding: "zstd, gzip")
+        content_encoding: content_encoding của submission (dùng khi không có x-accept-encoding)
+
+    Returns:
+        Tên encoding hoặc None (gửi JSON thường)
+    """
+    accepted = (headers or {}).get("x-accept-encoding")
+    if isinstance(accepted, bytes):
+        accepted = accepted.decode("utf-8", errors="ignore")
+    if accepted:
+        accepted = {e.strip().lower() for e in str(accepted).split(",")}
+    elif content_encoding and content_encoding.lower() not in IDENTITY:
+        accepted = {content_encoding.lower()}
+    else:
+        return None
+    available = supported_encodings()
+    for encoding in MESSAGE_COMPRESSION:
+        if encoding in accepted and encoding in available:
+            return encoding
+    return None
+
+
+def encode_reply(body, encoding):
+    """Nén body nếu có encoding và đủ lớn. Trả về (body, content_encoding hoặc None)"""
+    if not encoding or len(body) < COMPRESS_MIN_BYTES:
+        return body, None
+    return compress_body(body, encoding), encoding
@@ -2,19 +2,40 @@
 Async Message Handler Module (safe version)
 Xử lý message từ RabbitMQ và chạy sandbox qua process riêng (sync)
 """
-import json
 import os
 import asyncio
 import subprocess
 import logging
+import time
+from collections import OrderedDict
+from verdict_cache import VerdictCache, submission_cache_key
+from testcase_store import TestcaseResultStore, source_hash, result_key
+from result_journal import ResultJournal
+from progress_reporter import ProgressReporter, read_progress_pipe
+from message_codec import decompress_body, get_codec, RUNNER_CODEC, MessageTooLarge
+from submission_spool import should_spool, new_spool_dir, parse_spooled, remove_spool
+from metrics import REGISTRY, PARSE_TIME, VERDICTS, SUBMISSIONS, CACHE_LOOKUPS
+import tracing
+from profiler import profiler
+from node_speed import node_speed, scale_limit
+from resource_usage import aggregate as aggregate_usage
 
 MAX_RETRY_COUNT = int(os.getenv("MAX_RETRY_COUNT", "3"))
+# Thời gian chờ sandbox runner tự dọn box sau SIGTERM trước khi SIGKILL
+CANCEL_GRACE_SECONDS = float(os.getenv("CANCEL_GRACE_SECONDS", "10"))
+# Giữ lệnh cancel bao lâu (cho submission chưa tới lượt chạy)
+CANCEL_TTL_SECONDS = int(os.getenv("CANCEL_TTL_SECONDS", "3600"))
+# Lệnh cancel không có AttemptId chỉ áp dụng cho message publish trước nó ít nhất N giây (lệch đồng hồ)
+CANCEL_CLOCK_SKEW_SECONDS = float(os.getenv("CANCEL_CLOCK_SKEW_SECONDS", "5"))
 
 class SubmissionStatus:
     PENDING = "Pending"
     RUNNING = "Running"
     PASSED = "Passed"
     FAILED = "Failed"
+    CANCELLED = "Cancelled"
+    # Nội bộ: runner bị dừng vì consumer shutdown → NACK(requeue), không gửi kết quả
+    INTERRUPTED = "Interrupted"
 
 TESTCASE_STATUS_CODE = {
     "Passed": "0",
@@ -38,16 +59,154 @@ STATUS_MESSAGE = {
     "InternalError": "Internal error during testcase execution",
     "WrongAnswer": "Testcase produced wrong answer",
     "CompilationError": "Code compilation error",
-    "Skipped": "Testcase was skipped"
+    "Skipped": "Testcase was skipped",
+    "Cancelled": "Submission was cancelled"
 }
 
 # Thêm logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
+class CancellationRegistry:
+    """
+    Lưu các SubmissionId bị huỷ và sandbox runner đang chạy của từng submission.
+    - Submission chưa chạy: bị bỏ qua khi tới lượt (trả response Cancelled).
+    - Submission đang chạy: runner nhận SIGTERM, kill isolate và cleanup box.
+    Lệnh huỷ chỉ áp dụng 1 lần (pop_reason) và chỉ cho đúng lần chấm (attempt) của nó:
+    - Cancel có AttemptId: chỉ áp dụng cho message có cùng AttemptId (field body hoặc header x-attempt-id).
+    - Cancel không có AttemptId: chỉ áp dụng cho message có AMQP timestamp, publish trước lệnh huỷ
+      ít nhất 1 giây (độ phân giải timestamp) + CANCEL_CLOCK_SKEW_SECONDS. Message không có timestamp
+      thì không bị huỷ (có thể là bản rejudge/nộp lại cùng SubmissionId).
+    """
+
+    def __init__(self, ttl_seconds=CANCEL_TTL_SECONDS, max_entries=10000, clock_skew=CANCEL_CLOCK_SKEW_SECONDS):
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self.clock_skew = clock_skew
+        self._cancelled = OrderedDict()  # submission_id -> (cancelled_at, reason, attempt_id)
+        self._running = {}  # submission_id -> (asyncio subprocess, attempt)
+        self._interrupted = set()  # submission bị terminate_all() dừng khi shutdown
+
+    @staticmethod
+    def attempt_of(data, properties):
+        """(attempt_id, published_at) của 1 message submission; published_at là AMQP timestamp (epoch giây)"""
+        headers = getattr(properties, "headers", None) or {}
+        attempt_id = data.get("AttemptId") or headers.get("x-attempt-id")
+        if isinstance(attempt_id, bytes):
+            attempt_id = attempt_id.decode("utf-8", errors="replace")
+        timestamp = getattr(properties, "timestamp", None)
+        if hasattr(timestamp, "timestamp"):
+            timestamp = timestamp.timestamp()
+        return (str(attempt_id) if attempt_id else None,
+                float(timestamp) if isinstance(timestamp, (int, float)) else None)
+
+    def _matches(self, entry, attempt):
+        cancelled_at, _, cancel_attempt_id = entry
+        attempt_id, published_at = attempt or (None, None)
+        if cancel_attempt_id is not None:
+            return attempt_id == cancel_attempt_id
+        # Timestamp AMQP làm tròn xuống giây: message có thể được publish tới gần 1 giây sau giá trị ghi
+        return published_at is not None and published_at + 1 + self.clock_skew <= cancelled_at
+
+    def cancel(self, submission_id, reason=None, attempt_id=None):
+        """Đánh dấu huỷ; trả về True nếu submission đang chạy (đúng attempt) và đã gửi SIGTERM"""
+        self._evict()
+        entry = (time.time(), reason or "Cancelled by request", str(attempt_id) if attempt_id else None)
+        self._cancelled[submission_id] = entry
+        self._cancelled.move_to_end(submission_id)
+        while len(self._cancelled) > self.max_entries:
+            self._cancelled.popitem(last=False)
+
+        proc, attempt = self._running.get(submission_id, (None, None))
+        if proc is None or proc.returncode is not None or not self._matches(entry, attempt):
+            return False
+        logger.info(f"Cancelling running submission {submission_id} (PID={proc.pid})")
+        return self.terminate(proc)
+
+    @staticmethod
+    def terminate(proc):
+        """SIGTERM cho runner, SIGKILL nếu sau CANCEL_GRACE_SECONDS vẫn chưa thoát"""
+        try:
+            proc.terminate()
+        except ProcessLookupError:
+            return False
+
+        def _force_kill():
+            if proc.returncode is None:
+                logger.warning(f"Sandbox runner PID={proc.pid} ignored SIGTERM, killing")
+                try:
+                    proc.kill()
+                except ProcessLookupError:
+                    pass
+
+        asyncio.get_running_loop().call_later(CANCEL_GRACE_SECONDS, _force_kill)
+        return True
+
+    def is_cancelled(self, submission_id, attempt=None):
+        """Có lệnh huỷ áp dụng cho attempt này không (không xoá lệnh huỷ)"""
+        self._evict()
+        entry = self._cancelled.get(submission_id)
+        return entry is not None and self._matches(entry, attempt)
+
+    def pop_reason(self, submission_id, attempt=None):
+        """
+        Lấy và xoá lệnh huỷ nếu nó áp dụng cho attempt (attempt_of()) này.
+        Lệnh huỷ không khớp được giữ lại cho attempt khác (tới khi hết CANCEL_TTL_SECONDS).
+        """
+        self._evict()
+        entry = self._cancelled.get(submission_id)
+        if entry is None:
+            return None
+        if not self._matches(entry, attempt):
+            logger.info(f"Ignoring cancel of {submission_id}: it does not target this attempt")
+            return None
+        del self._cancelled[submission_id]
+        return entry[1]
+
+    def register(self, submission_id, proc, attempt=None):
+        self._running[submission_id] = (proc, attempt)
+
+    def unregister(self, submission_id):
+        self._running.pop(submission_id, None)
+        self._interrupted.discard(submission_id)
+
+    def terminate_all(self):
+        """
+        SIGTERM cho mọi runner đang chạy (consumer shutdown quá thời gian chờ).
+        Các submission này được đánh dấu interrupted để trả message về queue thay vì báo lỗi.
+        """
+        count = 0
+        for submission_id, (proc, _) in list(self._running.items()):
+            if proc.returncode is None and self.terminate(proc):
+                self._interrupted.add(submission_id)
+                count += 1
+        return count
+
+    def pop_interrupted(self, submission_id):
+        """True nếu runner của submission bị dừng bởi terminate_all()"""
+        if submission_id in self._interrupted:
+            self._interrupted.discard(submission_id)
+            return True
+        return False
+
+    def _evict(self):
+        now = time.time()
+        while self._cancelled:
+            cancelled_at = next(iter(self._cancelled.values()))[0]
+            if now - cancelled_at < self.ttl_seconds:
+                break
+            self._cancelled.popitem(last=False)
+
+
+cancellations = CancellationRegistry()
+verdict_cache = VerdictCache()
+testcase_results = TestcaseResultStore()
+result_journal = ResultJournal()
+
+
 class MessageHandler:
     @staticmethod
-    async def handle_message(body, properties, retry_count=0):
+    async def handle_message(body, properties, retry_count=0, cancel_reason=None, publish_progress=None):
         # Đọc retry count từ headers nếu có
         if properties.headers:
             retry_count = properties.headers.get('x-retry-count', 0)
@@ -57,29 +216,71 @@ class MessageHandler:
             "should_requeue": False,
             "response": None,
             "new_body": None,
-            "new_headers": None
+            "new_headers": None,
+            "dead_letter": False,
+            "requeue": False  # NACK(requeue=True), không gửi kết quả (consumer shutdown)
         }
 
+        # Body nén (content_encoding gzip/zstd), codec theo content_type (JSON/MessagePack)
+        try:
+            body = decompress_body(body, getattr(properties, "content_encoding", None))
+            codec = get_codec(getattr(properties, "content_type", None))
+        except MessageTooLarge as e:
+            # Không giải nén/parse tiếp: chuyển nguyên message sang dead-letter queue để kiểm tra
+            logger.error(f"Rejecting message body: {e}")
+            headers = properties.headers.copy() if properties.headers else {}
+            headers["x-dead-letter-reason"] = "message-too-large"
+            return MessageHandler._dead_letter(result, body, properties, "unknown", headers,
+                                               error_code="MESSAGE_TOO_LARGE", error_message=str(e))
+        except Exception as e:
+            logger.error(f"Cannot decode message body: {e}")
+            result["should_ack"] = True
+            result["response"] = MessageHandler._create_error_response(
+                submission_id="unknown",
+                error_code="UNSUPPORTED_CONTENT_ENCODING",
+                error_message=str(e)
+            )
+            return result
+
         # Retry limit
         if retry_count >= MAX_RETRY_COUNT:
             logger.error(f"Message exceeded max retry count ({MAX_RETRY_COUNT})")
             try:
-                data = json.loads(body)
+                data = codec.loads(body)
                 submission_id = data.get("SubmissionId", "unknown")
             except:
                 submission_id = "unknown"
-            result["should_ack"] = True
-            result["response"] = MessageHandler._create_error_response(
-                submission_id=submission_id,
-                error_code="MAX_RETRY_EXCEEDED"
-            )
-            return result
+            return MessageHandler._dead_letter(result, body, properties, submission_id)
 
-        # Parse JSON
+        # Parse JSON / MessagePack
+        # Body lớn: parse từng testcase và ghi input/output ra spool, data chỉ giữ metadata
+        loop = asyncio.get_running_loop()
+        spool_dir = None
+        parse_started = time.monotonic()
+        parse_started_ns = time.time_ns()
         try:
-            data = json.loads(body)
-        except json.JSONDecodeError as e:
-            logger.error(f"Invalid JSON message: {e}")
+            data = None
+            if should_spool(body):
+                try:
+                    spool_dir = await loop.run_in_executor(None, new_spool_dir)
+                    data = await loop.run_in_executor(None, parse_spooled, body, codec, spool_dir)
+                except OSError as e:
+                    # Spool không ghi được (quyền, hết dung lượng): parse trong bộ nhớ như body nhỏ
+                    logger.warning(f"Cannot spool submission body, parsing in memory: {e}")
+                    if spool_dir:
+                        await loop.run_in_executor(None, remove_spool, spool_dir)
+                        spool_dir = None
+            if data is None:
+                data = codec.loads(body)
+            if not isinstance(data, dict):
+                raise ValueError("message body is not an object")
+            PARSE_TIME.observe(time.monotonic() - parse_started, codec=codec.name)
+            tracing.record_span("parse", parse_started_ns, time.time_ns(),
+                                codec=codec.name, bytes=len(body), spooled=spool_dir is not None)
+        except ValueError as e:
+            logger.error(f"Invalid {codec.name} message: {e}")
+            if spool_dir:
+                await loop.run_in_executor(None, remove_spool, spool_dir)
             result["should_ack"] = True
             result["response"] = MessageHandler._create_error_response(
                 submission_id="unknown",
@@ -87,33 +288,34 @@ class MessageHandler:
             )
             return result
 
+        try:
+            result = await MessageHandler._handle_submission(
+                data, body, properties, retry_count, result, cancel_reason, publish_progress
+            )
+            outcome = result["response"]["ErrorCode"] if result["response"] else "Retry"
+            SUBMISSIONS.inc(result=outcome, language=data.get("Language", ""))
+            tracing.annotate_trace(result=outcome)
+            return result
+        finally:
+            if spool_dir:
+                await loop.run_in_executor(None, remove_spool, spool_dir)
+
+    @staticmethod
+    async def _handle_submission(data, body, properties, retry_count, result, cancel_reason, publish_progress):
+        """Validate và chấm submission đã parse"""
         submission_id = data.get("SubmissionId", "N/A")
-        logger.info(f"Processing submission {submission_id}, retry_count={retry_count}")
+        trace_id = tracing.current_trace_id()
+        logger.info(f"Processing submission {submission_id}, retry_count={retry_count}"
+                    + (f", trace_id={trace_id}" if trace_id else ""))
 
         # Validate
         language = data.get("Language")
         code = data.get("Code")
-        # TimeLimit: milliseconds → convert to seconds
-        # MemoryLimit: KB (giữ nguyên, không convert)
-        timelimit_ms = int(data.get("TimeLimit", 3000))  # Default 3000ms
-        memorylimit_kb = int(data.get("MemoryLimit", 262144))  # Default 256MB = 262144 KB
-        
-        # Chuyển đổi TimeLimit từ ms sang seconds
-        timelimit = timelimit_ms / 1000.0  # Convert ms to seconds
-        memorylimit = memorylimit_kb  # Keep in KB (no conversion needed)
-        
-        # Validation: đảm bảo giá trị hợp lý
-        if timelimit <= 0 or timelimit > 60:  # Max 60 seconds per testcase
-            logger.warning(f"Invalid TimeLimit: {timelimit}s, using default 3s")
-            timelimit = 3.0
-        
-        if memorylimit <= 0 or memorylimit > 2097152:  # Max 2GB = 2097152 KB
-            logger.warning(f"Invalid MemoryLimit: {memorylimit}KB, using default 262144KB")
-            memorylimit = 262144
-        
+        timelimit, memorylimit = MessageHandler._parse_limits(data)
         testcases = data.get("Testcases", [])
         
         logger.info(f"Submission {submission_id}: TimeLimit={timelimit}s, MemoryLimit={memorylimit}KB, Testcases={len(testcases)}")
+        tracing.annotate_trace(submission_id=submission_id, language=language, testcases=len(testcases))
 
         if not submission_id or not language or not code:
             result["should_ack"] = True
@@ -131,16 +333,64 @@ class MessageHandler:
             )
             return result
 
+        # Bị huỷ/supersede trước khi tới lượt chạy → bỏ qua, không đụng tới sandbox
+        attempt = CancellationRegistry.attempt_of(data, properties)
+        cancel_reason = cancel_reason or cancellations.pop_reason(submission_id, attempt)
+        if cancel_reason:
+            logger.info(f"Skipping cancelled submission {submission_id}: {cancel_reason}")
+            result["should_ack"] = True
+            result["response"] = MessageHandler._create_error_response(
+                submission_id=submission_id,
+                error_code=SubmissionStatus.CANCELLED,
+                error_message=cancel_reason
+            )
+            return result
+
+        # Progress mode (opt-in): gửi kết quả từng phần qua publish_progress
+        progress = None
+        headers = properties.headers or {}
+        if publish_progress and (data.get("Progress") or headers.get("x-progress")):
+            progress = ProgressReporter(submission_id, len(testcases), publish_progress)
+
         # Xử lý bằng subprocess (đảm bảo quyền isolate)
         try:
-            success, results, error_code, error_msg, compile_result = await MessageHandler._process_submission(
-                data=data,
-                language=language,
-                code=code,
-                timelimit=timelimit,
-                memorylimit=memorylimit,
-                testcases=testcases
-            )
+            # NoCache=true: problem bắt buộc chạy lại mỗi lần (ví dụ checker ngẫu nhiên)
+            use_cache = verdict_cache.enabled and not data.get("NoCache", False)
+            cache_key = None
+            cached = None
+            if use_cache:
+                cache_key = submission_cache_key(language, code, timelimit, memorylimit, testcases)
+                cached = verdict_cache.get(cache_key)
+                CACHE_LOOKUPS.inc(outcome="hit" if cached is not None else "miss")
+                tracing.annotate_trace(verdict_cache="hit" if cached is not None else "miss")
+
+            if cached is not None:
+                logger.info(f"Verdict cache hit for {submission_id} (key={cache_key[:12]})")
+                success, results, error_code, error_msg, compile_result = cached
+            else:
+                success, results, error_code, error_msg, compile_result = await MessageHandler._process_incremental(
+                    data=data,
+                    language=language,
+                    code=code,
+                    timelimit=timelimit,
+                    memorylimit=memorylimit,
+                    testcases=testcases,
+                    # Message redeliver/retry: có thể đã có testcase chạy xong trong journal
+                    resume=bool(getattr(properties, "redelivered", False)) or retry_count > 0,
+                    progress=progress,
+                    attempt=attempt
+                )
+                if use_cache and MessageHandler._is_cacheable(success, results, error_code):
+                    verdict_cache.put(cache_key, (success, results, error_code, error_msg, compile_result))
+
+            for r in results or []:
+                VERDICTS.inc(verdict=r.get("status", "InternalError"), language=language)
+
+            if error_code == SubmissionStatus.INTERRUPTED:
+                # Consumer đang shutdown: message về lại queue (node khác chấm, journal giữ testcase đã xong)
+                logger.info(f"Submission {submission_id} interrupted by shutdown, requeueing")
+                result["requeue"] = True
+                return result
 
             if not success:
                 result["should_ack"] = True
@@ -163,6 +413,10 @@ class MessageHandler:
             logger.exception(f"Failed to process submission {submission_id}")
             new_headers = properties.headers.copy() if properties.headers else {}
             new_headers['x-retry-count'] = retry_count + 1
+            new_headers['x-last-error'] = str(e)[:500]
+            if retry_count + 1 >= MAX_RETRY_COUNT:
+                # Hết lượt retry: không đi vòng qua delay queue nữa
+                return MessageHandler._dead_letter(result, body, properties, submission_id, new_headers)
             result.update({
                 "should_ack": True,
                 "should_requeue": True,
@@ -170,10 +424,66 @@ class MessageHandler:
                 "new_headers": new_headers
             })
             return result
+        finally:
+            if progress:
+                await progress.close()
 
     # ---------------------------------------------------------------------
     # Helper functions
     # ---------------------------------------------------------------------
+    @staticmethod
+    def _dead_letter(result, body, properties, submission_id, headers=None,
+                     error_code="MAX_RETRY_EXCEEDED", error_message=None):
+        """Trả error_code (mặc định MAX_RETRY_EXCEEDED) cho backend và chuyển message gốc sang dead-letter queue"""
+        if headers is None:
+            headers = properties.headers.copy() if properties.headers else {}
+        result.update({
+            "should_ack": True,
+            "dead_letter": True,
+            "new_body": body,
+            "new_headers": headers,
+            "response": MessageHandler._create_error_response(
+                submission_id=submission_id,
+                error_code=error_code,
+                error_message=error_message
+            )
+        })
+        return result
+
+    @staticmethod
+    def _parse_limits(data):
+        """
+        Đọc limits từ message.
+        TimeLimit: milliseconds → convert to seconds
+        MemoryLimit: KB (giữ nguyên, không convert)
+
+        Returns:
+            Tuple: (timelimit_seconds, memorylimit_kb)
+        """
+        timelimit_ms = int(data.get("TimeLimit", 3000))  # Default 3000ms
+        memorylimit_kb = int(data.get("MemoryLimit", 262144))  # Default 256MB = 262144 KB
+        
+        # Chuyển đổi TimeLimit từ ms sang seconds
+        timelimit = timelimit_ms / 1000.0  # Convert ms to seconds
+        memorylimit = memorylimit_kb  # Keep in KB (no conversion needed)
+        
+        # Validation: đảm bảo giá trị hợp lý
+        if timelimit <= 0 or timelimit > 60:  # Max 60 seconds per testcase
+            logger.warning(f"Invalid TimeLimit: {timelimit}s, using default 3s")
+            timelimit = 3.0
+        
+        if memorylimit <= 0 or memorylimit > 2097152:  # Max 2GB = 2097152 KB
+            logger.warning(f"Invalid MemoryLimit: {memorylimit}KB, using default 262144KB")
+            memorylimit = 262144
+        return timelimit, memorylimit
+
+    @staticmethod
+    def _is_cacheable(success, results, error_code):
+        """Chỉ cache kết quả xác định: chấm xong không có InternalError, hoặc lỗi biên dịch"""
+        if not success:
+            return error_code == "CompilationError"
+        return all(r.get("status") != "InternalError" for r in results)
+
     @staticmethod
     def _create_error_response(submission_id, error_code, error_message=None, compile_result=""):
         response = {
@@ -213,13 +523,128 @@ class MessageHandler:
             "TotalTime": total_time,
             "TotalMemory": total_memory,
             "ErrorCode": SubmissionStatus.PASSED if all_passed else SubmissionStatus.FAILED,
-            "ErrorMessage": "" if all_passed else (first_error_message or "Some testcases failed")
+            "ErrorMessage": "" if all_passed else (first_error_message or "Some testcases failed"),
+            # CPU user/sys, wall, peak memory, context switch, IO tổng hợp từ các testcase đã chạy
+            "ResourceUsage": aggregate_usage(results),
+            # Time ở trên đã quy đổi về node tham chiếu; ResourceUsage là số đo thật của node này
+            "NodeSpeedFactor": node_speed.factor
         }
         logger.info(f"[✓] Completed submission {submission_id}")
         return response
 
     @staticmethod
-    async def _process_submission(data, language, code, timelimit, memorylimit, testcases):
+    async def _process_incremental(data, language, code, timelimit, memorylimit, testcases, resume=False, progress=None,
+                                   attempt=None):
+        """
+        Chạy submission, lưu kết quả từng testcase vào TestcaseResultStore.
+        Với message Rejudge=true: chỉ chạy các testcase có nội dung/limits thay đổi,
+        testcase còn lại dùng kết quả đã lưu.
+        Với resume=True (message redeliver): bỏ qua testcase đã có trong ResultJournal.
+        Trả về cùng format với _process_submission.
+        """
+        if not testcase_results.enabled and not result_journal.enabled:
+            return await MessageHandler._process_submission(
+                data, language, code, timelimit, memorylimit, testcases, progress=progress, attempt=attempt
+            )
+
+        submission_id = data.get("SubmissionId", "N/A")
+        loop = asyncio.get_event_loop()
+        src_hash = source_hash(language, code)
+        keys = [result_key(src_hash, tc, timelimit, memorylimit) for tc in testcases]
+
+        stored = {}
+        if testcase_results.enabled and data.get("Rejudge", False) and not data.get("NoCache", False):
+            try:
+                stored = await loop.run_in_executor(None, testcase_results.load, keys)
+            except Exception as e:
+                logger.warning(f"Cannot load stored testcase results: {e}")
+        if result_journal.enabled and resume:
+            try:
+                journaled = await loop.run_in_executor(None, result_journal.load, submission_id)
+                if journaled:
+                    logger.info(f"Resuming {submission_id}: {len(journaled)} testcase results found in journal")
+                stored.update(journaled)
+            except Exception as e:
+                logger.warning(f"Cannot load result journal: {e}")
+
+        reused = []
+        to_run = []
+        for tc, key in zip(testcases, keys):
+            if key in stored:
+                reused.append(dict(
+                    stored[key],
+                    testcaseId=tc.get("TestCaseId") or tc.get("testcaseId", "unknown"),
+                    indexNo=tc.get("IndexNo", tc.get("indexNo", 0))
+                ))
+            else:
+                to_run.append((tc, key))
+
+        if progress:
+            progress.skip(len(reused))
+        if reused:
+            logger.info(f"{submission_id}: reusing {len(reused)} stored results, running {len(to_run)} testcases")
+
+        results = []
+        if to_run:
+            success, results, error_code, error_msg, compile_result = await MessageHandler._process_submission(
+                data, language, code, timelimit, memorylimit, [tc for tc, _ in to_run], progress=progress,
+                attempt=attempt
+            )
+            if not success:
+                if error_code != SubmissionStatus.INTERRUPTED:
+                    await MessageHandler._clear_journal(submission_id)
+                return success, results, error_code, error_msg, compile_result
+
+            # Chỉ lưu kết quả thực sự chạy (bỏ InternalError và testcase bị early stop)
+            key_by_id = MessageHandler._result_keys_by_id(to_run)
+            new_items = [
+                (key_by_id[MessageHandler._result_id(r)], r) for r in results
+                if key_by_id.get(MessageHandler._result_id(r))
+                and r.get("status") != "InternalError"
+                and not r.get("earlyStopped")
+            ]
+            if testcase_results.enabled:
+                try:
+                    await loop.run_in_executor(None, testcase_results.save, new_items)
+                except Exception as e:
+                    logger.warning(f"Cannot save testcase results: {e}")
+
+        await MessageHandler._clear_journal(submission_id)
+        merged = sorted(reused + results, key=lambda r: r.get("indexNo", 0))
+        return True, merged, None, None, ""
+
+    @staticmethod
+    def _result_id(result):
+        return str(result.get("testcaseId", "unknown")), result.get("indexNo", 0)
+
+    @staticmethod
+    def _result_keys_by_id(to_run):
+        """
+        (testcaseId, indexNo) → result key của testcase đã chạy. Kết quả chỉ mang testcaseId/indexNo
+        (thứ tự bị executor sắp lại), nên id trùng nhau mà nội dung khác → None, không lưu kết quả đó
+        (lưu nhầm key sẽ bị mọi lần rejudge sau dùng lại).
+        """
+        keys = {}
+        for tc, key in to_run:
+            result_id = MessageHandler._result_id({
+                "testcaseId": tc.get("TestCaseId") or tc.get("testcaseId", "unknown"),
+                "indexNo": tc.get("IndexNo", tc.get("indexNo", 0))
+            })
+            keys[result_id] = key if keys.get(result_id, key) == key else None
+        return keys
+
+    @staticmethod
+    async def _clear_journal(submission_id):
+        """Submission đã có kết quả cuối → không cần journal nữa"""
+        if not result_journal.enabled:
+            return
+        try:
+            await asyncio.get_event_loop().run_in_executor(None, result_journal.clear, submission_id)
+        except Exception as e:
+            logger.warning(f"Cannot clear result journal for {submission_id}: {e}")
+
+    @staticmethod
+    async def _process_submission(data, language, code, timelimit, memorylimit, testcases, progress=None, attempt=None):
         """
         Gọi isolate sync runner qua subprocess
         
@@ -230,20 +655,34 @@ class MessageHandler:
             timelimit: Time limit in SECONDS (đã convert từ ms)
             memorylimit: Memory limit in KB (giữ nguyên từ message)
             testcases: List of testcase dicts
+            progress: Optional ProgressReporter nhận kết quả từng testcase
+            attempt: (attempt_id, published_at) của message, để lệnh cancel chỉ áp dụng đúng lần chấm này
             
         Returns:
             Tuple: (success, results, error_code, error_msg, compile_result)
         """
         submission_id = data.get("SubmissionId", "N/A")
-        payload = json.dumps({
+        # Span của runner: trace context đi theo payload, runner trả span của nó về cùng kết quả
+        runner_span = tracing.start_span("sandbox_runner", testcases=len(testcases), codec=RUNNER_CODEC.name)
+        # Pipe riêng cho progress: runner ghi, handler đọc (stdout vẫn chỉ chứa kết quả cuối)
+        progress_r, progress_w = os.pipe() if progress else (None, None)
+        payload = RUNNER_CODEC.dumps({
             "language": language,
             "code": code,
             "testcases": testcases,
             "timelimit": timelimit,
-            "memorylimit": memorylimit
+            "memorylimit": memorylimit,
+            "journalId": submission_id if result_journal.enabled else None,
+            "progressFd": progress_w,
+            "trace": tracing.inject(),
+            # Consumer đang profile (SIGUSR1 / control message) → runner cũng profile
+            "profile": profiler.runner_request(),
+            # Limit thật = timelimit × hệ số tốc độ của node (node_speed.py)
+            "speedFactor": node_speed.factor
         })
         
         proc = None
+        progress_task = None
         try:
             current_dir = os.path.dirname(os.path.abspath(__file__))
             sandbox_runner_path = os.path.join(current_dir, "sandbox_runner.py")
@@ -253,7 +692,7 @@ class MessageHandler:
             max_parallel = int(os.getenv("MAX_PARALLEL_TESTCASES", "4"))
             estimated_batches = (len(testcases) + max_parallel - 1) // max_parallel
             # Mỗi batch timeout = (timelimit + 2s buffer) * số testcases trong batch
-            batch_timeout = (timelimit + 2) * max_parallel
+            batch_timeout = (scale_limit(timelimit, node_speed.factor) + 2) * max_parallel
             # Tổng timeout = số batch * batch_timeout + 60s buffer
             timeout_seconds = estimated_batches * batch_timeout + 60
             
@@ -263,18 +702,31 @@ class MessageHandler:
             
             logger.info(f"Starting sandbox runner for {submission_id}, timeout={timeout_seconds:.1f}s (batches={estimated_batches}, timelimit={timelimit}s)")
             
+            # Payload qua stdin (argv bị giới hạn kích thước), cùng codec với stdout của runner
             proc = await asyncio.create_subprocess_exec(
-                "python3", sandbox_runner_path, payload,
+                "python3", sandbox_runner_path, "--codec", RUNNER_CODEC.name,
+                stdin=asyncio.subprocess.PIPE,
                 stdout=asyncio.subprocess.PIPE,
                 stderr=asyncio.subprocess.PIPE,
-                limit=1024 * 1024 * 10  # 10MB buffer limit
+                limit=1024 * 1024 * 10,  # 10MB buffer limit
+                pass_fds=(progress_w,) if progress else ()
             )
+            if progress:
+                os.close(progress_w)
+                progress_w = None
+                progress_task = asyncio.ensure_future(read_progress_pipe(progress_r, progress))
+                progress_r = None
             
             logger.info(f"Subprocess started for {submission_id}, PID={proc.pid}")
+            runner_span.set(pid=proc.pid)
+            cancellations.register(submission_id, proc, attempt)
+            # Lệnh cancel có thể tới ngay trước khi runner kịp đăng ký
+            if cancellations.is_cancelled(submission_id, attempt):
+                cancellations.terminate(proc)
             
             try:
                 out, err = await asyncio.wait_for(
-                    proc.communicate(), 
+                    proc.communicate(payload), 
                     timeout=timeout_seconds
                 )
                 logger.info(f"Subprocess completed for {submission_id}")
@@ -291,20 +743,32 @@ class MessageHandler:
                 await proc.wait()
                 return False, [], "TimeLimitExceeded", "Sandbox execution timeout", "1"
 
+            interrupted = cancellations.pop_interrupted(submission_id)
+            cancel_reason = cancellations.pop_reason(submission_id, attempt)
+            if cancel_reason:
+                logger.info(f"Submission {submission_id} cancelled while running: {cancel_reason}")
+                return False, [], SubmissionStatus.CANCELLED, cancel_reason, ""
+            if interrupted and proc.returncode != 0:
+                return False, [], SubmissionStatus.INTERRUPTED, "Interrupted by consumer shutdown", ""
+
             if proc.returncode != 0:
                 error_msg = err.decode().strip()
                 logger.error(f"Sandbox runner failed for {submission_id}: {error_msg}")
                 return False, [], "InternalError", error_msg, "4"
 
-            output = out.decode().strip()
-            logger.info(f"Subprocess output length: {len(output)} bytes")
+            logger.info(f"Subprocess output length: {len(out)} bytes")
             
             try:
-                isolate_results = json.loads(output)
-            except json.JSONDecodeError as e:
-                logger.error(f"Invalid JSON from sandbox runner: {e}")
-                logger.error(f"Raw output: {output[:500]}")  # Log first 500 chars
-                return False, [], "InternalError", f"Invalid JSON output: {str(e)}", "4"
+                isolate_results = RUNNER_CODEC.loads(out)
+                # Runner trả {"results": [...], "metrics": {...}} - gộp metric đo trong runner
+                if isinstance(isolate_results, dict):
+                    REGISTRY.merge(isolate_results.get("metrics"))
+                    tracing.add_spans(isolate_results.get("spans"))
+                    isolate_results = isolate_results.get("results")
+            except Exception as e:
+                logger.error(f"Invalid {RUNNER_CODEC.name} output from sandbox runner: {e}")
+                logger.error(f"Raw output: {out[:500]!r}")  # Log first 500 bytes
+                return False, [], "InternalError", f"Invalid runner output: {str(e)}", "4"
             
             if not isinstance(isolate_results, list) or not isolate_results:
                 logger.error(f"Invalid result format from sandbox runner")
@@ -328,4 +792,17 @@ class MessageHandler:
                     await proc.wait()
                 except Exception as kill_error:
                     logger.error(f"Failed to kill process: {kill_error}")
-            return False, [], "InternalError", str(e), "4"
\ No newline at end of file
+            return False, [], "InternalError", str(e), "4"
+        finally:
+            cancellations.unregister(submission_id)
+            for fd in (progress_r, progress_w):
+                if fd is not None:
+                    os.close(fd)
+            if progress_task is not None:
+                # Runner đã thoát → pipe EOF; chờ đọc nốt các dòng còn lại
+                try:
+                    await asyncio.wait_for(progress_task, timeout=5)
+                except Exception:
+                    progress_task.cancel()
+            runner_span.set(exit_code=proc.returncode if proc else None)
+            runner_span.end()
@@ -0,0 +1,295 @@
+"""
+Metrics - Counter/Gauge/Histogram và HTTP endpoint /metrics (Prometheus text format)
+Không cần thư viện ngoài. Sandbox runner (process riêng) ghi vào cùng các metric này rồi
+gửi phần đã đo về cho MessageHandler (REGISTRY.dump() → REGISTRY.merge()).
+"""
+import asyncio
+import os
+import time
+from contextlib import contextmanager
+
+# Cổng HTTP của endpoint /metrics (0 = tắt)
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))
+METRICS_HOST = os.getenv("METRICS_HOST", "0.0.0.0")
+
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+def _format_labels(names, values, extra=None):
+    pairs = list(zip(names, values))
+    if extra:
+        pairs.append(extra)
+    if not pairs:
+        return ""
+    escaped = (str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for _, v in pairs)
+    return "{" + ",".join(f'{k}="{v}"' for (k, _), v in zip(pairs, escaped)) + "}"
+
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _Metric:
+    type_name = ""
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}  # tuple(label values) -> value
+
+    def _key(self, labels):
+        return tuple(str(labels.get(n, "")) for n in self.labelnames)
+
+    def header(self):
+        return [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.type_name}"]
+
+
+class Counter(_Metric):
+    type_name = "counter"
+
+    def header(self):
+        return [f"# HELP {self.name}_total {self.documentation}", f"# TYPE {self.name}_total counter"]
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        self._values[key] = self._values.get(key, 0) + amount
+
+    def get(self, **labels):
+        return self._values.get(self._key(labels), 0)
+
+    def render(self):
+        lines = self.header()
+        for key, value in sorted(self._values.items()):
+            lines.append(f"{self.name}_total{_format_labels(self.labelnames, key)} {_format_value(value)}")
+        return lines
+
+    def dump(self):
+        return [[list(k), v] for k, v in self._values.items()]
+
+    def merge(self, items):
+        for key, value in items:
+            key = tuple(key)
+            self._values[key] = self._values.get(key, 0) + value
+
+
+class Gauge(_Metric):
+    """Gauge; nếu có callback thì giá trị được tính lúc scrape"""
+    type_name = "gauge"
+
+    def __init__(self, name, documentation, labelnames=(), callback=None):
+        super().__init__(name, documentation, labelnames)
+        self.callback = callback
+
+    def set(self, value, **labels):
+        self._values[self._key(labels)] = value
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+    def render(self):
+        lines = self.header()
+        if self.callback is not None:
+            try:
+                lines.append(f"{self.name} {_format_value(self.callback())}")
+            except Exception:
+                pass
+            return lines
+        for key, value in sorted(self._values.items()):
+            lines.append(f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}")
+        return lines
+
+    def dump(self):
+        return []  # gauge là giá trị tức thời của từng process, không gộp
+
+    def merge(self, items):
+        pass
+
+
+class Histogram(_Metric):
+    type_name = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, seconds, **labels):
+        key = self._key(labels)
+        entry = self._values.get(key)
+        if entry is None:
+            entry = self._values[key] = [[0] * len(self.buckets), 0.0, 0]  # bucket counts, sum, count
+        for i, bound in enumerate(self.buckets):
+            if seconds <= bound:
+                entry[0][i] += 1
+                break
+        entry[1] += seconds
+        entry[2] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.observe(time.monotonic() - start, **labels)
+
+    def render(self):
+        lines = self.header()
+        for key, (counts, total, count) in sorted(self._values.items()):
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                labels = _format_labels(self.labelnames, key, ("le", _format_value(float(bound))))
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            labels = _format_labels(self.labelnames, key, ("le", "+Inf"))
+            lines.append(f"{self.name}_bucket{labels} {count}")
+            lines.append(f"{self.name}_sum{_format_labels(self.labelnames, key)} {_format_value(total)}")
+            lines.append(f"{self.name}_count{_format_labels(self.labelnames, key)} {count}")
+        return lines
+
+    def dump(self):
+        return [[list(k), v] for k, v in self._values.items()]
+
+    def merge(self, items):
+        for key, (counts, total, count) in items:
+            key = tuple(key)
+            entry = self._values.get(key)
+            if entry is None:
+                entry = self._values[key] = [[0] * len(self.buckets), 0.0, 0]
+            for i, c in enumerate(counts[:len(self.buckets)]):
+                entry[0][i] += c
+            entry[1] += total
+            entry[2] += count
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self._metrics = {}
+
+    def register(self, metric):
+        self._metrics[metric.name] = metric
+        return metric
+
+    def render(self):
+        lines = []
+        for metric in self._metrics.values():
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+    def dump(self):
+        """Giá trị đã đo trong process này (để gửi sang process khác)"""
+        out = {}
+        for name, metric in self._metrics.items():
+            items = metric.dump()
+            if items:
+                out[name] = items
+        return out
+
+    def merge(self, dumped):
+        for name, items in (dumped or {}).items():
+            metric = self._metrics.get(name)
+            if metric is not None:
+                try:
+                    metric.merge(items)
+                except (TypeError, ValueError):
+                    continue
+
+
+REGISTRY = MetricsRegistry()
+
+
+def _busy_boxes():
+    """Số sandbox box đang tồn tại trong dải box id của process này"""
+    from executor_isolate_async import ISOLATE_BOX_ID_START, ISOLATE_BOX_ID_COUNT
+    from sandbox_backend import get_backend
+
+    return sum(
+        1 for box_id in get_backend().box_ids()
+        if ISOLATE_BOX_ID_START <= box_id < ISOLATE_BOX_ID_START + ISOLATE_BOX_ID_COUNT
+    )
+
+
+# ----------------------------------------------------------------------------
+# Metric của judge pipeline
+# ----------------------------------------------------------------------------
+QUEUE_WAIT = REGISTRY.register(Histogram(
+    "judge_queue_wait_seconds", "Time from delivery to start of judging", ["priority"]))
+SUBMISSION_DURATION = REGISTRY.register(Histogram(
+    "judge_submission_duration_seconds", "Time from delivery to result published", ["priority"]))
+PARSE_TIME = REGISTRY.register(Histogram(
+    "judge_parse_seconds", "Time spent decoding a submission body", ["codec"]))
+COMPILE_TIME = REGISTRY.register(Histogram(
+    "judge_compile_seconds", "Compile or syntax check time", ["language"]))
+BOX_INIT_TIME = REGISTRY.register(Histogram(
+    "judge_box_init_seconds", "Sandbox box cleanup/init time before a run"))
+BOX_CLEANUP_TIME = REGISTRY.register(Histogram(
+    "judge_box_cleanup_seconds", "Sandbox box cleanup time after a run"))
+TESTCASE_RUN_TIME = REGISTRY.register(Histogram(
+    "judge_testcase_run_seconds", "Wall time of one testcase run in the sandbox", ["language"]))
+COMPARE_TIME = REGISTRY.register(Histogram(
+    "judge_compare_seconds", "Output comparison time"))
+PUBLISH_TIME = REGISTRY.register(Histogram(
+    "judge_publish_seconds", "Time from queuing a message to its publisher confirm"))
+
+VERDICTS = REGISTRY.register(Counter(
+    "judge_testcase_verdicts", "Testcase results by verdict and language", ["verdict", "language"]))
+SUBMISSIONS = REGISTRY.register(Counter(
+    "judge_submissions", "Judged submissions by result code and language", ["result", "language"]))
+RETRIES = REGISTRY.register(Counter(
+    "judge_retries", "Submissions scheduled for retry or dead-lettered", ["outcome"]))
+CACHE_LOOKUPS = REGISTRY.register(Counter(
+    "judge_verdict_cache_lookups", "Verdict cache lookups", ["outcome"]))
+PUBLISH_FAILURES = REGISTRY.register(Counter(
+    "judge_publish_failures", "Messages that could not be published after all retries"))
+
+INFLIGHT = REGISTRY.register(Gauge(
+    "judge_inflight_submissions", "Submissions being judged by this consumer"))
+PENDING = REGISTRY.register(Gauge(
+    "judge_pending_submissions", "Prefetched submissions waiting for a free slot"))
+BUSY_BOXES = REGISTRY.register(Gauge(
+    "judge_busy_boxes", "Sandbox boxes currently initialized in this consumer's box range",
+    callback=_busy_boxes))
+NODE_SPEED_FACTOR = REGISTRY.register(Gauge(
+    "judge_node_speed_factor", "Time limit scaling factor of this node (>1 = slower than the reference node)"))
+
+
+async def _handle_request(reader, writer):
+    try:
+        request_line = await asyncio.wait_for(reader.readline(), timeout=5)
+        # Bỏ qua phần header còn lại
+        while True:
+            line = await asyncio.wait_for(reader.readline(), timeout=5)
+            if not line or line in (b"\r\n", b"\n"):
+                break
+        parts = request_line.decode("latin-1").split()
+        path = parts[1].split("?")[0] if len(parts) > 1 else "/"
+        if path in ("/metrics", "/"):
+            body = REGISTRY.render().encode("utf-8")
+            status = "200 OK"
+        else:
+            body = b"Not Found\n"
+            status = "404 Not Found"
+        writer.write(
+            f"HTTP/1.1 {status}\r\nContent-Type: text/plain; version=0.0.4; charset=utf-8\r\n"
+            f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode("latin-1") + body
+        )
+        await writer.drain()
+    except (asyncio.TimeoutError, ConnectionError):
+        pass
+    finally:
+        writer.close()
+
+
+async def start_metrics_server(port=METRICS_PORT, host=METRICS_HOST):
+    """Mở HTTP server cho /metrics; trả về server hoặc None nếu tắt"""
+    if port <= 0:
+        return None
+    server = await asyncio.start_server(_handle_request, host, port)
+    print(f"[✓] Metrics endpoint at http://{host}:{port}/metrics")
+    return server
@@ -0,0 +1,175 @@
+"""
+Node Speed - Hệ số tốc độ của judge node để TimeLimit có cùng ý nghĩa trên phần cứng khác nhau
+
+Calibration: chạy 1 workload CPU cố định (số học, sàng nguyên tố, dict, sort) trong process con
+với cùng nice/CPU affinity như sandbox, lấy CPU time nhỏ nhất của NODE_SPEED_RUNS lần.
+    factor = thời gian đo được / NODE_SPEED_REFERENCE_SECONDS (thời gian trên node tham chiếu)
+factor > 1: node chậm hơn node tham chiếu → executor chạy với --time/--wall-time = TimeLimit × factor
+và báo time = CPU time / factor (thời gian quy đổi về node tham chiếu). Nhờ vậy cùng 1 bài trên các
+node khác nhau cho cùng verdict. ResourceUsage vẫn là số đo thật của node.
+
+Chạy lúc consumer khởi động và định kỳ mỗi NODE_SPEED_RECALIBRATE_INTERVAL giây (khi không có
+submission nào đang chạy). Lấy giá trị tham chiếu: chạy trên node tham chiếu
+    python3 src/node_speed.py
+"""
+import argparse
+import asyncio
+import os
+import subprocess
+import sys
+import time
+
+from metrics import NODE_SPEED_FACTOR
+from sandbox_backend import _set_low_priority
+
+# Cố định hệ số (bỏ qua calibration), ví dụ "1.25". Rỗng = calibration
+NODE_SPEED_FIXED = os.getenv("NODE_SPEED_FACTOR", "").strip()
+# CPU time (giây) của workload calibration trên node tham chiếu. Rỗng = chỉ đo và log, hệ số luôn 1.0
+NODE_SPEED_REFERENCE_SECONDS = float(os.getenv("NODE_SPEED_REFERENCE_SECONDS", "0") or 0)
+# Calibration lại định kỳ (giây), 0 = chỉ lúc khởi động
+NODE_SPEED_RECALIBRATE_INTERVAL = float(os.getenv("NODE_SPEED_RECALIBRATE_INTERVAL", "3600"))
+NODE_SPEED_RUNS = max(1, int(os.getenv("NODE_SPEED_RUNS", "5")))
+# Giới hạn hệ số (calibration lỗi/node quá tải không được làm limit lệch quá xa)
+NODE_SPEED_MIN_FACTOR = float(os.getenv("NODE_SPEED_MIN_FACTOR", "0.5"))
+NODE_SPEED_MAX_FACTOR = float(os.getenv("NODE_SPEED_MAX_FACTOR", "3.0"))
+# Lần calibration sau lệch ít hơn mức này (tương đối) thì giữ hệ số cũ, tránh limit dao động
+NODE_SPEED_TOLERANCE = float(os.getenv("NODE_SPEED_TOLERANCE", "0.05"))
+
+# Workload calibration: in CPU time nhỏ nhất (giây) của argv[1] lần chạy
+_WORKLOAD = r"""
+import sys, time
+
+def work():
+    x = 0
+    for i in range(1500000):
+        x = (x * 31 + i) % 1000003
+    n = 1000000
+    sieve = bytearray([1]) * n
+    for p in range(2, int(n ** 0.5) + 1):
+        if sieve[p]:
+            sieve[p * p::p] = bytes(len(range(p * p, n, p)))
+    counts = {}
+    for i in range(300000):
+        key = (i * 7919) % 5003
+        counts[key] = counts.get(key, 0) + 1
+    data = [(i * 2654435761) % 4294967296 for i in range(200000)]
+    data.sort()
+    return x + sum(sieve) + len(counts) + data[0]
+
+best = None
+for _ in range(int(sys.argv[1])):
+    start = time.process_time()
+    work()
+    elapsed = time.process_time() - start
+    best = elapsed if best is None else min(best, elapsed)
+print(f"{best:.6f}")
+"""
+
+
+def measure(runs=NODE_SPEED_RUNS, timeout=300):
+    """CPU time (giây) nhỏ nhất của workload calibration, chạy trong process con"""
+    proc = subprocess.run(
+        [sys.executable, "-c", _WORKLOAD, str(runs)],
+        capture_output=True, text=True, timeout=timeout, preexec_fn=_set_low_priority
+    )
+    if proc.returncode != 0:
+        raise RuntimeError(f"calibration workload failed: {proc.stderr.strip()}")
+    return float(proc.stdout.strip())
+
+
+class NodeSpeed:
+    """Hệ số tốc độ hiện tại của node (đọc trên event loop thread, truyền cho sandbox runner qua payload)"""
+
+    def __init__(self):
+        self.factor = 1.0
+        self.measured_seconds = None
+        self.calibrated_at = None
+        if NODE_SPEED_FIXED:
+            self.factor = float(NODE_SPEED_FIXED)
+        NODE_SPEED_FACTOR.set(self.factor)
+
+    @property
+    def enabled(self):
+        return not NODE_SPEED_FIXED
+
+    def _factor_from(self, seconds):
+        if NODE_SPEED_REFERENCE_SECONDS <= 0:
+            return 1.0
+        factor = seconds / NODE_SPEED_REFERENCE_SECONDS
+        return round(min(max(factor, NODE_SPEED_MIN_FACTOR), NODE_SPEED_MAX_FACTOR), 3)
+
+    async def calibrate(self):
+        """Đo lại và cập nhật hệ số; lỗi thì giữ hệ số cũ. Trả về hệ số hiện tại"""
+        if not self.enabled:
+            return self.factor
+        loop = asyncio.get_running_loop()
+        try:
+            seconds = await loop.run_in_executor(None, measure)
+        except (OSError, ValueError, RuntimeError, subprocess.TimeoutExpired) as e:
+            print(f"[WARNING] Node speed calibration failed, keeping factor {self.factor}: {e}")
+            return self.factor
+        factor = self._factor_from(seconds)
+        if self.calibrated_at is not None and abs(factor - self.factor) <= self.factor * NODE_SPEED_TOLERANCE:
+            factor = self.factor
+        self.measured_seconds = seconds
+        self.calibrated_at = time.time()
+        self.factor = factor
+        NODE_SPEED_FACTOR.set(factor)
+        if NODE_SPEED_REFERENCE_SECONDS > 0:
+            print(f"[✓] Node speed calibrated: {seconds:.3f}s (reference {NODE_SPEED_REFERENCE_SECONDS:g}s), "
+                  f"factor={self.factor}")
+        else:
+            print(f"[i] Node speed calibration: {seconds:.3f}s; set NODE_SPEED_REFERENCE_SECONDS "
+                  f"to the value of the reference node to normalize time limits")
+        return self.factor
+
+    async def run_periodic(self, is_idle=lambda: True, pause=None):
+        """
+        Calibration định kỳ lúc is_idle() (không có submission đang chạy) để không đo sai.
+
+        Args:
+            pause: async context manager dừng nhận submission mới trong lúc đo; nếu vừa có
+                submission bắt đầu chạy trước khi dừng được thì chờ rảnh và thử lại
+        """
+        while self.enabled and NODE_SPEED_RECALIBRATE_INTERVAL > 0:
+            await asyncio.sleep(NODE_SPEED_RECALIBRATE_INTERVAL)
+            while True:
+                while not is_idle():
+                    await asyncio.sleep(5)
+                if pause is None:
+                    await self.calibrate()
+                    break
+                async with pause():
+                    if is_idle():
+                        await self.calibrate()
+                        break
+
+
+node_speed = NodeSpeed()
+
+
+def scale_limit(timelimit, factor):
+    """TimeLimit (giây, trên node tham chiếu) → limit thật trên node này"""
+    return round(timelimit * factor, 3)
+
+
+def normalize_ms(time_ms, factor):
+    """Thời gian đo trên node này → thời gian quy đổi về node tham chiếu"""
+    return int(round(time_ms / factor)) if factor else time_ms
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure this node's speed for time limit normalization")
+    parser.add_argument("--runs", type=int, default=NODE_SPEED_RUNS, help="Workload repetitions (minimum is kept)")
+    args = parser.parse_args()
+
+    seconds = measure(args.runs)
+    print(f"Calibration workload: {seconds:.3f}s CPU (min of {args.runs} runs)")
+    if NODE_SPEED_REFERENCE_SECONDS > 0:
+        print(f"Speed factor vs reference ({NODE_SPEED_REFERENCE_SECONDS:g}s): {node_speed._factor_from(seconds)}")
+    else:
+        print(f"On the reference node, set NODE_SPEED_REFERENCE_SECONDS={seconds:.3f} on every judge node")
+
+
+if __name__ == "__main__":
+    main()
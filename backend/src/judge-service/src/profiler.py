@@ -0,0 +1,272 @@
+"""
+Profiler - Profile consumer và sandbox runner đang chạy trong N giây, không cần restart
+
+Kích hoạt:
+    kill -USR1 <pid consumer hoặc supervisor>     (PROFILE_MODE trong PROFILE_SECONDS giây)
+    control message {"Type": "Profile", "Seconds": 30, "Mode": "sample"} lên JUDGE_CONTROL_EXCHANGE (mọi node)
+Sandbox runner khởi động trong lúc consumer đang profile cũng tự profile (yêu cầu đi theo payload).
+
+Mode:
+    cprofile  cProfile của event loop thread → .prof (pstats / snakeviz) + .txt (top theo cumulative time)
+    sample    stack của mọi thread mỗi PROFILE_SAMPLE_INTERVAL giây → .folded (flamegraph.pl / speedscope)
+
+Profile 1 submission từ dòng lệnh (handler + runner, không cần RabbitMQ):
+    python3 src/profiler.py submission.json --mode cprofile
+    python3 src/profiler.py traffic.jsonl --index 42 --mode sample
+"""
+import argparse
+import asyncio
+import cProfile
+import io
+import math
+import os
+import pstats
+import sys
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+
+# Thư mục nhận file profile
+PROFILE_DIR = os.getenv("PROFILE_DIR", "/tmp/judge-profiles")
+# Thời gian profile mặc định (SIGUSR1 / control message không có Seconds)
+PROFILE_SECONDS = float(os.getenv("PROFILE_SECONDS", "30"))
+# Thời gian profile tối đa của 1 yêu cầu (Seconds lớn hơn bị cắt về mức này)
+PROFILE_MAX_SECONDS = float(os.getenv("PROFILE_MAX_SECONDS", "600"))
+# cprofile | sample
+PROFILE_MODE = os.getenv("PROFILE_MODE", "sample")
+PROFILE_SAMPLE_INTERVAL = float(os.getenv("PROFILE_SAMPLE_INTERVAL", "0.005"))
+
+MODES = ("cprofile", "sample")
+
+
+class _CProfileSession:
+    """cProfile chỉ thấy thread gọi enable() (event loop thread)"""
+
+    def __init__(self):
+        self.profile = cProfile.Profile()
+        self.profile.enable()
+
+    def stop(self, path_base):
+        self.profile.disable()
+        self.profile.dump_stats(path_base + ".prof")
+        text = io.StringIO()
+        pstats.Stats(self.profile, stream=text).sort_stats("cumulative").print_stats(60)
+        with open(path_base + ".txt", "w", encoding="utf-8") as f:
+            f.write(text.getvalue())
+        return [path_base + ".prof", path_base + ".txt"]
+
+
+class _StackSampler:
+    """Thread lấy mẫu stack của mọi thread khác, gộp thành folded stack (mỗi dòng: stack đếm)"""
+
+    def __init__(self, interval=PROFILE_SAMPLE_INTERVAL):
+        self.interval = interval
+        self.stacks = Counter()
+        self._stop_event = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="profile-sampler", daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        own = threading.get_ident()
+        while not self._stop_event.wait(self.interval):
+            names = {t.ident: t.name for t in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident == own:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                    frame = frame.f_back
+                stack.append(names.get(ident, "thread"))
+                self.stacks[";".join(reversed(stack))] += 1
+
+    def stop(self, path_base):
+        self._stop_event.set()
+        self._thread.join()
+        with open(path_base + ".folded", "w", encoding="utf-8") as f:
+            for stack, count in self.stacks.most_common():
+                f.write(f"{stack} {count}\n")
+        return [path_base + ".folded"]
+
+
+def _start_session(mode):
+    if mode not in MODES:
+        raise ValueError(f"Unknown profile mode: {mode} (expected {' | '.join(MODES)})")
+    return _CProfileSession() if mode == "cprofile" else _StackSampler()
+
+
+def _path_base(name):
+    return os.path.join(PROFILE_DIR, f"{name}-{os.getpid()}-{time.strftime('%Y%m%d-%H%M%S')}")
+
+
+def _finish(session, path_base, out):
+    try:
+        os.makedirs(PROFILE_DIR, exist_ok=True)
+        files = session.stop(path_base)
+    except OSError as e:
+        print(f"[WARNING] Cannot write profile {path_base}: {e}", file=out, flush=True)
+        return []
+    print(f"[✓] Profile written: {', '.join(files)}", file=out, flush=True)
+    return files
+
+
+class Profiler:
+    """Profile theo yêu cầu của 1 process (start/stop gọi trên event loop thread)"""
+
+    def __init__(self, name="consumer"):
+        self.name = name
+        self._session = None
+        self._mode = None
+        self._until = 0.0
+        self._timer = None
+        self._path_base = None
+
+    @property
+    def active(self):
+        return self._session is not None
+
+    def start(self, seconds=None, mode=None, max_seconds=PROFILE_MAX_SECONDS):
+        """
+        Profile trong `seconds` giây (tối đa max_seconds, None = không giới hạn) rồi tự ghi file.
+        Yêu cầu không hợp lệ (control message) hoặc đang profile thì log và bỏ qua, trả về False.
+        """
+        if seconds is None:
+            seconds = PROFILE_SECONDS
+        try:
+            if isinstance(seconds, bool):
+                raise TypeError
+            seconds = float(seconds)
+        except (TypeError, ValueError):
+            print(f"[WARNING] Invalid profile Seconds {seconds!r}, request ignored")
+            return False
+        if not math.isfinite(seconds) or seconds <= 0:
+            print(f"[WARNING] Invalid profile Seconds {seconds!r}, request ignored")
+            return False
+        if max_seconds is not None and seconds > max_seconds:
+            print(f"[WARNING] Profile Seconds {seconds:g} capped to PROFILE_MAX_SECONDS={max_seconds:g}")
+            seconds = max_seconds
+        if mode is None:
+            mode = PROFILE_MODE
+        if not isinstance(mode, str):
+            print(f"[WARNING] Invalid profile Mode {mode!r}, request ignored")
+            return False
+        mode = mode.lower()
+        if self._session is not None:
+            print(f"[WARNING] Profiling already in progress ({self._mode}), request ignored")
+            return False
+        try:
+            self._session = _start_session(mode)
+        except ValueError as e:
+            print(f"[WARNING] {e}")
+            return False
+        self._mode = mode
+        self._until = time.monotonic() + seconds
+        self._path_base = _path_base(self.name)
+        self._timer = asyncio.get_running_loop().call_later(seconds, self.stop)
+        print(f"[i] Profiling {self.name} ({mode}) for {seconds:g}s, output in {PROFILE_DIR}")
+        return True
+
+    def stop(self):
+        session, self._session = self._session, None
+        if session is None:
+            return []
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        return _finish(session, self._path_base, sys.stdout)
+
+    def runner_request(self):
+        """Yêu cầu profile gửi kèm payload cho sandbox runner khởi động trong lúc đang profile"""
+        if self._session is None:
+            return None
+        return {"mode": self._mode, "seconds": round(max(0.0, self._until - time.monotonic()), 3)}
+
+
+profiler = Profiler()
+
+
+@contextmanager
+def profile_request(request, name):
+    """
+    Profile đoạn code bên trong theo yêu cầu của process cha (sandbox runner: cả vòng đời runner).
+    Log ghi ra stderr vì stdout của runner là kết quả.
+    """
+    if not request:
+        yield
+        return
+    try:
+        session = _start_session(request.get("mode", PROFILE_MODE))
+    except ValueError as e:
+        print(f"[WARNING] {e}", file=sys.stderr)
+        yield
+        return
+    try:
+        yield
+    finally:
+        _finish(session, _path_base(name), sys.stderr)
+
+
+# ----------------------------------------------------------------------------
+# CLI: profile 1 submission
+# ----------------------------------------------------------------------------
+def load_submission(path, index=0):
+    """(body, properties) từ file message JSON hoặc dòng thứ index của file traffic (traffic_replay)"""
+    import json
+    from traffic_replay import build_message, load_trace
+
+    with open(path, "rb") as f:
+        head = f.read(1 << 16).lstrip()
+    try:
+        first = json.loads(head.split(b"\n", 1)[0])
+    except ValueError:
+        first = None
+    if isinstance(first, dict) and "body" in first and "t" in first:
+        entries = load_trace(path)
+        if not 0 <= index < len(entries):
+            raise SystemExit(f"[ERROR] {path} has {len(entries)} submissions, --index {index} is out of range")
+        return build_message(entries[index])
+    with open(path, "rb") as f:
+        return f.read(), {"content_type": "application/json"}
+
+
+async def profile_submission(body, properties, mode):
+    from broker_transport import InMemoryMessage
+    from message_handler import MessageHandler
+
+    message = InMemoryMessage(body, **properties)
+    profiler.name = "submission"
+    profiler.start(seconds=24 * 3600, mode=mode, max_seconds=None)
+    started = time.monotonic()
+    try:
+        result = await MessageHandler.handle_message(body, message)
+    finally:
+        files = profiler.stop()
+    return result, time.monotonic() - started, files
+
+
+def main():
+    global PROFILE_DIR
+    parser = argparse.ArgumentParser(description="Profile one submission through handler and sandbox runner")
+    parser.add_argument("source", help="Submission message (JSON) or recorded traffic file (JSONL)")
+    parser.add_argument("--index", type=int, default=0, help="Submission index in a traffic file")
+    parser.add_argument("--mode", choices=MODES, default=PROFILE_MODE)
+    parser.add_argument("-o", "--output-dir", help=f"Profile directory (default {PROFILE_DIR})")
+    args = parser.parse_args()
+
+    if args.output_dir:
+        # Runner đọc PROFILE_DIR từ env
+        PROFILE_DIR = os.environ["PROFILE_DIR"] = args.output_dir
+    body, properties = load_submission(args.source, args.index)
+    result, seconds, files = asyncio.run(profile_submission(body, properties, args.mode))
+    response = result.get("response") or {}
+    print(f"[✓] {response.get('SubmissionId', 'N/A')}: {response.get('ErrorCode', 'Retry')} in {seconds:.2f}s")
+    print(f"    handler profile: {', '.join(files) or '-'}")
+    print(f"    runner profiles: {PROFILE_DIR}/runner-*")
+
+
+if __name__ == "__main__":
+    # Chạy bằng module "profiler" (không phải __main__) để dùng chung instance profiler với message_handler
+    from profiler import main
+    main()
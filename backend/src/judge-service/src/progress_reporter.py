@@ -0,0 +1,99 @@
+"""
+Progress Reporter - Gửi kết quả từng phần (per-testcase) về reply_to trong lúc đang chấm
+Opt-in theo message (Progress=true hoặc header x-progress), có rate-limit để không flood broker.
+
+Sandbox runner ghi mỗi testcase xong thành 1 dòng JSON vào pipe (progressFd),
+MessageHandler đọc pipe và gom lại, tối đa 1 message / PROGRESS_MIN_INTERVAL giây.
+"""
+import asyncio
+import json
+import os
+import time
+
+PROGRESS_MIN_INTERVAL = float(os.getenv("PROGRESS_MIN_INTERVAL", "1.0"))
+
+# Field gọn của 1 testcase được gửi trong progress message
+PROGRESS_FIELDS = ("testcaseId", "indexNo", "status", "time", "memory")
+
+
+def compact_result(result):
+    return {f: result.get(f) for f in PROGRESS_FIELDS}
+
+
+class ProgressReporter:
+    """
+    Gom kết quả testcase và publish theo chu kỳ.
+
+    Args:
+        submission_id: SubmissionId
+        total: Tổng số testcase của submission
+        publish: async callable(body_dict) gửi progress message
+        min_interval: Khoảng cách tối thiểu giữa 2 message (giây)
+    """
+
+    def __init__(self, submission_id, total, publish, min_interval=PROGRESS_MIN_INTERVAL):
+        self.submission_id = submission_id
+        self.total = total
+        self.publish = publish
+        self.min_interval = min_interval
+        self.completed = 0
+        self._pending = []
+        self._last_publish = 0.0
+        self._flush_task = None
+
+    def skip(self, count):
+        """Testcase đã có kết quả sẵn (store/journal), chỉ tính vào số đã xong"""
+        self.completed += count
+
+    def add(self, result):
+        self.completed += 1
+        self._pending.append(compact_result(result))
+        if self._flush_task is None:
+            delay = max(0.0, self.min_interval - (time.monotonic() - self._last_publish))
+            self._flush_task = asyncio.ensure_future(self._flush_later(delay))
+
+    async def _flush_later(self, delay):
+        await asyncio.sleep(delay)
+        # Kết quả tới trong lúc đang publish sẽ được lên lịch flush tiếp theo
+        self._flush_task = None
+        await self.flush()
+
+    async def flush(self):
+        if not self._pending:
+            return
+        results, self._pending = self._pending, []
+        self._last_publish = time.monotonic()
+        await self.publish({
+            "SubmissionId": self.submission_id,
+            "Progress": True,
+            "Completed": self.completed,
+            "Total": self.total,
+            "Results": results
+        })
+
+    async def close(self):
+        """Huỷ flush đang chờ - kết quả cuối cùng sẽ được gửi bằng response chính"""
+        if self._flush_task is not None:
+            self._flush_task.cancel()
+            self._flush_task = None
+        self._pending = []
+
+
+async def read_progress_pipe(read_fd, reporter):
+    """Đọc các dòng JSON từ pipe của sandbox runner tới khi runner đóng pipe"""
+    loop = asyncio.get_running_loop()
+    reader = asyncio.StreamReader()
+    transport, _ = await loop.connect_read_pipe(
+        lambda: asyncio.StreamReaderProtocol(reader), os.fdopen(read_fd, "rb")
+    )
+    try:
+        while True:
+            line = await reader.readline()
+            if not line:
+                break
+            try:
+                reporter.add(json.loads(line))
+            except json.JSONDecodeError:
+                continue
+    finally:
+        transport.close()
@@ -0,0 +1,102 @@
+"""
+Resource Usage - Tài nguyên dùng bởi 1 lần chạy testcase và tổng hợp theo submission
+
+Đọc từ meta của sandbox (format isolate, đơn vị cố định - không đoán):
+    time / time-wall      giây (CPU user+sys / wall clock)
+    time-user / time-sys  giây (cgroup cpu.stat của isolate --cg, hoặc rusage của local backend)
+    cg-mem                KB, peak memory của cgroup (isolate --cg)
+    max-rss               KB, peak RSS của process lớn nhất (khi không có cgroup)
+    csw-voluntary / csw-forced
+    io-read-bytes / io-write-bytes   byte đọc/ghi block device (cgroup io.stat hoặc rusage)
+Giá trị sandbox không đo được là None (không phải 0).
+"""
+from dataclasses import dataclass, asdict
+from typing import Optional
+
+
+def _int(meta, key, scale=1):
+    value = meta.get(key)
+    if value is None or str(value).strip() == "":
+        return None
+    try:
+        return int(round(float(value) * scale))
+    except ValueError:
+        return None
+
+
+@dataclass
+class ResourceUsage:
+    cpu_ms: int = 0
+    cpu_user_ms: Optional[int] = None
+    cpu_sys_ms: Optional[int] = None
+    wall_ms: Optional[int] = None
+    peak_memory_kb: int = 0
+    memory_source: str = ""  # cgroup | rss
+    csw_voluntary: Optional[int] = None
+    csw_forced: Optional[int] = None
+    io_read_bytes: Optional[int] = None
+    io_write_bytes: Optional[int] = None
+
+    @classmethod
+    def from_meta(cls, meta):
+        cg_mem = _int(meta, "cg-mem")
+        if cg_mem is not None:
+            peak, source = cg_mem, "cgroup"
+        else:
+            peak, source = _int(meta, "max-rss") or 0, "rss"
+        return cls(
+            cpu_ms=_int(meta, "time", 1000) or 0,
+            cpu_user_ms=_int(meta, "time-user", 1000),
+            cpu_sys_ms=_int(meta, "time-sys", 1000),
+            wall_ms=_int(meta, "time-wall", 1000),
+            peak_memory_kb=peak,
+            memory_source=source,
+            csw_voluntary=_int(meta, "csw-voluntary"),
+            csw_forced=_int(meta, "csw-forced"),
+            io_read_bytes=_int(meta, "io-read-bytes"),
+            io_write_bytes=_int(meta, "io-write-bytes"),
+        )
+
+    def to_dict(self):
+        """Dạng dict camelCase (như các field khác của result), đi qua msgpack/JSON được"""
+        return {_camel(k): v for k, v in asdict(self).items()}
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(**{k: data.get(_camel(k), getattr(cls, k)) for k in cls.__dataclass_fields__})
+
+
+def _camel(name):
+    first, *rest = name.split("_")
+    return first + "".join(p.title() for p in rest)
+
+
+_SUMMED = ("cpu_ms", "cpu_user_ms", "cpu_sys_ms", "wall_ms", "csw_voluntary", "csw_forced",
+           "io_read_bytes", "io_write_bytes")
+
+
+def aggregate(results):
+    """
+    Tổng hợp usage của các testcase đã chạy (result có field "usage") cho 1 submission.
+
+    Returns:
+        dict camelCase: tổng CPU/wall/context switch/IO, peak memory và testcase chậm nhất;
+        None nếu không testcase nào chạy trong sandbox (cache, compile error, ...)
+    """
+    usages = [(r, ResourceUsage.from_dict(r["usage"])) for r in results if r.get("usage")]
+    if not usages:
+        return None
+    summary = {"testcases": len(usages)}
+    for key in _SUMMED:
+        values = [getattr(u, key) for _, u in usages if getattr(u, key) is not None]
+        summary[_camel(key)] = sum(values) if values else None
+    peak_result, peak = max(usages, key=lambda ru: ru[1].peak_memory_kb)
+    slowest_result, slowest = max(usages, key=lambda ru: ru[1].cpu_ms)
+    summary.update(
+        peakMemoryKb=peak.peak_memory_kb,
+        peakMemoryIndexNo=peak_result.get("indexNo"),
+        memorySource=peak.memory_source,
+        maxCpuMs=slowest.cpu_ms,
+        maxCpuIndexNo=slowest_result.get("indexNo"),
+    )
+    return summary
@@ -0,0 +1,82 @@
+"""
+Result Journal - Ghi lại kết quả từng testcase ngay khi chạy xong (SQLite WAL, append-only)
+Nếu judge process chết giữa chừng, message được redeliver sẽ bỏ qua các testcase đã có trong journal.
+
+Sandbox runner ghi (append), MessageHandler đọc khi message được redeliver và xoá khi submission xong.
+"""
+import json
+import os
+import sqlite3
+import threading
+import time
+
+from testcase_store import JUDGE_DATA_DIR
+
+# File SQLite của journal (rỗng = tắt)
+RESULT_JOURNAL_DB = os.getenv("RESULT_JOURNAL_DB", os.path.join(JUDGE_DATA_DIR, "result_journal.db"))
+# Entry của submission không bao giờ hoàn tất (ví dụ message bị xoá khỏi queue) bị dọn sau N giờ
+RESULT_JOURNAL_TTL_HOURS = float(os.getenv("RESULT_JOURNAL_TTL_HOURS", "24"))
+
+
+class ResultJournal:
+    """Journal (submission_id, result_key) -> result. Method sync, gọi qua run_in_executor."""
+
+    def __init__(self, db_path=RESULT_JOURNAL_DB, ttl_hours=RESULT_JOURNAL_TTL_HOURS):
+        self.db_path = db_path
+        self.ttl_seconds = ttl_hours * 3600
+        self._conn = None
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self):
+        return bool(self.db_path)
+
+    def _connect(self):
+        if self._conn is None:
+            os.makedirs(os.path.dirname(os.path.abspath(self.db_path)), exist_ok=True)
+            # Nhiều sandbox runner có thể ghi cùng lúc → chờ lock thay vì lỗi ngay
+            self._conn = sqlite3.connect(self.db_path, timeout=30, check_same_thread=False)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("PRAGMA synchronous=NORMAL")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS result_journal ("
+                " submission_id TEXT NOT NULL, result_key TEXT NOT NULL,"
+                " result TEXT NOT NULL, created_at REAL NOT NULL)"
+            )
+            self._conn.execute(
+                "CREATE INDEX IF NOT EXISTS ix_result_journal_submission ON result_journal (submission_id)"
+            )
+            self._conn.commit()
+        return self._conn
+
+    def append(self, submission_id, result_key, result):
+        """Ghi kết quả 1 testcase (commit ngay)"""
+        with self._lock:
+            conn = self._connect()
+            conn.execute(
+                "INSERT INTO result_journal VALUES (?, ?, ?, ?)",
+                (str(submission_id), result_key, json.dumps(result), time.time())
+            )
+            conn.commit()
+
+    def load(self, submission_id):
+        """Trả về {result_key: result} đã ghi cho submission"""
+        with self._lock:
+            conn = self._connect()
+            rows = conn.execute(
+                "SELECT result_key, result FROM result_journal WHERE submission_id = ? ORDER BY created_at",
+                (str(submission_id),)
+            ).fetchall()
+            return {key: json.loads(result) for key, result in rows}
+
+    def clear(self, submission_id):
+        """Xoá journal của submission đã hoàn tất, đồng thời dọn entry quá hạn"""
+        with self._lock:
+            conn = self._connect()
+            conn.execute("DELETE FROM result_journal WHERE submission_id = ?", (str(submission_id),))
+            if self.ttl_seconds > 0:
+                conn.execute(
+                    "DELETE FROM result_journal WHERE created_at < ?",
+                    (time.time() - self.ttl_seconds,)
+                )
+            conn.commit()
@@ -0,0 +1,133 @@
+"""
+Result Publisher - Publish kết quả trên channel riêng (publisher confirms), gom batch và retry có backoff
+Worker chỉ đưa message vào hàng đợi rồi nhận slot mới; message nguồn được ACK khi kết quả đã được broker confirm.
+"""
+import asyncio
+import os
+import time
+
+import aio_pika
+from pamqp.commands import Basic
+
+from metrics import PUBLISH_TIME, PUBLISH_FAILURES
+
+# Số channel dùng để publish (message cùng correlation_id luôn đi cùng 1 channel để giữ thứ tự)
+PUBLISHER_CHANNELS = max(1, int(os.getenv("PUBLISHER_CHANNELS", "2")))
+# Số message tối đa publish cùng lúc trên 1 channel trước khi chờ confirm
+PUBLISH_BATCH_SIZE = max(1, int(os.getenv("PUBLISH_BATCH_SIZE", "50")))
+# Số lần retry publish thất bại (backoff PUBLISH_RETRY_BASE_DELAY × 2^n, tối đa PUBLISH_RETRY_MAX_DELAY)
+PUBLISH_MAX_RETRIES = int(os.getenv("PUBLISH_MAX_RETRIES", "5"))
+PUBLISH_RETRY_BASE_DELAY = float(os.getenv("PUBLISH_RETRY_BASE_DELAY", "0.5"))
+PUBLISH_RETRY_MAX_DELAY = float(os.getenv("PUBLISH_RETRY_MAX_DELAY", "30"))
+
+
+class _Outbound:
+    __slots__ = ("message", "routing_key", "retries", "attempt", "future", "queued_at")
+
+    def __init__(self, message, routing_key, retries, future):
+        self.message = message
+        self.routing_key = routing_key
+        self.retries = retries
+        self.attempt = 0
+        self.future = future
+        self.queued_at = time.monotonic()
+
+
+class ResultPublisher:
+    """
+    Publisher dùng chung cho consumer.
+
+    publish() trả về Future: True khi broker đã confirm, False khi hết lượt retry.
+    """
+
+    def __init__(self, connection, channels=PUBLISHER_CHANNELS, batch_size=PUBLISH_BATCH_SIZE,
+                 max_retries=PUBLISH_MAX_RETRIES):
+        self.connection = connection
+        self.channel_count = channels
+        self.batch_size = batch_size
+        self.max_retries = max_retries
+        self._channels = []
+        self._queues = []
+        self._tasks = []
+        self._unresolved = set()
+        self.published = 0
+        self.retried = 0
+        self.failed = 0
+
+    async def start(self):
+        for i in range(self.channel_count):
+            self._channels.append(await self.connection.channel(publisher_confirms=True))
+            self._queues.append(asyncio.Queue())
+            self._tasks.append(asyncio.create_task(self._sender_loop(i)))
+
+    def publish(self, message: aio_pika.Message, routing_key, retries=None):
+        """
+        Đưa message vào hàng đợi publish (không chờ).
+
+        Args:
+            message: aio_pika.Message
+            routing_key: Queue đích (default exchange)
+            retries: Số lần retry (mặc định max_retries; 0 cho message best-effort như progress)
+        """
+        future = asyncio.get_running_loop().create_future()
+        item = _Outbound(message, routing_key, self.max_retries if retries is None else retries, future)
+        self._unresolved.add(future)
+        future.add_done_callback(self._unresolved.discard)
+        index = hash(message.correlation_id or routing_key) % self.channel_count
+        self._queues[index].put_nowait(item)
+        return future
+
+    async def _sender_loop(self, index):
+        queue = self._queues[index]
+        while True:
+            batch = [await queue.get()]
+            while len(batch) < self.batch_size and not queue.empty():
+                batch.append(queue.get_nowait())
+
+            exchange = self._channels[index].default_exchange
+            # Publish cả batch rồi chờ confirm cùng lúc
+            confirms = await asyncio.gather(
+                *(exchange.publish(item.message, routing_key=item.routing_key) for item in batch),
+                return_exceptions=True
+            )
+            for item, confirm in zip(batch, confirms):
+                if isinstance(confirm, asyncio.CancelledError):
+                    raise confirm
+                if isinstance(confirm, Exception) or isinstance(confirm, Basic.Nack):
+                    self._retry_later(index, item, confirm)
+                else:
+                    self.published += 1
+                    PUBLISH_TIME.observe(time.monotonic() - item.queued_at)
+                    if not item.future.done():
+                        item.future.set_result(True)
+
+    def _retry_later(self, index, item, error):
+        if item.attempt >= item.retries:
+            self.failed += 1
+            PUBLISH_FAILURES.inc()
+            print(f"[ERROR] Giving up publishing to {item.routing_key} (CID={item.message.correlation_id}) "
+                  f"after {item.attempt + 1} attempts: {error}")
+            if not item.future.done():
+                item.future.set_result(False)
+            return
+        delay = min(PUBLISH_RETRY_BASE_DELAY * (2 ** item.attempt), PUBLISH_RETRY_MAX_DELAY)
+        item.attempt += 1
+        self.retried += 1
+        print(f"[WARNING] Publish to {item.routing_key} failed ({error}), retry {item.attempt}/{item.retries} in {delay:.1f}s")
+        asyncio.get_running_loop().call_later(delay, self._queues[index].put_nowait, item)
+
+    async def close(self, timeout=10):
+        """Chờ các message còn trong hàng đợi (tối đa timeout giây) rồi đóng channel"""
+        if self._unresolved:
+            await asyncio.wait(list(self._unresolved), timeout=timeout)
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks.clear()
+        for future in list(self._unresolved):
+            if not future.done():
+                future.set_result(False)
+        for channel in self._channels:
+            if not channel.is_closed:
+                await channel.close()
+        self._channels.clear()
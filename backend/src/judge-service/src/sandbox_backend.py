@@ -0,0 +1,433 @@
+"""
+Sandbox Backend - Interface chung cho nơi chạy code của thí sinh
+init box → ghi file vào box → chạy lệnh (giới hạn time/memory, ghi meta) → đọc meta → cleanup box.
+
+- IsolateBackend: isolate (cần root + isolate, dùng cho production)
+- LocalProcessBackend: process thường với rlimit, không cần root. Chỉ dùng để dev, benchmark,
+  profiling scheduler/cache trên máy thường - KHÔNG cô lập filesystem/network, không dùng cho code lạ.
+
+Chọn bằng SANDBOX_BACKEND=isolate|local. Cả 2 ghi meta theo format của isolate
+(time, time-wall, max-rss, status, exitcode, exitsig, message) nên executor xử lý như nhau,
+thêm time-user, time-sys, io-read-bytes, io-write-bytes khi đo được (xem resource_usage.py).
+"""
+import asyncio
+import math
+import os
+import resource
+import shutil
+import signal
+import subprocess
+import tempfile
+import threading
+import time
+from abc import ABC, abstractmethod
+from concurrent.futures import ThreadPoolExecutor
+
+SANDBOX_BACKEND = os.getenv("SANDBOX_BACKEND", "isolate").lower()
+# Thư mục chứa box của LocalProcessBackend (mỗi box: <dir>/<box_id>/box như isolate)
+LOCAL_SANDBOX_DIR = os.getenv("LOCAL_SANDBOX_DIR", os.path.join(tempfile.gettempdir(), "judge-sandbox"))
+# Giới hạn kích thước file chương trình được ghi (KB) trong LocalProcessBackend
+LOCAL_SANDBOX_FSIZE_KB = int(os.getenv("LOCAL_SANDBOX_FSIZE_KB", "262144"))
+
+# isolate --cg: giới hạn memory của cả cgroup (--cg-mem), meta có cg-mem (peak) và
+# đọc thêm CPU user/sys + IO từ cgroup của box. Cần isolate cấu hình cgroup (cg_root)
+ISOLATE_CGROUPS = os.getenv("ISOLATE_CGROUPS", "false").lower() == "true"
+# Thư mục chứa cgroup box-<id> của isolate (rỗng = đường dẫn trong /run/isolate/cgroup, như cg_root=auto:)
+ISOLATE_CGROUP_ROOT = os.getenv("ISOLATE_CGROUP_ROOT", "")
+
+MAX_PARALLEL_TESTCASES = int(os.getenv("MAX_PARALLEL_TESTCASES", "4"))
+LOW_PRIORITY_NICE = int(os.getenv("ISOLATE_NICE", "10"))
+ISOLATE_CPU_AFFINITY = os.getenv("ISOLATE_CPU_AFFINITY", "").strip()  # ví dụ: "1-7" hoặc "2,3,4"
+
+# Thread pool for running subprocess commands
+executor = ThreadPoolExecutor(max_workers=MAX_PARALLEL_TESTCASES * 2)
+# Các subprocess (isolate / chương trình trong local box) đang chạy
+_running_procs = set()
+
+
+def _parse_affinity(s: str):
+    cpus = set()
+    for part in s.split(","):
+        part = part.strip()
+        if not part:
+            continue
+        if "-" in part:
+            a, b = part.split("-", 1)
+            cpus.update(range(int(a), int(b) + 1))
+        else:
+            cpus.add(int(part))
+    return sorted(cpus)
+
+def _set_low_priority():
+    try:
+        # Hạ ưu tiên CPU cho process con (giá trị nice lớn hơn = kém ưu tiên hơn)
+        os.nice(LOW_PRIORITY_NICE)
+    except Exception:
+        pass
+    if ISOLATE_CPU_AFFINITY:
+        try:
+            cpus = _parse_affinity(ISOLATE_CPU_AFFINITY)
+            if cpus:
+                os.sched_setaffinity(0, cpus)
+        except Exception:
+            pass
+
+
+async def run_command(cmd, timeout=None, capture_output=False):
+    """
+    Chạy subprocess command trong async context.
+    Process đang chạy được ghi vào _running_procs để có thể dừng khi submission bị huỷ.
+    """
+    loop = asyncio.get_event_loop()
+
+    def _run():
+        proc = subprocess.Popen(
+            cmd,
+            stdout=subprocess.PIPE if capture_output else subprocess.DEVNULL,
+            stderr=subprocess.PIPE if capture_output else subprocess.DEVNULL,
+            preexec_fn=_set_low_priority
+        )
+        _running_procs.add(proc)
+        try:
+            stdout, stderr = proc.communicate(timeout=timeout)
+        except subprocess.TimeoutExpired:
+            proc.kill()
+            proc.communicate()
+            raise
+        finally:
+            _running_procs.discard(proc)
+        return subprocess.CompletedProcess(cmd, proc.returncode, stdout, stderr)
+
+    return await loop.run_in_executor(executor, _run)
+
+
+def terminate_running_commands():
+    """
+    Gửi SIGTERM tới mọi lệnh đang chạy trong sandbox (dùng khi huỷ submission).
+    Isolate tự kill chương trình trong box khi nhận signal, sau đó các khối finally
+    vẫn chạy cleanup để trả box.
+    """
+    for proc in list(_running_procs):
+        try:
+            proc.terminate()
+        except Exception:
+            pass
+
+
+def _isolate_cgroup_root():
+    if ISOLATE_CGROUP_ROOT:
+        return ISOLATE_CGROUP_ROOT
+    try:
+        with open("/run/isolate/cgroup", "r") as f:
+            return f.read().strip()
+    except OSError:
+        return ""
+
+
+def read_cgroup_stats(cgroup_dir):
+    """CPU user/sys (cpu.stat) và byte đọc/ghi (io.stat) của 1 cgroup v2, dạng key meta; thiếu file thì bỏ qua"""
+    stats = {}
+    try:
+        with open(os.path.join(cgroup_dir, "cpu.stat"), "r") as f:
+            cpu = dict(line.split() for line in f if line.strip())
+        stats["time-user"] = f"{int(cpu['user_usec']) / 1e6:.3f}"
+        stats["time-sys"] = f"{int(cpu['system_usec']) / 1e6:.3f}"
+    except (OSError, KeyError, ValueError):
+        pass
+    try:
+        read_bytes = write_bytes = 0
+        with open(os.path.join(cgroup_dir, "io.stat"), "r") as f:
+            for line in f:
+                # "8:0 rbytes=4096 wbytes=0 rios=1 wios=0 dbytes=0 dios=0"
+                fields = dict(p.split("=", 1) for p in line.split()[1:] if "=" in p)
+                read_bytes += int(fields.get("rbytes", 0))
+                write_bytes += int(fields.get("wbytes", 0))
+        stats["io-read-bytes"] = str(read_bytes)
+        stats["io-write-bytes"] = str(write_bytes)
+    except (OSError, ValueError):
+        pass
+    return stats
+
+
+class SandboxBackend(ABC):
+    """
+    Interface của sandbox. Box được đánh số (box id do executor cấp trong dải của process);
+    file trong box nằm ở box_path(box_id) trên host.
+    """
+    name = ""
+    root = ""
+
+    def box_path(self, box_id):
+        return os.path.join(self.root, str(box_id), "box")
+
+    @abstractmethod
+    async def init(self, box_id):
+        """Dọn box cũ (nếu process trước chết giữa chừng) và tạo box rỗng"""
+
+    @abstractmethod
+    async def cleanup(self, box_id):
+        """Xoá box"""
+
+    def stage_file(self, box_id, name, content):
+        """Ghi file text vào box (sync), trả về đường dẫn trên host"""
+        path = os.path.join(self.box_path(box_id), name)
+        with open(path, "w", encoding="utf-8") as f:
+            f.write(content)
+        return path
+
+    @abstractmethod
+    async def run(self, box_id, cmd, stdin=None, stdout=None, stderr=None, time_limit=None,
+                  wall_time=None, memory_kb=None, meta_file=None, full_env=False,
+                  timeout=None, capture_output=False):
+        """
+        Chạy cmd trong box (cwd = box). stdin/stdout/stderr là tên file trong box,
+        time_limit/wall_time tính bằng giây, memory_kb bằng KB, meta ghi theo format isolate.
+        Trả về subprocess.CompletedProcess; returncode != 0 khi chương trình không thoát bình thường.
+        """
+
+    @staticmethod
+    def read_meta(meta_file):
+        """Read isolate meta file (sync)"""
+        meta = {}
+        if os.path.exists(meta_file):
+            with open(meta_file, "r") as f:
+                for line in f:
+                    if ':' in line:
+                        k, v = line.strip().split(':', 1)
+                        meta[k] = v
+        return meta
+
+    def box_ids(self):
+        """Box id đang tồn tại (đã init, chưa cleanup)"""
+        try:
+            return [int(n) for n in os.listdir(self.root) if n.isdigit()]
+        except OSError:
+            return []
+
+
+class IsolateBackend(SandboxBackend):
+    name = "isolate"
+    root = "/var/local/lib/isolate"
+
+    def __init__(self, cgroups=ISOLATE_CGROUPS):
+        self.cgroups = cgroups
+        self._cg = ["--cg"] if cgroups else []
+
+    async def init(self, box_id):
+        await run_command(["isolate", *self._cg, "--box-id", str(box_id), "--cleanup"], timeout=5)
+        await run_command(["isolate", *self._cg, "--box-id", str(box_id), "--init"], timeout=5)
+
+    async def cleanup(self, box_id):
+        await run_command(["isolate", *self._cg, "--box-id", str(box_id), "--cleanup"], timeout=5)
+
+    async def run(self, box_id, cmd, stdin=None, stdout=None, stderr=None, time_limit=None,
+                  wall_time=None, memory_kb=None, meta_file=None, full_env=False,
+                  timeout=None, capture_output=False):
+        isolate_cmd = ["isolate", *self._cg, "--box-id", str(box_id)]
+        if stdin:
+            isolate_cmd.append(f"--stdin={stdin}")
+        if stdout:
+            isolate_cmd.append(f"--stdout={stdout}")
+        if stderr:
+            isolate_cmd.append(f"--stderr={stderr}")
+        if time_limit is not None:
+            isolate_cmd.append(f"--time={time_limit}")
+        if wall_time is not None:
+            isolate_cmd.append(f"--wall-time={wall_time}")
+        if memory_kb is not None:
+            # --cg-mem giới hạn tổng memory của cgroup; --mem giới hạn address space từng process
+            isolate_cmd.append(f"--cg-mem={memory_kb}" if self.cgroups else f"--mem={memory_kb}")
+        isolate_cmd.append("--processes")
+        if full_env:
+            isolate_cmd.append("--full-env")
+        if meta_file:
+            isolate_cmd += ["--meta", meta_file]
+        isolate_cmd += ["--run", "--"] + list(cmd)
+        result = await run_command(isolate_cmd, timeout=timeout, capture_output=capture_output)
+        if self.cgroups and meta_file:
+            # cgroup của box còn tới lúc --cleanup: bổ sung CPU user/sys và IO vào meta
+            await asyncio.get_event_loop().run_in_executor(executor, self._append_cgroup_stats, box_id, meta_file)
+        return result
+
+    @staticmethod
+    def _append_cgroup_stats(box_id, meta_file):
+        root = _isolate_cgroup_root()
+        stats = read_cgroup_stats(os.path.join(root, f"box-{box_id}")) if root else {}
+        if stats and os.path.exists(meta_file):
+            with open(meta_file, "a") as f:
+                f.writelines(f"{k}:{v}\n" for k, v in stats.items())
+
+
+class LocalProcessBackend(SandboxBackend):
+    """
+    Chạy chương trình như process thường của user hiện tại:
+    - CPU time: RLIMIT_CPU (+ so sánh CPU time đo được với time_limit)
+    - Wall time: kill cả process group khi quá hạn
+    - Memory: RLIMIT_AS (virtual memory, chặt hơn cgroup memory của isolate)
+    - max-rss/CPU time lấy từ rusage của đúng process con (os.wait4)
+    """
+    name = "local"
+
+    def __init__(self, root=LOCAL_SANDBOX_DIR):
+        self.root = root
+
+    async def init(self, box_id):
+        path = self.box_path(box_id)
+        await asyncio.get_event_loop().run_in_executor(executor, self._reset_box, path)
+
+    async def cleanup(self, box_id):
+        path = os.path.dirname(self.box_path(box_id))
+        await asyncio.get_event_loop().run_in_executor(executor, shutil.rmtree, path, True)
+
+    @staticmethod
+    def _reset_box(path):
+        shutil.rmtree(os.path.dirname(path), ignore_errors=True)
+        os.makedirs(path)
+
+    async def run(self, box_id, cmd, stdin=None, stdout=None, stderr=None, time_limit=None,
+                  wall_time=None, memory_kb=None, meta_file=None, full_env=False,
+                  timeout=None, capture_output=False):
+        box = self.box_path(box_id)
+        return await asyncio.get_event_loop().run_in_executor(
+            executor, self._run, box, list(cmd), stdin, stdout, stderr,
+            time_limit, wall_time or timeout, memory_kb, meta_file, full_env, capture_output
+        )
+
+    @staticmethod
+    def _limits(time_limit, memory_kb):
+        def _apply():
+            _set_low_priority()
+            resource.setrlimit(resource.RLIMIT_CORE, (0, 0))
+            resource.setrlimit(resource.RLIMIT_FSIZE, (LOCAL_SANDBOX_FSIZE_KB * 1024,) * 2)
+            if time_limit is not None:
+                cpu = max(1, math.ceil(float(time_limit)))
+                resource.setrlimit(resource.RLIMIT_CPU, (cpu, cpu + 1))
+            if memory_kb is not None:
+                resource.setrlimit(resource.RLIMIT_AS, (int(memory_kb) * 1024,) * 2)
+        return _apply
+
+    def _run(self, box, cmd, stdin, stdout, stderr, time_limit, wall_time, memory_kb, meta_file,
+             full_env, capture_output):
+        env = dict(os.environ) if full_env else {"PATH": "/usr/local/bin:/usr/bin:/bin", "HOME": box}
+        files = []
+
+        def _open(name, mode, capture=False):
+            if name:
+                f = open(os.path.join(box, name), mode)
+            elif capture:
+                # File tạm thay cho pipe: không cần đọc song song trong lúc chờ wait4
+                f = tempfile.TemporaryFile()
+            else:
+                return subprocess.DEVNULL
+            files.append(f)
+            return f
+
+        started = time.monotonic()
+        try:
+            stdin_f = _open(stdin, "rb")
+            stdout_f = _open(stdout, "wb", capture_output)
+            stderr_f = _open(stderr, "wb", capture_output)
+            proc = subprocess.Popen(
+                cmd, cwd=box, env=env,
+                stdin=stdin_f,
+                stdout=stdout_f,
+                stderr=stderr_f,
+                preexec_fn=self._limits(time_limit, memory_kb),
+                start_new_session=True
+            )
+        except OSError as e:
+            for f in files:
+                f.close()
+            self._write_meta(meta_file, {"status": "XX", "message": f"Cannot execute {cmd[0]}: {e}"})
+            return subprocess.CompletedProcess(cmd, 1, b"", str(e).encode())
+
+        _running_procs.add(proc)
+        wall_killed = threading.Event()
+
+        def _kill_on_wall_time():
+            wall_killed.set()
+            try:
+                os.killpg(proc.pid, signal.SIGKILL)
+            except ProcessLookupError:
+                pass
+
+        timer = threading.Timer(wall_time, _kill_on_wall_time) if wall_time else None
+        if timer:
+            timer.start()
+        try:
+            # wait4 (thay vì Popen.wait) để lấy rusage của đúng process này
+            _, status, usage = os.wait4(proc.pid, 0)
+            proc.returncode = os.waitstatus_to_exitcode(status)
+            out = err = b""
+            if capture_output and not stdout:
+                stdout_f.seek(0)
+                out = stdout_f.read()
+            if capture_output and not stderr:
+                stderr_f.seek(0)
+                err = stderr_f.read()
+        finally:
+            if timer:
+                timer.cancel()
+            _running_procs.discard(proc)
+            # Dọn process cháu còn sót trong group
+            try:
+                os.killpg(proc.pid, signal.SIGKILL)
+            except (ProcessLookupError, PermissionError):
+                pass
+            for f in files:
+                f.close()
+
+        wall = time.monotonic() - started
+        cpu = usage.ru_utime + usage.ru_stime
+        meta = {
+            "time": f"{cpu:.3f}",
+            "time-wall": f"{wall:.3f}",
+            "time-user": f"{usage.ru_utime:.3f}",
+            "time-sys": f"{usage.ru_stime:.3f}",
+            "max-rss": str(usage.ru_maxrss),  # KB trên Linux
+            "csw-voluntary": str(usage.ru_nvcsw),
+            "csw-forced": str(usage.ru_nivcsw),
+            # Block I/O (đơn vị 512 byte), cùng ý nghĩa với rbytes/wbytes của cgroup io.stat
+            "io-read-bytes": str(usage.ru_inblock * 512),
+            "io-write-bytes": str(usage.ru_oublock * 512),
+        }
+        code = proc.returncode
+        if wall_killed.is_set():
+            meta.update(status="TO", killed="1", message="Time limit exceeded (wall clock)")
+        elif time_limit is not None and (
+                cpu > float(time_limit)
+                or (code in (-signal.SIGXCPU, -signal.SIGKILL) and cpu >= math.ceil(float(time_limit)))):
+            meta.update(status="TO", message="Time limit exceeded")
+        elif code < 0:
+            meta.update(status="SG", exitsig=str(-code), message=f"Caught fatal signal {-code}")
+        elif code > 0:
+            meta.update(status="RE", exitcode=str(code), message=f"Exited with error status {code}")
+        else:
+            meta["exitcode"] = "0"
+        self._write_meta(meta_file, meta)
+        return subprocess.CompletedProcess(cmd, 0 if "status" not in meta else 1, out, err)
+
+    @staticmethod
+    def _write_meta(meta_file, meta):
+        if not meta_file:
+            return
+        with open(meta_file, "w") as f:
+            f.writelines(f"{k}:{v}\n" for k, v in meta.items())
+
+
+SANDBOX_BACKENDS = {
+    IsolateBackend.name: IsolateBackend,
+    LocalProcessBackend.name: LocalProcessBackend,
+}
+
+_backend = None
+
+
+def get_backend():
+    """Backend dùng chung trong process (theo SANDBOX_BACKEND)"""
+    global _backend
+    if _backend is None:
+        if SANDBOX_BACKEND not in SANDBOX_BACKENDS:
+            raise ValueError(f"Unknown SANDBOX_BACKEND '{SANDBOX_BACKEND}' (expected: {', '.join(SANDBOX_BACKENDS)})")
+        _backend = SANDBOX_BACKENDS[SANDBOX_BACKEND]()
+    return _backend
@@ -1,20 +1,102 @@
+import os
 import sys
 import json
+import signal
 import asyncio
 from executor_isolate_async import execute_in_sandbox
+from result_journal import ResultJournal
+from sandbox_backend import terminate_running_commands
+from testcase_store import source_hash, result_key
+from progress_reporter import compact_result
+from message_codec import codec_by_name, JsonCodec
+from metrics import REGISTRY
+from tracing import continue_trace
+from profiler import profile_request
+
+# Exit code khi runner bị huỷ bằng SIGTERM (submission bị cancel)
+CANCELLED_EXIT_CODE = 130
 
 async def main():
     """Entry point - chạy async executor"""
-    payload = json.loads(sys.argv[1])
+    # sandbox_runner.py --codec <json|msgpack>: payload đọc từ stdin
+    # sandbox_runner.py '<json>': payload JSON trong argv (cách gọi cũ)
+    stdin_mode = len(sys.argv) > 2 and sys.argv[1] == "--codec"
+    if stdin_mode:
+        codec = codec_by_name(sys.argv[2])
+        payload = codec.loads(sys.stdin.buffer.read())
+    else:
+        codec = JsonCodec
+        payload = json.loads(sys.argv[1])
     language = payload["language"]
     code = payload["code"]
     testcases = payload["testcases"]
     timelimit = payload.get("timelimit", 3)
     memorylimit = payload.get("memorylimit", 256)
+    journal_id = payload.get("journalId")
+    progress_fd = payload.get("progressFd")
+    loop = asyncio.get_running_loop()
+    callbacks = []
+
+    # Ghi journal từng testcase ngay khi chạy xong (để resume nếu process chết)
+    if journal_id:
+        journal = ResultJournal()
+        src_hash = source_hash(language, code)
+
+        async def _journal_result(tc, result):
+            if result.get("status") == "InternalError":
+                return
+            key = result_key(src_hash, tc, timelimit, memorylimit)
+            await loop.run_in_executor(None, journal.append, journal_id, key, result)
+
+        callbacks.append(_journal_result)
+
+    # Progress mode: mỗi testcase xong ghi 1 dòng JSON gọn vào pipe của MessageHandler
+    if progress_fd is not None:
+        progress_pipe = os.fdopen(progress_fd, "w", buffering=1)
+
+        async def _report_progress(tc, result):
+            progress_pipe.write(json.dumps(compact_result(result)) + "\n")
+
+        callbacks.append(_report_progress)
+
+    on_result = None
+    if callbacks:
+        async def on_result(tc, result):
+            for callback in callbacks:
+                await callback(tc, result)
+
+    # Span compile/testcase trong executor là con của span runner (trace context từ payload)
+    with profile_request(payload.get("profile"), "runner"), \
+            continue_trace(payload.get("trace"), "runner.execute", language=language, testcases=len(testcases)) as trace:
+        # Gọi async executor
+        task = asyncio.ensure_future(
+            execute_in_sandbox(language, code, testcases, timelimit, memorylimit, on_result=on_result,
+                               speed_factor=payload.get("speedFactor", 1.0))
+        )
+
+        # SIGTERM: dừng các isolate đang chạy rồi huỷ task (box được cleanup trong finally)
+        def _on_sigterm():
+            terminate_running_commands()
+            task.cancel()
+
+        asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, _on_sigterm)
 
-    # Gọi async executor
-    results = await execute_in_sandbox(language, code, testcases, timelimit, memorylimit)
-    print(json.dumps(results))
+        try:
+            results = await task
+        except asyncio.CancelledError:
+            # Box đã được cleanup trong các khối finally; thoát ngay, không chờ thread pool
+            print("[CANCEL] Sandbox runner cancelled", file=sys.stderr, flush=True)
+            os._exit(CANCELLED_EXIT_CODE)
+    if stdin_mode:
+        # Kèm metric (compile, box init/cleanup, run, compare) và span đã ghi trong runner
+        sys.stdout.buffer.write(codec.dumps({
+            "results": results,
+            "metrics": REGISTRY.dump(),
+            "spans": trace.spans if trace else []
+        }))
+    else:
+        sys.stdout.buffer.write(codec.dumps(results))
+    sys.stdout.flush()
 
 if __name__ == "__main__":
     asyncio.run(main())
@@ -0,0 +1,293 @@
+"""
+Soak Test - Chạy pipeline (consumer + sandbox) nhiều giờ với workload liên tục và phát hiện rò rỉ tài nguyên
+
+Lấy mẫu định kỳ: RSS, số fd đang mở, số thread, số process con (cả cháu) và số box đang dùng
+(box_ids của sandbox backend). Sau warmup, so sánh mức nền (giá trị nhỏ nhất) của 1/4 số mẫu đầu
+và 1/4 số mẫu cuối - mức nền không phụ thuộc số submission đang chạy lúc lấy mẫu:
+tăng vượt ngưỡng cho phép → FAIL (exit code 1). Khi workload dừng và pipeline rảnh,
+process con và box phải về 0 (box không được cleanup, process sandbox mồ côi).
+
+Workload: tổng hợp như benchmark.py (seed mới mỗi vòng) hoặc file traffic đã ghi (--trace, lặp lại).
+
+Ví dụ:
+    SANDBOX_BACKEND=local python3 src/soak_test.py --duration 4h --rate 5 -o soak.json
+    python3 src/soak_test.py --duration 30m --trace traffic.jsonl --speed 5
+"""
+import argparse
+import asyncio
+import contextlib
+import json
+import os
+import sys
+import threading
+import time
+from collections import Counter
+
+# Mức tăng cho phép từ đầu tới cuối test: (tuyệt đối, tương đối)
+DEFAULT_TOLERANCE = {
+    "rss_mb": (32.0, 0.10),
+    "open_fds": (8, 0.0),
+    "threads": (4, 0.0),
+    "children": (2, 0.0),
+    "boxes": (2, 0.0),
+}
+# Chỉ số phải về 0 khi không còn submission nào chạy
+IDLE_ZERO = ("children", "boxes")
+
+
+def parse_duration(s):
+    """'90' / '90s' / '30m' / '4h' → giây"""
+    s = str(s).strip().lower()
+    units = {"s": 1, "m": 60, "h": 3600, "d": 86400}
+    if s and s[-1] in units:
+        return float(s[:-1]) * units[s[-1]]
+    return float(s)
+
+
+def _rss_mb(pid="self"):
+    with open(f"/proc/{pid}/status", "r") as f:
+        for line in f:
+            if line.startswith("VmRSS:"):
+                return int(line.split()[1]) / 1024
+    return 0.0
+
+
+def _descendants(pid):
+    """PID của mọi process con/cháu (theo PPid trong /proc)"""
+    children = {}
+    for entry in os.listdir("/proc"):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f"/proc/{entry}/stat", "r") as f:
+                # comm có thể chứa dấu cách/ngoặc → tách sau ')' cuối cùng
+                ppid = int(f.read().rsplit(")", 1)[1].split()[1])
+        except (OSError, IndexError, ValueError):
+            continue
+        children.setdefault(ppid, []).append(int(entry))
+    result, stack = [], [pid]
+    while stack:
+        for child in children.get(stack.pop(), []):
+            result.append(child)
+            stack.append(child)
+    return result
+
+
+def sample(backend):
+    return {
+        "t": round(time.time(), 3),
+        "rss_mb": round(_rss_mb(), 2),
+        "open_fds": len(os.listdir("/proc/self/fd")),
+        "threads": threading.active_count(),
+        "children": len(_descendants(os.getpid())),
+        "boxes": len(backend.box_ids()),
+    }
+
+
+def _slope_per_hour(samples, key):
+    """Độ dốc hồi quy tuyến tính (đơn vị / giờ)"""
+    if len(samples) < 3:
+        return 0.0
+    xs = [s["t"] for s in samples]
+    ys = [s[key] for s in samples]
+    mean_x, mean_y = sum(xs) / len(xs), sum(ys) / len(ys)
+    var = sum((x - mean_x) ** 2 for x in xs)
+    if not var:
+        return 0.0
+    return sum((x - mean_x) * (y - mean_y) for x, y in zip(xs, ys)) / var * 3600
+
+
+def analyze(samples, idle, tolerance=DEFAULT_TOLERANCE):
+    """
+    Phát hiện xu hướng tăng của từng chỉ số.
+
+    Args:
+        samples: Mẫu lấy trong lúc chạy workload (đã bỏ warmup)
+        idle: Mẫu lấy sau khi workload dừng và mọi submission đã xong
+
+    Returns:
+        (passed, {chỉ số: chi tiết})
+    """
+    report = {}
+    passed = True
+    quarter = max(1, len(samples) // 4)
+    for key, (absolute, relative) in tolerance.items():
+        if not samples:
+            break
+        start = min(s[key] for s in samples[:quarter])
+        end = min(s[key] for s in samples[-quarter:])
+        allowed = absolute + start * relative
+        growth = end - start
+        leak = len(samples) >= 8 and growth > allowed
+        report[key] = {
+            "start": start,
+            "end": end,
+            "max": max(s[key] for s in samples),
+            "growth": round(growth, 2),
+            "allowed": round(allowed, 2),
+            "slope_per_hour": round(_slope_per_hour(samples, key), 2),
+            "leak": leak,
+        }
+        if key in IDLE_ZERO and idle is not None and idle[key] > 0:
+            report[key]["idle"] = idle[key]
+            report[key]["leak"] = leak = True
+        passed = passed and not leak
+    return passed, report
+
+
+def _synthetic_rounds(args):
+    from benchmark import generate_workload
+
+    round_index = 0
+    while True:
+        round_args = argparse.Namespace(**vars(args))
+        round_args.seed = args.seed + round_index
+        round_args.count = max(1, int(args.rate * 60)) if args.rate > 0 else 50
+        yield [(offset, message) for offset, _, message in generate_workload(round_args)]
+        round_index += 1
+
+
+def _trace_rounds(args):
+    from traffic_replay import load_trace, build_message, _schedule
+
+    entries = load_trace(args.trace)
+    if not entries:
+        raise SystemExit(f"[ERROR] No submissions in {args.trace}")
+    while True:
+        yield [(offset, build_message(entry, no_cache=True)) for offset, entry in _schedule(entries, args.speed)]
+
+
+async def soak(args):
+    from benchmark import in_memory_judge
+    from sandbox_backend import get_backend
+
+    backend = get_backend()
+    duration = parse_duration(args.duration)
+    warmup = parse_duration(args.warmup)
+    samples, counters = [], {"submitted": 0, "completed": 0, "errors": 0, "throttled": 0}
+    error_codes = Counter()
+    started = time.monotonic()
+    deadline = started + duration
+
+    async def sampler():
+        while True:
+            point = sample(backend)
+            point["elapsed_s"] = round(time.monotonic() - started, 1)
+            point["completed"] = counters["completed"]
+            samples.append(point)
+            if args.progress:
+                print(f"[i] {point['elapsed_s']:>8.0f}s rss={point['rss_mb']:.1f}MB fds={point['open_fds']} "
+                      f"threads={point['threads']} children={point['children']} boxes={point['boxes']} "
+                      f"done={point['completed']}", file=sys.__stdout__, flush=True)
+            await asyncio.sleep(args.interval)
+
+    async with in_memory_judge() as judge:
+        async def submit(item):
+            counters["submitted"] += 1
+            try:
+                if isinstance(item, tuple):  # (body, properties) từ trace
+                    response, _ = await judge(item[0], **item[1])
+                else:
+                    response, _ = await judge(json.dumps(item).encode(), content_type="application/json")
+                if response.get("ErrorCode") not in ("Passed", "Failed"):
+                    counters["errors"] += 1
+                    error_codes[str(response.get("ErrorCode"))] += 1
+            finally:
+                counters["completed"] += 1
+
+        sampler_task = asyncio.create_task(sampler())
+        rounds = _trace_rounds(args) if args.trace else _synthetic_rounds(args)
+        inflight = set()
+        try:
+            while time.monotonic() < deadline:
+                round_start = time.monotonic()
+                for offset, item in next(rounds):
+                    delay = round_start + offset - time.monotonic()
+                    if delay > 0:
+                        await asyncio.sleep(delay)
+                    # Workload nhanh hơn khả năng chấm: chờ bớt backlog thay vì để hàng đợi tăng mãi
+                    if len(inflight) >= args.max_inflight:
+                        counters["throttled"] += 1
+                        while len(inflight) >= args.max_inflight and time.monotonic() < deadline:
+                            await asyncio.sleep(0.1)
+                    if time.monotonic() >= deadline:
+                        break
+                    task = asyncio.create_task(submit(item))
+                    inflight.add(task)
+                    task.add_done_callback(inflight.discard)
+            await asyncio.gather(*inflight, return_exceptions=True)
+            # Để cleanup/thread pool ổn định rồi mới lấy mẫu lúc rảnh
+            await asyncio.sleep(args.idle_wait)
+            idle = sample(backend)
+        finally:
+            sampler_task.cancel()
+            await asyncio.gather(sampler_task, return_exceptions=True)
+
+    measured = [s for s in samples if s["elapsed_s"] >= warmup and s["t"] <= idle["t"]]
+    passed, metrics = analyze(measured, idle)
+    return {
+        "passed": passed,
+        "duration_s": round(time.monotonic() - started, 1),
+        "config": {k: v for k, v in vars(args).items() if k not in ("output", "verbose", "progress")},
+        "sandbox_backend": os.getenv("SANDBOX_BACKEND", "isolate"),
+        **counters,
+        "error_codes": dict(error_codes),
+        "idle": idle,
+        "metrics": metrics,
+        "samples": samples,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Soak test: run the judge pipeline for hours and detect leaks")
+    parser.add_argument("--duration", default="1h", help="Test length (e.g. 90s, 30m, 4h)")
+    parser.add_argument("--warmup", default="5m", help="Samples before this are ignored (caches, pools filling up)")
+    parser.add_argument("--interval", type=float, default=30, help="Sampling interval (seconds)")
+    parser.add_argument("--idle-wait", type=float, default=10, help="Seconds to wait after the last submission")
+    parser.add_argument("--max-inflight", type=int, default=50,
+                        help="Pause arrivals while this many submissions are unanswered")
+    parser.add_argument("--trace", help="Replay this recorded traffic file in a loop instead of synthetic load")
+    parser.add_argument("--speed", type=float, default=1.0, help="Replay speed for --trace")
+    # Workload tổng hợp (cùng ý nghĩa với benchmark.py)
+    parser.add_argument("--rate", type=float, default=2, help="Synthetic submissions/s")
+    parser.add_argument("--arrival", choices=("poisson", "uniform"), default="poisson")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--languages", default="python=0.6,cpp=0.4")
+    parser.add_argument("--testcases", default="3-10")
+    parser.add_argument("--output-bytes", type=int, default=1000)
+    parser.add_argument("--tle-ratio", type=float, default=0.05)
+    parser.add_argument("--wa-ratio", type=float, default=0.15)
+    parser.add_argument("--timelimit", type=int, default=1)
+    parser.add_argument("--memorylimit", type=int, default=262144)
+    parser.add_argument("-o", "--output", help="Write report with all samples (JSON)")
+    parser.add_argument("-q", "--quiet", dest="progress", action="store_false", help="Do not print samples")
+    parser.add_argument("-v", "--verbose", action="store_true", help="Show consumer logs")
+    args = parser.parse_args()
+
+    os.environ.setdefault("LATENCY_LOG_INTERVAL", "0")
+    if not args.verbose:
+        import logging
+        logging.disable(logging.INFO)
+
+    if args.verbose:
+        report = asyncio.run(soak(args))
+    else:
+        with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+            report = asyncio.run(soak(args))
+
+    print(f"{'[✓] PASSED' if report['passed'] else '[ERROR] FAILED'}: {report['completed']} submissions "
+          f"in {report['duration_s']:.0f}s ({report['errors']} errors {report['error_codes'] or ''}, "
+          f"throttled {report['throttled']} times)")
+    for key, m in report["metrics"].items():
+        print(f"  {'LEAK' if m['leak'] else 'ok  '} {key:<9} {m['start']:>9} → {m['end']:<9} "
+              f"(growth {m['growth']:+}, allowed {m['allowed']}, {m['slope_per_hour']:+}/h"
+              + (f", {m['idle']} left when idle" if "idle" in m else "") + ")")
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+        print(f"Report written to {args.output}")
+    sys.exit(0 if report["passed"] else 1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,169 @@
+"""
+Submission Spool - Parse submission lớn theo từng testcase và ghi input/output ra file
+Thay vì giữ toàn bộ testcase trong dict (rồi dump lại thành payload cho sandbox runner),
+mỗi testcase được decode xong là ghi ngay vào thư mục spool; data chỉ còn metadata:
+    {"TestCaseId", "IndexNo", "InputFile", "OutputFile", "InputHash", "ContentHash"}
+Executor đọc file khi chạy từng testcase.
+"""
+import hashlib
+import json
+import os
+import re
+import shutil
+import time
+import uuid
+
+from message_codec import MsgpackCodec, msgpack
+from testcase_store import JUDGE_DATA_DIR
+
+# Thư mục spool (mỗi submission 1 thư mục con, xoá khi chấm xong)
+SPOOL_DIR = os.getenv("SPOOL_DIR", os.path.join(JUDGE_DATA_DIR, "spool"))
+# Body lớn hơn N byte thì parse kiểu spool (0 = tắt)
+SPOOL_MIN_BYTES = int(os.getenv("SPOOL_MIN_BYTES", str(1024 * 1024)))
+# Thư mục spool bị bỏ lại (process chết giữa chừng) bị xoá sau N giờ
+SPOOL_STALE_HOURS = float(os.getenv("SPOOL_STALE_HOURS", "6"))
+# Quét thư mục spool bị bỏ lại tối đa 1 lần mỗi N giây (khi tạo thư mục spool mới)
+SPOOL_CLEANUP_INTERVAL = float(os.getenv("SPOOL_CLEANUP_INTERVAL", "600"))
+
+_TESTCASE_KEYS = ("Testcases", "testcases")
+_WHITESPACE = re.compile(r"[ \t\n\r]*")
+_decoder = json.JSONDecoder()
+_last_cleanup = None
+
+
+def should_spool(body):
+    return SPOOL_MIN_BYTES > 0 and len(body) >= SPOOL_MIN_BYTES
+
+
+def new_spool_dir():
+    """Tạo thư mục spool cho 1 submission (raise OSError nếu SPOOL_DIR không ghi được)"""
+    global _last_cleanup
+    now = time.monotonic()
+    if _last_cleanup is None or now - _last_cleanup >= SPOOL_CLEANUP_INTERVAL:
+        _last_cleanup = now
+        remove_stale_spools()
+    path = os.path.join(SPOOL_DIR, uuid.uuid4().hex)
+    os.makedirs(path)
+    return path
+
+
+def remove_spool(spool_dir):
+    shutil.rmtree(spool_dir, ignore_errors=True)
+
+
+def remove_stale_spools(max_age_hours=SPOOL_STALE_HOURS):
+    try:
+        names = os.listdir(SPOOL_DIR)
+    except OSError:
+        return
+    cutoff = time.time() - max_age_hours * 3600
+    for name in names:
+        path = os.path.join(SPOOL_DIR, name)
+        try:
+            if os.path.getmtime(path) < cutoff:
+                shutil.rmtree(path, ignore_errors=True)
+        except OSError:
+            continue
+
+
+def parse_spooled(body, codec, spool_dir):
+    """
+    Parse body (JSON hoặc MessagePack), ghi testcase ra spool_dir.
+    Raise ValueError nếu body không hợp lệ, OSError nếu không ghi được file spool.
+    """
+    try:
+        if codec is MsgpackCodec:
+            return _parse_msgpack(body, spool_dir)
+        return _parse_json(body.decode("utf-8"), spool_dir)
+    except (ValueError, OSError):
+        raise
+    except Exception as e:
+        raise ValueError(f"Invalid submission body: {e}")
+
+
+def _spool_testcase(tc, spool_dir, position):
+    """Ghi input/expected output của 1 testcase ra file, trả về metadata"""
+    if not isinstance(tc, dict):
+        raise ValueError("testcase is not an object")
+    # Giống executor: input/output được strip trước khi ghi và so sánh
+    input_ref = str(tc.pop("InputRef", None) or tc.pop("inputRef", "") or "").strip()
+    output_ref = str(tc.pop("OutputRef", None) or tc.pop("outputRef", "") or "").strip()
+    input_file = os.path.join(spool_dir, f"{position}.in")
+    output_file = os.path.join(spool_dir, f"{position}.out")
+    with open(input_file, "w", encoding="utf-8") as f:
+        f.write(input_ref)
+    with open(output_file, "w", encoding="utf-8") as f:
+        f.write(output_ref)
+    tc["InputFile"] = input_file
+    tc["OutputFile"] = output_file
+    tc["InputHash"] = hashlib.sha256(input_ref.encode("utf-8")).hexdigest()
+    tc["ContentHash"] = hashlib.sha256(f"{input_ref}\0{output_ref}".encode("utf-8")).hexdigest()
+    return tc
+
+
+def _skip(text, pos):
+    return _WHITESPACE.match(text, pos).end()
+
+
+def _expect(text, pos, char):
+    if pos >= len(text) or text[pos] != char:
+        raise ValueError(f"Expected '{char}' at position {pos}")
+    return _skip(text, pos + 1)
+
+
+def _parse_json(text, spool_dir):
+    """Object ngoài cùng được duyệt từng key; mảng Testcases được decode từng phần tử"""
+    pos = _expect(text, _skip(text, 0), "{")
+    data = {}
+    if text.startswith("}", pos):
+        return data
+    while True:
+        key, pos = _decoder.raw_decode(text, pos)
+        if not isinstance(key, str):
+            raise ValueError(f"Expected string key at position {pos}")
+        pos = _expect(text, _skip(text, pos), ":")
+        if key in _TESTCASE_KEYS and text.startswith("[", pos):
+            data[key], pos = _parse_testcase_array(text, pos, spool_dir)
+        else:
+            data[key], pos = _decoder.raw_decode(text, pos)
+        pos = _skip(text, pos)
+        if text.startswith(",", pos):
+            pos = _skip(text, pos + 1)
+        elif text.startswith("}", pos):
+            break
+        else:
+            raise ValueError(f"Expected ',' or '}}' at position {pos}")
+    if _skip(text, pos + 1) != len(text):
+        raise ValueError("Extra data after JSON object")
+    return data
+
+
+def _parse_testcase_array(text, pos, spool_dir):
+    pos = _expect(text, pos, "[")
+    testcases = []
+    if text.startswith("]", pos):
+        return testcases, pos + 1
+    while True:
+        tc, pos = _decoder.raw_decode(text, pos)
+        testcases.append(_spool_testcase(tc, spool_dir, len(testcases)))
+        pos = _skip(text, pos)
+        if text.startswith(",", pos):
+            pos = _skip(text, pos + 1)
+        elif text.startswith("]", pos):
+            return testcases, pos + 1
+        else:
+            raise ValueError(f"Expected ',' or ']' at position {pos}")
+
+
+def _parse_msgpack(body, spool_dir):
+    unpacker = msgpack.Unpacker(raw=False, max_buffer_size=max(len(body), 1))
+    unpacker.feed(body)
+    data = {}
+    for _ in range(unpacker.read_map_header()):
+        key = unpacker.unpack()
+        if key in _TESTCASE_KEYS:
+            count = unpacker.read_array_header()
+            data[key] = [_spool_testcase(unpacker.unpack(), spool_dir, i) for i in range(count)]
+        else:
+            data[key] = unpacker.unpack()
+    return data
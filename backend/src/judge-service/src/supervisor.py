@@ -0,0 +1,210 @@
+"""
+Consumer Supervisor - Chạy N consumer process song song để dùng nhiều core
+Mỗi process có connection RabbitMQ, event loop, số slot và dải isolate box id riêng.
+Supervisor theo dõi heartbeat, restart process bị crash/treo và shutdown đồng bộ khi nhận SIGTERM/SIGINT.
+"""
+import asyncio
+import os
+import signal
+import sys
+import tempfile
+import time
+
+# Số consumer process (1 = chạy trực tiếp trong main.py, không có supervisor)
+CONSUMER_PROCESSES = int(os.getenv("CONSUMER_PROCESSES", "1"))
+# Consumer không cập nhật heartbeat trong N giây bị coi là treo và bị kill
+CONSUMER_HEARTBEAT_TIMEOUT = float(os.getenv("CONSUMER_HEARTBEAT_TIMEOUT", "60"))
+# Backoff khi restart process crash liên tục (giây, nhân đôi tới mức tối đa)
+RESTART_BACKOFF_MAX = float(os.getenv("RESTART_BACKOFF_MAX", "30"))
+SHUTDOWN_GRACE_SECONDS = float(os.getenv("SHUTDOWN_GRACE_SECONDS", "60"))
+# Consumer drain: SHUTDOWN_GRACE_SECONDS, rồi SIGTERM runner còn chạy và chờ thêm CANCEL_GRACE_SECONDS
+CANCEL_GRACE_SECONDS = float(os.getenv("CANCEL_GRACE_SECONDS", "10"))
+# Thời gian thêm cho consumer settle/publish kết quả và đóng connection trước khi bị SIGKILL
+SHUTDOWN_KILL_MARGIN = float(os.getenv("SHUTDOWN_KILL_MARGIN", "30"))
+
+MAIN_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "main.py")
+# Process chạy ổn định lâu hơn mức này thì reset backoff
+_STABLE_SECONDS = 60
+
+
+def shutdown_timeout():
+    """Thời gian chờ 1 consumer drain xong sau SIGTERM"""
+    return SHUTDOWN_GRACE_SECONDS + CANCEL_GRACE_SECONDS + SHUTDOWN_KILL_MARGIN
+
+
+def kill_group(proc):
+    """SIGKILL cả process group của consumer (kể cả sandbox runner con còn sống)"""
+    try:
+        os.killpg(proc.pid, signal.SIGKILL)
+    except (ProcessLookupError, PermissionError):
+        pass
+
+
+def split_evenly(total, parts):
+    """Chia total thành `parts` phần chênh nhau tối đa 1, mỗi phần ít nhất 1"""
+    return [max(1, total // parts + (1 if i < total % parts else 0)) for i in range(parts)]
+
+
+class ConsumerSupervisor:
+    """
+    Quản lý N consumer process (python3 main.py với CONSUMER_PROCESSES=1).
+
+    Args:
+        processes: Số consumer process
+        heartbeat_timeout: Giây không có heartbeat trước khi kill process
+    """
+
+    def __init__(self, processes=CONSUMER_PROCESSES, heartbeat_timeout=CONSUMER_HEARTBEAT_TIMEOUT):
+        self.processes = max(1, processes)
+        self.heartbeat_timeout = heartbeat_timeout
+        self.heartbeat_dir = tempfile.mkdtemp(prefix="judge-heartbeat-")
+        self._procs = [None] * self.processes
+        self._started_at = [0.0] * self.processes
+        self._backoff = [1.0] * self.processes
+        self._stop_event = asyncio.Event()
+
+    def _worker_env(self, index):
+        """Env cho consumer thứ index: chia slot, prefetch và dải box id"""
+        env = dict(os.environ)
+        total_slots = int(os.getenv("MAX_CONCURRENT_SUBMISSIONS", "4"))
+        box_start = int(os.getenv("ISOLATE_BOX_ID_START", "0"))
+        box_count = int(os.getenv("ISOLATE_BOX_ID_COUNT", "1000"))
+        box_share = max(1, box_count // self.processes)
+
+        env["CONSUMER_PROCESSES"] = "1"
+        env["CONSUMER_INDEX"] = str(index)
+        env["CONSUMER_HEARTBEAT_FILE"] = os.path.join(self.heartbeat_dir, f"consumer-{index}")
+        env["MAX_CONCURRENT_SUBMISSIONS"] = str(split_evenly(total_slots, self.processes)[index])
+        if os.getenv("PREFETCH_COUNT"):
+            env["PREFETCH_COUNT"] = str(split_evenly(int(os.environ["PREFETCH_COUNT"]), self.processes)[index])
+        env["ISOLATE_BOX_ID_START"] = str(box_start + index * box_share)
+        env["ISOLATE_BOX_ID_COUNT"] = str(box_share)
+        env["PYTHONUNBUFFERED"] = "1"
+        # Mỗi consumer có endpoint /metrics riêng: METRICS_PORT + 1 + index
+        metrics_port = int(os.getenv("METRICS_PORT", "0"))
+        if metrics_port > 0:
+            env["METRICS_PORT"] = str(metrics_port + 1 + index)
+        return env
+
+    async def _spawn(self, index):
+        env = self._worker_env(index)
+        # Heartbeat cũ của process trước không được tính cho process mới
+        try:
+            os.remove(env["CONSUMER_HEARTBEAT_FILE"])
+        except FileNotFoundError:
+            pass
+        # Process group riêng: consumer bị kill thì runner của nó bị kill theo (không bị mồ côi)
+        proc = await asyncio.create_subprocess_exec(
+            sys.executable, MAIN_SCRIPT,
+            env=env,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.STDOUT,
+            start_new_session=True
+        )
+        self._procs[index] = proc
+        self._started_at[index] = time.monotonic()
+        asyncio.create_task(self._pipe_output(index, proc))
+        print(f"[✓] Consumer #{index} started (PID={proc.pid}, slots={env['MAX_CONCURRENT_SUBMISSIONS']}, "
+              f"boxes={env['ISOLATE_BOX_ID_START']}+{env['ISOLATE_BOX_ID_COUNT']})")
+
+    @staticmethod
+    async def _pipe_output(index, proc):
+        """In log của consumer kèm prefix để phân biệt các process"""
+        while True:
+            line = await proc.stdout.readline()
+            if not line:
+                break
+            print(f"[#{index}] {line.decode('utf-8', errors='replace').rstrip()}", flush=True)
+
+    def _heartbeat_age(self, index):
+        path = os.path.join(self.heartbeat_dir, f"consumer-{index}")
+        try:
+            return time.time() - os.path.getmtime(path)
+        except FileNotFoundError:
+            # Chưa có heartbeat (đang connect RabbitMQ): tính từ lúc start
+            return time.monotonic() - self._started_at[index]
+
+    async def _monitor(self, index):
+        """Restart consumer khi crash hoặc không còn heartbeat"""
+        while not self._stop_event.is_set():
+            proc = self._procs[index]
+            if proc.returncode is not None:
+                kill_group(proc)  # runner còn sót lại của consumer vừa chết
+                uptime = time.monotonic() - self._started_at[index]
+                if uptime > _STABLE_SECONDS:
+                    self._backoff[index] = 1.0
+                delay = self._backoff[index]
+                self._backoff[index] = min(delay * 2, RESTART_BACKOFF_MAX)
+                print(f"[WARNING] Consumer #{index} exited with code {proc.returncode}, restarting in {delay:.0f}s")
+                try:
+                    await asyncio.wait_for(self._stop_event.wait(), timeout=delay)
+                    return
+                except asyncio.TimeoutError:
+                    await self._spawn(index)
+                continue
+
+            if self._heartbeat_age(index) > self.heartbeat_timeout:
+                print(f"[WARNING] Consumer #{index} (PID={proc.pid}) missed heartbeat "
+                      f"for {self.heartbeat_timeout:.0f}s, killing")
+                kill_group(proc)
+                await proc.wait()
+                continue
+
+            try:
+                await asyncio.wait_for(self._stop_event.wait(), timeout=1)
+            except asyncio.TimeoutError:
+                pass
+
+    def _forward_signal(self, sig):
+        """SIGUSR1 (profiling) gửi tiếp cho mọi consumer process"""
+        for proc in self._procs:
+            if proc is not None and proc.returncode is None:
+                try:
+                    proc.send_signal(sig)
+                except ProcessLookupError:
+                    pass
+
+    def request_stop(self):
+        if not self._stop_event.is_set():
+            print("\n[*] Shutdown requested, stopping all consumers...")
+            self._stop_event.set()
+
+    async def _shutdown(self):
+        """SIGTERM cho mọi consumer (mỗi consumer tự drain), SIGKILL cả process group nếu quá thời gian chờ"""
+        alive = [p for p in self._procs if p is not None and p.returncode is None]
+        for proc in alive:
+            try:
+                proc.send_signal(signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+        if not alive:
+            return
+        _, pending = await asyncio.wait(
+            [asyncio.ensure_future(p.wait()) for p in alive],
+            timeout=shutdown_timeout()
+        )
+        for task in pending:
+            task.cancel()
+        for proc in alive:
+            if proc.returncode is None:
+                print(f"[WARNING] Consumer PID={proc.pid} did not stop in {shutdown_timeout():.0f}s, killing")
+                kill_group(proc)
+                await proc.wait()
+            else:
+                kill_group(proc)
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGTERM, signal.SIGINT):
+            loop.add_signal_handler(sig, self.request_stop)
+        loop.add_signal_handler(signal.SIGUSR1, self._forward_signal, signal.SIGUSR1)
+
+        print(f"[*] Starting {self.processes} consumer processes...")
+        for i in range(self.processes):
+            await self._spawn(i)
+        monitors = [asyncio.create_task(self._monitor(i)) for i in range(self.processes)]
+
+        await self._stop_event.wait()
+        await asyncio.gather(*monitors, return_exceptions=True)
+        await self._shutdown()
+        print("[✓] All consumers stopped.")
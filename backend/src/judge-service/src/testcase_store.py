@@ -0,0 +1,140 @@
+"""
+Testcase Result Store - Lưu kết quả từng testcase để rejudge chỉ chạy lại testcase thay đổi
+Key = (hash source, hash nội dung testcase, limits), lưu trong SQLite.
+Mặc định tắt (bật bằng TESTCASE_RESULT_DB trên node dùng để rejudge). Kích thước được giới hạn:
+xoá theo TTL và số dòng tối đa định kỳ, output/error lưu bị cắt ngắn.
+"""
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+
+# Thư mục dữ liệu cục bộ của judge (SQLite, journal, ...)
+JUDGE_DATA_DIR = os.getenv("JUDGE_DATA_DIR", "/var/local/lib/judge")
+# File SQLite lưu kết quả testcase (rỗng = tắt), ví dụ <JUDGE_DATA_DIR>/testcase_results.db
+TESTCASE_RESULT_DB = os.getenv("TESTCASE_RESULT_DB", "")
+# Xoá kết quả cũ hơn N ngày
+TESTCASE_RESULT_TTL_DAYS = float(os.getenv("TESTCASE_RESULT_TTL_DAYS", "30"))
+# Số kết quả tối đa (xoá cũ nhất trước), 0 = không giới hạn
+TESTCASE_RESULT_MAX_ROWS = int(os.getenv("TESTCASE_RESULT_MAX_ROWS", "500000"))
+# Chu kỳ xoá theo TTL / số dòng (giây) trong process chạy lâu
+TESTCASE_RESULT_PRUNE_INTERVAL = float(os.getenv("TESTCASE_RESULT_PRUNE_INTERVAL", "600"))
+# Số ký tự tối đa của output/error được lưu
+TESTCASE_RESULT_MAX_OUTPUT = int(os.getenv("TESTCASE_RESULT_MAX_OUTPUT", "4096"))
+
+# Các field của result được lưu (testcaseId/indexNo lấy theo testcase hiện tại khi dùng lại)
+_STORED_FIELDS = ("status", "time", "memory", "output", "error", "usage")
+
+
+def source_hash(language, code):
+    return hashlib.sha256(f"{language}\0{code}".encode("utf-8")).hexdigest()
+
+
+def testcase_hash(tc):
+    """Hash nội dung testcase (input + expected output), không phụ thuộc TestCaseId"""
+    if tc.get("ContentHash"):
+        return tc["ContentHash"]  # testcase đã spool ra file (submission_spool)
+    input_ref = str(tc.get("InputRef") or tc.get("inputRef", "")).strip()
+    output_ref = str(tc.get("OutputRef") or tc.get("outputRef", "")).strip()
+    return hashlib.sha256(f"{input_ref}\0{output_ref}".encode("utf-8")).hexdigest()
+
+
+def result_key(src_hash, tc, timelimit, memorylimit):
+    return f"{src_hash}:{testcase_hash(tc)}:{timelimit}:{memorylimit}"
+
+
+def _stored_result(result, max_output=TESTCASE_RESULT_MAX_OUTPUT):
+    """Các field được lưu, output/error dài bị cắt (đánh dấu outputTruncated)"""
+    stored = {f: result.get(f) for f in _STORED_FIELDS}
+    for field in ("output", "error"):
+        value = stored.get(field)
+        if max_output > 0 and isinstance(value, str) and len(value) > max_output:
+            stored[field] = value[:max_output]
+            stored[f"{field}Truncated"] = True
+    return stored
+
+
+class TestcaseResultStore:
+    """
+    Kho kết quả testcase (SQLite). Các method là sync, caller nên gọi qua run_in_executor.
+    """
+
+    def __init__(self, db_path=TESTCASE_RESULT_DB, ttl_days=TESTCASE_RESULT_TTL_DAYS,
+                 max_rows=TESTCASE_RESULT_MAX_ROWS, prune_interval=TESTCASE_RESULT_PRUNE_INTERVAL):
+        self.db_path = db_path
+        self.ttl_seconds = ttl_days * 86400
+        self.max_rows = max_rows
+        self.prune_interval = prune_interval
+        self._conn = None
+        self._lock = threading.Lock()
+        self._pruned_at = 0.0
+
+    @property
+    def enabled(self):
+        return bool(self.db_path)
+
+    def _connect(self):
+        if self._conn is None:
+            os.makedirs(os.path.dirname(os.path.abspath(self.db_path)), exist_ok=True)
+            self._conn = sqlite3.connect(self.db_path, check_same_thread=False)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS testcase_results ("
+                " key TEXT PRIMARY KEY, result TEXT NOT NULL, stored_at REAL NOT NULL)"
+            )
+            self._conn.execute(
+                "CREATE INDEX IF NOT EXISTS testcase_results_stored_at ON testcase_results (stored_at)"
+            )
+            self._prune()
+        return self._conn
+
+    def _prune(self):
+        """Xoá kết quả quá TTL và kết quả cũ nhất vượt max_rows"""
+        self._pruned_at = time.time()
+        if self.ttl_seconds > 0:
+            self._conn.execute(
+                "DELETE FROM testcase_results WHERE stored_at < ?",
+                (self._pruned_at - self.ttl_seconds,)
+            )
+        if self.max_rows > 0:
+            (count,) = self._conn.execute("SELECT COUNT(*) FROM testcase_results").fetchone()
+            if count > self.max_rows:
+                self._conn.execute(
+                    "DELETE FROM testcase_results WHERE key IN ("
+                    " SELECT key FROM testcase_results ORDER BY stored_at LIMIT ?)",
+                    (count - self.max_rows,)
+                )
+        self._conn.commit()
+
+    def load(self, keys):
+        """Trả về {key: result_dict} cho các key đã có kết quả"""
+        if not keys:
+            return {}
+        with self._lock:
+            conn = self._connect()
+            found = {}
+            unique_keys = list(set(keys))
+            # SQLite giới hạn số tham số trong 1 câu lệnh
+            for i in range(0, len(unique_keys), 500):
+                chunk = unique_keys[i:i + 500]
+                rows = conn.execute(
+                    f"SELECT key, result FROM testcase_results WHERE key IN ({','.join('?' * len(chunk))})",
+                    chunk
+                ).fetchall()
+                found.update((key, json.loads(result)) for key, result in rows)
+            return found
+
+    def save(self, items):
+        """Lưu list (key, result_dict)"""
+        if not items:
+            return
+        now = time.time()
+        rows = [(key, json.dumps(_stored_result(result)), now) for key, result in items]
+        with self._lock:
+            conn = self._connect()
+            conn.executemany("INSERT OR REPLACE INTO testcase_results VALUES (?, ?, ?)", rows)
+            conn.commit()
+            if now - self._pruned_at >= self.prune_interval:
+                self._prune()
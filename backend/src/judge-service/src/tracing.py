@@ -0,0 +1,247 @@
+"""
+Tracing - Span cho từng phase của 1 submission (queue wait, parse, runner, compile, box, run, compare...)
+Trace ID đi theo payload sang sandbox runner; runner trả span của nó về cùng kết quả (như metrics).
+Khi trace kết thúc, toàn bộ span được ghi thành 1 dòng OTLP/JSON (ExportTraceServiceRequest) vào TRACE_FILE,
+đọc được bằng OpenTelemetry Collector (receiver otlpjsonfile) hoặc jq.
+
+Ví dụ xem timeline của 1 submission:
+    jq -c '.resourceSpans[].scopeSpans[].spans[] | [.name, ((.endTimeUnixNano|tonumber) - (.startTimeUnixNano|tonumber)) / 1e6]' traces.jsonl
+"""
+import contextvars
+import json
+import os
+import socket
+import time
+from contextlib import contextmanager
+
+# File JSON-lines nhận trace (rỗng = tắt tracing)
+TRACE_FILE = os.getenv("TRACE_FILE", "")
+# Chỉ ghi trace dài hơn N ms (0 = ghi mọi submission)
+TRACE_SLOW_MS = float(os.getenv("TRACE_SLOW_MS", "0"))
+TRACE_SERVICE_NAME = os.getenv("TRACE_SERVICE_NAME", "judge-service")
+
+_SPAN_KIND_INTERNAL = 1
+_STATUS_ERROR = 2
+
+_current = contextvars.ContextVar("judge_trace_span", default=None)
+
+
+def _new_id(nbytes):
+    return os.urandom(nbytes).hex()
+
+
+def _any_value(value):
+    if isinstance(value, bool):
+        return {"boolValue": value}
+    if isinstance(value, int):
+        return {"intValue": str(value)}
+    if isinstance(value, float):
+        return {"doubleValue": value}
+    return {"stringValue": str(value)}
+
+
+def _attributes(values):
+    return [{"key": k, "value": _any_value(v)} for k, v in values.items() if v is not None]
+
+
+class _Trace:
+    __slots__ = ("trace_id", "spans", "root")
+
+    def __init__(self, trace_id=None):
+        self.trace_id = trace_id or _new_id(16)
+        self.spans = []  # span đã kết thúc, dạng OTLP
+        self.root = None
+
+
+class Span:
+    __slots__ = ("trace", "span_id", "parent_id", "name", "start_ns", "attributes", "_token")
+
+    def __init__(self, trace, name, parent_id=None, start_ns=None, attributes=None):
+        self.trace = trace
+        self.span_id = _new_id(8)
+        self.parent_id = parent_id
+        self.name = name
+        self.start_ns = start_ns or time.time_ns()
+        self.attributes = dict(attributes or {})
+        self._token = None
+
+    def set(self, **attributes):
+        self.attributes.update(attributes)
+
+    def end(self, error=None, end_ns=None):
+        if self._token is not None:
+            _current.reset(self._token)
+            self._token = None
+        span = {
+            "traceId": self.trace.trace_id,
+            "spanId": self.span_id,
+            "name": self.name,
+            "kind": _SPAN_KIND_INTERNAL,
+            "startTimeUnixNano": str(self.start_ns),
+            "endTimeUnixNano": str(end_ns or time.time_ns()),
+            "attributes": _attributes(self.attributes),
+        }
+        if self.parent_id:
+            span["parentSpanId"] = self.parent_id
+        if error is not None:
+            span["status"] = {"code": _STATUS_ERROR, "message": str(error)[:500] or type(error).__name__}
+        self.trace.spans.append(span)
+
+
+class _NoopSpan:
+    """Trả về khi không có trace nào đang chạy (tracing tắt, bulk_judge...)"""
+    trace = None
+    span_id = None
+
+    def set(self, **attributes):
+        pass
+
+    def end(self, error=None, end_ns=None):
+        pass
+
+
+_NOOP = _NoopSpan()
+
+
+def start_span(name, **attributes):
+    """
+    Mở span con của span hiện tại và đặt nó làm span hiện tại; gọi span.end() trong cùng task.
+    Không có trace đang chạy → trả về span rỗng.
+    """
+    parent = _current.get()
+    if parent is None:
+        return _NOOP
+    span = Span(parent.trace, name, parent.span_id, attributes=attributes)
+    span._token = _current.set(span)
+    return span
+
+
+@contextmanager
+def span(name, **attributes):
+    current = start_span(name, **attributes)
+    try:
+        yield current
+    except BaseException as e:
+        current.end(error=e)
+        raise
+    else:
+        current.end()
+
+
+def record_span(name, start_ns, end_ns, **attributes):
+    """Ghi span đã xảy ra (ví dụ thời gian chờ trong queue) dưới span hiện tại"""
+    parent = _current.get()
+    if parent is None or start_ns is None or end_ns <= start_ns:
+        return
+    Span(parent.trace, name, parent.span_id, start_ns, attributes).end(end_ns=end_ns)
+
+
+def _parse_traceparent(value):
+    """W3C traceparent (00-<trace id>-<span id>-<flags>) → (trace_id, span_id)"""
+    if isinstance(value, bytes):
+        value = value.decode("ascii", errors="replace")
+    parts = str(value or "").split("-")
+    if len(parts) != 4 or len(parts[1]) != 32 or len(parts[2]) != 16:
+        return None, None
+    return parts[1].lower(), parts[2].lower()
+
+
+@contextmanager
+def start_trace(name, traceparent=None, start_ns=None, **attributes):
+    """
+    Root span của 1 submission. Nếu message có header traceparent thì dùng trace ID của bên gửi.
+    Trace được ghi ra TRACE_FILE khi kết thúc.
+    """
+    if not TRACE_FILE:
+        yield _NOOP
+        return
+    trace_id, parent_id = _parse_traceparent(traceparent)
+    trace = _Trace(trace_id)
+    root = trace.root = Span(trace, name, parent_id, start_ns, attributes)
+    root._token = _current.set(root)
+    error = None
+    try:
+        yield root
+    except BaseException as e:
+        error = e
+        raise
+    finally:
+        end_ns = time.time_ns()
+        root.end(error=error, end_ns=end_ns)
+        if (end_ns - root.start_ns) / 1e6 >= TRACE_SLOW_MS:
+            _write(trace)
+
+
+@contextmanager
+def continue_trace(context, name, **attributes):
+    """
+    Tiếp tục trace của process cha (sandbox runner). Span chỉ được giữ trong bộ nhớ;
+    process cha lấy về qua trace.spans rồi add_spans().
+    """
+    if not context:
+        yield None
+        return
+    trace = _Trace(context["traceId"])
+    # Từ lúc handler gửi payload tới lúc runner đọc xong: spawn process, import, đọc stdin
+    sent_at = context.get("sentAt")
+    if sent_at:
+        Span(trace, "runner.startup", context.get("spanId"), sent_at).end()
+    root = Span(trace, name, context.get("spanId"), attributes=dict(attributes, pid=os.getpid()))
+    root._token = _current.set(root)
+    try:
+        yield trace
+    except BaseException as e:
+        root.end(error=e)
+        raise
+    else:
+        root.end()
+
+
+def inject():
+    """Trace context để truyền sang process khác (None nếu không có trace)"""
+    current = _current.get()
+    if current is None:
+        return None
+    return {"traceId": current.trace.trace_id, "spanId": current.span_id, "sentAt": time.time_ns()}
+
+
+def add_spans(spans):
+    """Gộp span nhận từ sandbox runner vào trace hiện tại"""
+    current = _current.get()
+    if current is None or not isinstance(spans, list):
+        return
+    current.trace.spans.extend(s for s in spans if isinstance(s, dict) and s.get("traceId") == current.trace.trace_id)
+
+
+def annotate_trace(**attributes):
+    """Thêm attribute cho root span (ví dụ submission_id, biết sau khi parse body)"""
+    current = _current.get()
+    if current is not None and current.trace.root is not None:
+        current.trace.root.set(**attributes)
+
+
+def current_trace_id():
+    current = _current.get()
+    return current.trace.trace_id if current is not None else None
+
+
+def _write(trace):
+    resource = {
+        "service.name": TRACE_SERVICE_NAME,
+        "host.name": socket.gethostname(),
+        "process.pid": os.getpid(),
+        "judge.consumer_index": os.getenv("CONSUMER_INDEX"),
+    }
+    line = json.dumps({"resourceSpans": [{
+        "resource": {"attributes": _attributes(resource)},
+        "scopeSpans": [{"scope": {"name": "judge-service"}, "spans": trace.spans}],
+    }]}, separators=(",", ":")) + "\n"
+    try:
+        # O_APPEND + 1 lần write: nhiều consumer process ghi chung 1 file không bị xen dòng
+        fd = os.open(TRACE_FILE, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            os.write(fd, line.encode("utf-8"))
+        finally:
+            os.close(fd)
+    except OSError as e:
+        print(f"[WARNING] Cannot write trace {trace.trace_id} to {TRACE_FILE}: {e}")
@@ -0,0 +1,362 @@
+"""
+Traffic Record/Replay - Ghi lại submission thật (thời điểm tới, kích thước, header, body) để replay khi đo hiệu năng
+
+Ghi (trong consumer): TRAFFIC_RECORD_FILE=/var/log/judge/traffic.jsonl
+    Mỗi submission 1 dòng JSON (lần nhận đầu tiên, không tính retry/redeliver), body nén zstd/gzip.
+    TRAFFIC_RECORD_REDACT=code,testcases,users thay nội dung bằng hash + độ dài:
+    replay dùng chương trình "cat" và testcase cùng kích thước, giữ nguyên thời điểm tới,
+    ngôn ngữ, số testcase và kích thước dữ liệu (verdict không còn giống bản gốc).
+
+Replay (giữ khoảng cách thời gian giữa các submission, chia cho --speed):
+    SANDBOX_BACKEND=local python3 src/traffic_replay.py traffic.jsonl --speed 2 -o replay.json
+    python3 src/traffic_replay.py traffic.jsonl --speed 10 --target rabbitmq
+"""
+import argparse
+import asyncio
+import base64
+import hashlib
+import json
+import os
+import sys
+import threading
+import time
+import uuid
+from collections import Counter
+
+from message_codec import (
+    MESSAGE_COMPRESSION, supported_encodings, decompress_body, compress_body, encode_reply, get_codec
+)
+
+# File JSON-lines nhận traffic (rỗng = không ghi)
+TRAFFIC_RECORD_FILE = os.getenv("TRAFFIC_RECORD_FILE", "")
+# Field bị che khi ghi: code | testcases | users
+TRAFFIC_RECORD_REDACT = {
+    f.strip().lower() for f in os.getenv("TRAFFIC_RECORD_REDACT", "").split(",") if f.strip()
+}
+# Ngừng ghi khi file vượt quá N MB (0 = không giới hạn)
+TRAFFIC_RECORD_MAX_MB = float(os.getenv("TRAFFIC_RECORD_MAX_MB", "1024"))
+
+TRACE_FORMAT_VERSION = 1
+# Header được ghi lại (ảnh hưởng tới priority, fair-share, supersede, nén reply)
+_RECORDED_HEADERS = ("x-user-id", "x-user-class", "x-problem-id", "x-priority", "x-accept-encoding")
+_REDACTED = "$redacted"
+
+# Chương trình thay cho code đã bị che: in lại input (expected output = input)
+CAT_PROGRAMS = {
+    "python": ("import sys\nsys.stdout.write(sys.stdin.read())\n", "#"),
+    "cpp": ("#include <cstdio>\nint main(){int c;while((c=getchar())!=EOF)putchar(c);}\n", "//"),
+}
+
+
+def _placeholder(value):
+    data = value.encode("utf-8")
+    return {_REDACTED: hashlib.sha256(data).hexdigest()[:16], "len": len(data)}
+
+
+def _is_placeholder(value):
+    return isinstance(value, dict) and _REDACTED in value
+
+
+def redact(data, headers, fields):
+    """Che Code / input-output testcase / user id (tại chỗ)"""
+    if "code" in fields and isinstance(data.get("Code"), str):
+        data["Code"] = _placeholder(data["Code"])
+    if "testcases" in fields:
+        for tc in data.get("Testcases") or []:
+            for key in ("InputRef", "inputRef", "OutputRef", "outputRef"):
+                if isinstance(tc.get(key), str):
+                    tc[key] = _placeholder(tc[key])
+    if "users" in fields:
+        for key in ("UserId", "userId"):
+            if data.get(key) is not None:
+                data[key] = _placeholder(str(data[key]))[_REDACTED]
+        if headers.get("x-user-id"):
+            headers["x-user-id"] = _placeholder(str(headers["x-user-id"]))[_REDACTED]
+
+
+class TrafficRecorder:
+    """Ghi submission nhận được vào file JSON-lines (ghi trong thread pool, không chặn event loop)"""
+
+    def __init__(self, path=TRAFFIC_RECORD_FILE, redact_fields=TRAFFIC_RECORD_REDACT,
+                 max_bytes=TRAFFIC_RECORD_MAX_MB * 1024 * 1024):
+        self.path = path
+        self.redact_fields = redact_fields
+        self.max_bytes = max_bytes
+        self.enabled = bool(path)
+        self._lock = threading.Lock()
+        self._storage_encoding = next((e for e in MESSAGE_COMPRESSION if e in supported_encodings()), None)
+
+    def record(self, message):
+        """Gọi trong _message_callback; bỏ qua message redeliver/retry (không phải traffic mới)"""
+        if not self.enabled or message.redelivered:
+            return
+        headers = dict(message.headers or {})
+        if headers.get("x-retry-count") or headers.get("x-deferred-count"):
+            return
+        received_at = time.time()
+        asyncio.get_running_loop().run_in_executor(
+            None, self._write, received_at, message.body, headers,
+            message.content_type, message.content_encoding, message.priority
+        )
+
+    def _entry(self, received_at, body, headers, content_type, content_encoding, priority):
+        headers = {
+            k: v.decode("utf-8", errors="replace") if isinstance(v, bytes) else v
+            for k, v in headers.items() if k in _RECORDED_HEADERS
+        }
+        raw = decompress_body(body, content_encoding)
+        if self.redact_fields:
+            codec = get_codec(content_type)
+            data = codec.loads(raw)
+            redact(data, headers, self.redact_fields)
+            raw = codec.dumps(data)
+        stored, body_encoding = encode_reply(raw, self._storage_encoding)
+        return {
+            "v": TRACE_FORMAT_VERSION,
+            "t": round(received_at, 6),
+            "size": len(body),
+            "priority": priority,
+            "headers": headers,
+            "content_type": content_type,
+            "content_encoding": content_encoding,
+            "body_encoding": body_encoding,
+            "redacted": sorted(self.redact_fields),
+            "body": base64.b64encode(stored).decode("ascii"),
+        }
+
+    def _write(self, *args):
+        try:
+            line = (json.dumps(self._entry(*args), separators=(",", ":")) + "\n").encode("utf-8")
+            with self._lock:
+                try:
+                    size = os.path.getsize(self.path)
+                except FileNotFoundError:
+                    size = 0
+                if self.max_bytes and size + len(line) > self.max_bytes:
+                    print(f"[WARNING] {self.path} reached TRAFFIC_RECORD_MAX_MB, traffic recording stopped")
+                    self.enabled = False
+                    return
+                # O_APPEND + 1 lần write: nhiều consumer process ghi chung 1 file không bị xen dòng
+                fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o600)
+                try:
+                    os.write(fd, line)
+                finally:
+                    os.close(fd)
+        except Exception as e:
+            print(f"[WARNING] Cannot record submission to {self.path}: {e}")
+
+
+recorder = TrafficRecorder()
+
+
+# ----------------------------------------------------------------------------
+# Replay
+# ----------------------------------------------------------------------------
+def load_trace(path):
+    """Đọc file traffic, sắp theo thời điểm tới"""
+    entries = []
+    with open(path, "r", encoding="utf-8") as f:
+        for line_no, line in enumerate(f, 1):
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                entries.append(json.loads(line))
+            except ValueError:
+                print(f"[WARNING] Skipping malformed line {line_no} in {path}")
+    entries.sort(key=lambda e: e["t"])
+    return entries
+
+
+def _filler(length):
+    """Dữ liệu testcase thay thế có đúng `length` byte"""
+    line = "0123456789" * 7 + "\n"
+    return (line * (length // len(line) + 1))[:length]
+
+
+def _restore(data):
+    """Thay placeholder bằng chương trình cat + testcase cùng kích thước"""
+    code = data.get("Code")
+    if _is_placeholder(code):
+        program, comment = CAT_PROGRAMS.get(data.get("Language"), CAT_PROGRAMS["python"])
+        if data.get("Language") not in CAT_PROGRAMS:
+            data["Language"] = "python"
+        padding = max(0, code["len"] - len(program) - len(comment) - 1)
+        data["Code"] = program + comment + "x" * padding + "\n"
+    for tc in data.get("Testcases") or []:
+        for key in ("InputRef", "inputRef", "OutputRef", "outputRef"):
+            if _is_placeholder(tc.get(key)):
+                tc[key] = _filler(tc[key]["len"])
+        if _is_placeholder(code):
+            # cat in lại input: expected output = input
+            input_key = "InputRef" if "InputRef" in tc else "inputRef"
+            tc["OutputRef" if "OutputRef" in tc else "outputRef"] = tc.get(input_key, "")
+
+
+def build_message(entry, no_cache=False):
+    """Entry trong trace → (body, properties) để publish lại"""
+    raw = decompress_body(base64.b64decode(entry["body"]), entry.get("body_encoding"))
+    if entry.get("redacted") or no_cache:
+        codec = get_codec(entry.get("content_type"))
+        data = codec.loads(raw)
+        _restore(data)
+        if no_cache:
+            data["NoCache"] = True
+        raw = codec.dumps(data)
+    properties = {
+        "headers": dict(entry.get("headers") or {}),
+        "content_type": entry.get("content_type"),
+        "content_encoding": entry.get("content_encoding"),
+        "priority": entry.get("priority"),
+    }
+    return compress_body(raw, entry.get("content_encoding")), properties
+
+
+def _decode_reply(body, content_type, content_encoding):
+    try:
+        return get_codec(content_type).loads(decompress_body(body, content_encoding))
+    except Exception:
+        return {}
+
+
+def _schedule(entries, speed):
+    start = entries[0]["t"] if entries else 0
+    return [((e["t"] - start) / speed, e) for e in entries]
+
+
+async def replay_in_memory(entries, args):
+    """Replay vào AsyncAdaptiveConsumer trong cùng process (InMemoryTransport)"""
+    from benchmark import _paced, in_memory_judge
+
+    async with in_memory_judge() as judge:
+        async def submit(_, entry):
+            body, properties = build_message(entry, args.no_cache)
+            response, seconds = await judge(body, **properties)
+            return response.get("ErrorCode"), seconds
+
+        return await _paced([(offset, None, e) for offset, e in _schedule(entries, args.speed)], submit)
+
+
+async def replay_rabbitmq(entries, args):
+    """Replay vào submission_queue của RabbitMQ (judge node đang chạy), reply về queue tạm"""
+    import aio_pika
+    from benchmark import _paced
+
+    connection = await aio_pika.connect_robust(
+        f"amqp://{os.getenv('RABBITMQ_USER', 'guest')}:{os.getenv('RABBITMQ_PASS', 'guest')}"
+        f"@{os.getenv('RABBITMQ_HOST', 'localhost')}/"
+    )
+    async with connection:
+        channel = await connection.channel()
+        reply_queue = await channel.declare_queue(exclusive=True, auto_delete=True)
+        pending = {}
+
+        async def on_reply(message):
+            future = pending.pop(message.correlation_id, None)
+            if future is not None and not future.done():
+                future.set_result(_decode_reply(message.body, message.content_type, message.content_encoding))
+
+        await reply_queue.consume(on_reply, no_ack=True)
+        submission_queue = os.getenv("SUBMISSION_QUEUE", "submission_queue")
+
+        async def submit(_, entry):
+            body, properties = build_message(entry, args.no_cache)
+            correlation_id = uuid.uuid4().hex
+            future = asyncio.get_running_loop().create_future()
+            pending[correlation_id] = future
+            sent = time.monotonic()
+            await channel.default_exchange.publish(
+                aio_pika.Message(body, reply_to=reply_queue.name, correlation_id=correlation_id,
+                                 delivery_mode=aio_pika.DeliveryMode.PERSISTENT, **properties),
+                routing_key=submission_queue
+            )
+            try:
+                response = await asyncio.wait_for(future, timeout=args.timeout)
+            except asyncio.TimeoutError:
+                pending.pop(correlation_id, None)
+                return "Timeout", time.monotonic() - sent
+            return response.get("ErrorCode"), time.monotonic() - sent
+
+        return await _paced([(offset, None, e) for offset, e in _schedule(entries, args.speed)], submit)
+
+
+def summarize(entries, outcomes, duration, args):
+    from benchmark import percentile
+
+    latencies = [o[1] * 1000 for o in outcomes]
+    span = entries[-1]["t"] - entries[0]["t"] if entries else 0
+    return {
+        "trace": os.path.abspath(args.trace),
+        "target": args.target,
+        "speed": args.speed,
+        "submissions": len(entries),
+        "trace_span_s": round(span, 3),
+        "trace_bytes": sum(e.get("size", 0) for e in entries),
+        "replay_duration_s": round(duration, 3),
+        "offered_sps": round(len(entries) / (span / args.speed), 3) if span else None,
+        "throughput_sps": round(len(outcomes) / duration, 3) if duration else 0.0,
+        "latency_ms": {
+            "p50": round(percentile(latencies, 50), 1),
+            "p95": round(percentile(latencies, 95), 1),
+            "p99": round(percentile(latencies, 99), 1),
+            "max": round(max(latencies), 1) if latencies else 0.0,
+        },
+        "results": dict(Counter(str(o[0]) for o in outcomes)),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay recorded submission traffic into the judge")
+    parser.add_argument("trace", help="Traffic file recorded with TRAFFIC_RECORD_FILE")
+    parser.add_argument("--speed", type=float, default=1.0, help="Time compression (1 = real time, 10 = 10x faster)")
+    parser.add_argument("--target", choices=("inmemory", "rabbitmq"), default="inmemory",
+                        help="inmemory: consumer in this process; rabbitmq: running judge nodes")
+    parser.add_argument("--limit", type=int, default=0, help="Replay only the first N submissions")
+    parser.add_argument("--no-cache", action="store_true", help="Set NoCache so every submission really runs")
+    parser.add_argument("--timeout", type=float, default=600, help="Seconds to wait for each reply (rabbitmq)")
+    parser.add_argument("-o", "--output", help="Write summary (JSON)")
+    parser.add_argument("-v", "--verbose", action="store_true", help="Show consumer logs")
+    args = parser.parse_args()
+    if args.speed <= 0:
+        parser.error("--speed must be > 0")
+
+    entries = load_trace(args.trace)
+    if args.limit:
+        entries = entries[:args.limit]
+    if not entries:
+        print(f"[ERROR] No submissions in {args.trace}")
+        sys.exit(1)
+    print(f"[*] Replaying {len(entries)} submissions at {args.speed:g}x into {args.target}")
+
+    if args.target == "inmemory":
+        os.environ.setdefault("LATENCY_LOG_INTERVAL", "0")
+        # Không ghi lại chính traffic đang replay
+        recorder.enabled = False
+        if not args.verbose:
+            import logging
+            logging.disable(logging.INFO)
+    runner = replay_in_memory if args.target == "inmemory" else replay_rabbitmq
+
+    started = time.monotonic()
+    if args.verbose or args.target == "rabbitmq":
+        outcomes = asyncio.run(runner(entries, args))
+    else:
+        import contextlib
+        with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+            outcomes = asyncio.run(runner(entries, args))
+    summary = summarize(entries, outcomes, time.monotonic() - started, args)
+
+    lat = summary["latency_ms"]
+    print(f"[✓] {len(outcomes)} replies in {summary['replay_duration_s']:.1f}s "
+          f"(trace span {summary['trace_span_s']:.1f}s / {args.speed:g})")
+    print(f"    throughput {summary['throughput_sps']:.2f} submissions/s, "
+          f"latency p50={lat['p50']:.0f}ms p95={lat['p95']:.0f}ms p99={lat['p99']:.0f}ms max={lat['max']:.0f}ms")
+    print(f"    results {summary['results']}")
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(summary, f, indent=2)
+        print(f"[✓] Summary written to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,72 @@
+"""
+Verdict Cache - Cache kết quả chấm cho các submission giống hệt nhau
+Rejudge hoặc code copy-paste cho cùng bộ testcase sẽ trả kết quả cũ mà không chạy sandbox.
+"""
+import hashlib
+import json
+import os
+import time
+from collections import OrderedDict
+
+from testcase_store import testcase_hash
+
+# Số entry tối đa (0 = tắt cache)
+VERDICT_CACHE_SIZE = int(os.getenv("VERDICT_CACHE_SIZE", "1000"))
+# Thời gian sống của 1 entry (giây)
+VERDICT_CACHE_TTL = int(os.getenv("VERDICT_CACHE_TTL", "3600"))
+
+
+def submission_cache_key(language, code, timelimit, memorylimit, testcases):
+    """
+    Hash của (language, source, limits, bộ testcase).
+    Testcase được sort theo IndexNo nên thứ tự trong message không ảnh hưởng.
+    """
+    normalized = sorted(
+        (
+            tc.get("IndexNo", tc.get("indexNo", 0)),
+            str(tc.get("TestCaseId") or tc.get("testcaseId", "")),
+            testcase_hash(tc),
+        )
+        for tc in testcases
+    )
+    raw = json.dumps([language, code, timelimit, memorylimit, normalized], ensure_ascii=False)
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+class VerdictCache:
+    """LRU cache có TTL, lưu kết quả của _process_submission"""
+
+    def __init__(self, max_entries=VERDICT_CACHE_SIZE, ttl_seconds=VERDICT_CACHE_TTL):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self._entries = OrderedDict()  # key -> (stored_at, value)
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def enabled(self):
+        return self.max_entries > 0
+
+    def get(self, key):
+        if not self.enabled:
+            return None
+        entry = self._entries.get(key)
+        if entry is None or time.monotonic() - entry[0] > self.ttl_seconds:
+            if entry is not None:
+                del self._entries[key]
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return entry[1]
+
+    def put(self, key, value):
+        if not self.enabled:
+            return
+        self._entries[key] = (time.monotonic(), value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def __len__(self):
+        return len(self._entries)
@@ -0,0 +1,211 @@
+"""
+Test InMemoryBroker / InMemoryTransport: ack, nack(requeue) + redelivered, prefetch theo consumer,
+x-max-priority, x-message-ttl + dead-letter (delay queue của retry) và fanout.
+
+    python3 -m pytest tests
+"""
+import asyncio
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+from broker_transport import InMemoryBroker, InMemoryTransport  # noqa: E402
+
+
+def run(coro):
+    return asyncio.run(coro)
+
+
+async def settle():
+    """Cho callback của consumer chạy"""
+    for _ in range(5):
+        await asyncio.sleep(0)
+
+
+async def open_consumer(broker, queue_name, prefetch=0, arguments=None):
+    connection = await InMemoryTransport(broker).connect()
+    channel = await connection.channel()
+    await channel.set_qos(prefetch_count=prefetch)
+    queue = await channel.declare_queue(queue_name, durable=True, arguments=arguments)
+    received = []
+
+    async def callback(message):
+        received.append(message)
+
+    await queue.consume(callback)
+    return channel, received
+
+
+def test_ack_removes_message_and_frees_prefetch_slot():
+    async def scenario():
+        broker = InMemoryBroker()
+        _, received = await open_consumer(broker, "q", prefetch=1)
+        broker.publish("q", b"1")
+        broker.publish("q", b"2")
+        await settle()
+        assert [m.body for m in received] == [b"1"]
+        await received[0].ack()
+        await settle()
+        assert [m.body for m in received] == [b"1", b"2"]
+        await received[1].ack()
+        with pytest.raises(RuntimeError):
+            await received[1].ack()
+        return broker.depth("q")
+
+    assert run(scenario()) == 0
+
+
+def test_nack_requeue_redelivers_with_flag():
+    async def scenario():
+        broker = InMemoryBroker()
+        _, received = await open_consumer(broker, "q", prefetch=1)
+        broker.publish("q", b"1", correlation_id="c1")
+        await settle()
+        first = received[0]
+        assert first.redelivered is False
+        await first.nack(requeue=True)
+        await settle()
+        again = received[1]
+        assert again.body == b"1" and again.correlation_id == "c1"
+        assert again.redelivered is True
+        await again.nack(requeue=False)  # không có dead-letter exchange → bỏ
+        await settle()
+        return len(received), broker.depth("q")
+
+    assert run(scenario()) == (2, 0)
+
+
+def test_requeued_message_keeps_its_position():
+    async def scenario():
+        broker = InMemoryBroker()
+        _, received = await open_consumer(broker, "q", prefetch=1)
+        for body in (b"1", b"2"):
+            broker.publish("q", body)
+        await settle()
+        await received[0].nack(requeue=True)
+        await settle()
+        return [m.body for m in received]
+
+    assert run(scenario()) == [b"1", b"1"]
+
+
+def test_prefetch_is_per_consumer():
+    async def scenario():
+        broker = InMemoryBroker()
+        _, a = await open_consumer(broker, "q", prefetch=2)
+        _, b = await open_consumer(broker, "q", prefetch=1)
+        for i in range(5):
+            broker.publish("q", str(i).encode())
+        await settle()
+        counts = (len(a), len(b), broker.depth("q"))
+        await a[0].ack()
+        await settle()
+        return counts, (len(a), len(b), broker.depth("q"))
+
+    assert run(scenario()) == ((2, 1, 2), (3, 1, 1))
+
+
+def test_closing_channel_requeues_unacked_messages():
+    async def scenario():
+        broker = InMemoryBroker()
+        channel, received = await open_consumer(broker, "q", prefetch=2)
+        broker.publish("q", b"1")
+        await settle()
+        await channel.close()
+        message = await broker.get("q", timeout=1)
+        return len(received), message.body, message.redelivered
+
+    assert run(scenario()) == (1, b"1", True)
+
+
+def test_max_priority_orders_messages():
+    async def scenario():
+        broker = InMemoryBroker()
+        broker.declare_queue("q", arguments={"x-max-priority": 5})
+        for body, priority in ((b"low", 0), (b"mid", 3), (b"over", 9), (b"high", 5), (b"none", None)):
+            broker.publish("q", body, priority=priority)
+        return [(await broker.get("q", timeout=1)).body for _ in range(5)]
+
+    # Priority > x-max-priority bị cắt về max; cùng priority thì FIFO
+    assert run(scenario()) == [b"over", b"high", b"mid", b"low", b"none"]
+
+
+def test_priority_ignored_without_max_priority():
+    async def scenario():
+        broker = InMemoryBroker()
+        for body, priority in ((b"a", 0), (b"b", 9)):
+            broker.publish("q", body, priority=priority)
+        return [(await broker.get("q", timeout=1)).body for _ in range(2)]
+
+    assert run(scenario()) == [b"a", b"b"]
+
+
+def test_ttl_dead_letters_into_target_queue():
+    async def scenario():
+        broker = InMemoryBroker()
+        broker.declare_queue("submission_queue")
+        # Giống delay queue của consumer (_retry_queue_name): hết TTL thì quay lại submission_queue
+        broker.declare_queue("submission_queue.retry.50ms", arguments={
+            "x-message-ttl": 50,
+            "x-dead-letter-exchange": "",
+            "x-dead-letter-routing-key": "submission_queue",
+        })
+        broker.publish("submission_queue.retry.50ms", b"1", headers={"x-retry-count": 1}, reply_to="r")
+        assert broker.depth("submission_queue") == 0
+        message = await broker.get("submission_queue", timeout=2)
+        return message, broker.depth("submission_queue.retry.50ms")
+
+    message, retry_depth = run(scenario())
+    assert retry_depth == 0
+    assert message.body == b"1" and message.reply_to == "r"
+    assert message.headers["x-retry-count"] == 1
+    death = message.headers["x-death"][0]
+    assert death["queue"] == "submission_queue.retry.50ms" and death["reason"] == "expired"
+
+
+def test_rejected_message_is_dead_lettered():
+    async def scenario():
+        broker = InMemoryBroker()
+        broker.declare_queue("dlq")
+        _, received = await open_consumer(broker, "q", prefetch=1, arguments={
+            "x-dead-letter-exchange": "", "x-dead-letter-routing-key": "dlq"})
+        broker.publish("q", b"1")
+        await settle()
+        await received[0].nack(requeue=False)
+        return await broker.get("dlq", timeout=1)
+
+    message = run(scenario())
+    assert message.body == b"1"
+    assert message.headers["x-death"][0]["reason"] == "rejected"
+
+
+def test_declare_queue_with_different_arguments_fails():
+    broker = InMemoryBroker()
+    broker.declare_queue("q", arguments={"x-max-priority": 5})
+    with pytest.raises(ValueError):
+        broker.declare_queue("q", arguments={"x-max-priority": 9})
+
+
+def test_fanout_exchange_reaches_every_bound_queue():
+    async def scenario():
+        broker = InMemoryBroker()
+        bodies = []
+        for _ in range(2):
+            connection = await InMemoryTransport(broker).connect()
+            channel = await connection.channel()
+            exchange = await channel.declare_exchange("judge_control", "fanout")
+            queue = await channel.declare_queue(exclusive=True, auto_delete=True)
+            await queue.bind(exchange)
+
+            async def callback(message):
+                bodies.append(message.body)
+
+            await queue.consume(callback, no_ack=True)
+        broker.publish("", b"cancel", exchange="judge_control")
+        await settle()
+        return bodies
+
+    assert run(scenario()) == [b"cancel", b"cancel"]
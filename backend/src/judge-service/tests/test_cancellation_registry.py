@@ -0,0 +1,104 @@
+"""
+Test CancellationRegistry: lệnh huỷ chỉ áp dụng 1 lần và chỉ cho đúng attempt
+(AttemptId, hoặc AMQP timestamp cũ hơn lệnh huỷ khi không có AttemptId).
+
+    python3 -m pytest tests
+"""
+import asyncio
+import os
+import sys
+from datetime import datetime, timezone
+from types import SimpleNamespace
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+import message_handler  # noqa: E402
+from message_handler import CancellationRegistry  # noqa: E402
+
+
+class FakeProc:
+    pid = 4242
+
+    def __init__(self):
+        self.returncode = None
+        self.terminated = False
+
+    def terminate(self):
+        self.terminated = True
+
+    def kill(self):
+        pass
+
+
+def make_registry(monkeypatch, now=1_000_000.0):
+    clock = SimpleNamespace(now=now)
+    monkeypatch.setattr(message_handler.time, "time", lambda: clock.now)
+    return CancellationRegistry(ttl_seconds=3600, clock_skew=5), clock
+
+
+def test_attempt_of_reads_body_header_and_timestamp():
+    published = datetime(2026, 1, 1, tzinfo=timezone.utc)
+    properties = SimpleNamespace(headers={"x-attempt-id": b"a2"}, timestamp=published)
+    assert CancellationRegistry.attempt_of({}, properties) == ("a2", published.timestamp())
+    assert CancellationRegistry.attempt_of({"AttemptId": 7}, SimpleNamespace(headers=None)) == ("7", None)
+    assert CancellationRegistry.attempt_of({}, SimpleNamespace()) == (None, None)
+
+
+def test_cancel_with_attempt_id_applies_only_to_that_attempt(monkeypatch):
+    registry, _ = make_registry(monkeypatch)
+    registry.cancel("s1", "stop", attempt_id="a1")
+    assert registry.pop_reason("s1", ("a2", None)) is None  # rejudge: attempt khác
+    assert registry.pop_reason("s1", (None, None)) is None
+    assert registry.pop_reason("s1", ("a1", None)) == "stop"
+    assert registry.pop_reason("s1", ("a1", None)) is None  # chỉ áp dụng 1 lần
+
+
+def test_cancel_without_attempt_id_ignores_message_without_timestamp(monkeypatch):
+    registry, _ = make_registry(monkeypatch)
+    registry.cancel("s1")
+    assert registry.pop_reason("s1", (None, None)) is None
+    assert not registry.is_cancelled("s1", ("x", None))
+
+
+def test_cancel_without_attempt_id_uses_timestamp_with_skew(monkeypatch):
+    registry, clock = make_registry(monkeypatch)
+    registry.cancel("s1", "stop")
+    cancelled_at = clock.now
+    # Cùng giây / trong khoảng lệch đồng hồ: không chắc message cũ hơn lệnh huỷ → không áp dụng
+    assert registry.pop_reason("s1", (None, float(int(cancelled_at)))) is None
+    assert registry.pop_reason("s1", (None, cancelled_at - 5.5)) is None
+    assert registry.pop_reason("s1", (None, cancelled_at - 6)) == "stop"
+
+
+def test_cancel_expires_after_ttl(monkeypatch):
+    registry, clock = make_registry(monkeypatch)
+    registry.cancel("s1", attempt_id="a1")
+    clock.now += 3601
+    assert registry.pop_reason("s1", ("a1", None)) is None
+
+
+def test_running_submission_is_terminated_only_for_matching_attempt(monkeypatch):
+    async def scenario():
+        registry, _ = make_registry(monkeypatch)
+        proc = FakeProc()
+        registry.register("s1", proc, ("a2", None))
+        assert registry.cancel("s1", attempt_id="a1") is False
+        assert not proc.terminated
+        assert registry.cancel("s1", attempt_id="a2") is True
+        assert proc.terminated
+        assert registry.pop_reason("s1", ("a2", None)) == "Cancelled by request"
+        registry.unregister("s1")
+
+    asyncio.run(scenario())
+
+
+def test_terminate_all_marks_running_submissions_interrupted(monkeypatch):
+    async def scenario():
+        registry, _ = make_registry(monkeypatch)
+        registry.register("s1", FakeProc())
+        assert registry.terminate_all() == 1
+        assert registry.pop_interrupted("s1") is True
+        assert registry.pop_interrupted("s1") is False
+        registry.unregister("s1")
+
+    asyncio.run(scenario())
@@ -0,0 +1,160 @@
+"""
+Test PriorityDispatchQueue: aging giữa các mức priority, weighted round-robin giữa các user,
+giới hạn số submission đồng thời của 1 user và evict_blocked.
+
+    python3 -m pytest tests
+"""
+import asyncio
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+import dispatch_queue  # noqa: E402
+from dispatch_queue import PriorityDispatchQueue, parse_weights  # noqa: E402
+
+
+class FakeClock:
+    def __init__(self, now=1000.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+def run(coro):
+    return asyncio.run(coro)
+
+
+def test_higher_priority_first(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(dispatch_queue.time, "monotonic", clock)
+
+    async def scenario():
+        queue = PriorityDispatchQueue(aging_seconds=30)
+        await queue.put("practice", priority=0)
+        await queue.put("contest", priority=5)
+        return [(await queue.get())[0] for _ in range(2)]
+
+    assert run(scenario()) == ["contest", "practice"]
+
+
+def test_aging_lets_old_low_priority_item_run(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(dispatch_queue.time, "monotonic", clock)
+
+    async def scenario():
+        queue = PriorityDispatchQueue(aging_seconds=10)
+        await queue.put("practice", priority=0)
+        clock.now += 35  # 0 + 35/10 = 3.5 điểm
+        await queue.put("contest", priority=3)
+        item, priority, _, waited = await queue.get()
+        return item, priority, waited
+
+    assert run(scenario()) == ("practice", 0, 35)
+
+
+def test_aging_disabled_keeps_strict_priority(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(dispatch_queue.time, "monotonic", clock)
+
+    async def scenario():
+        queue = PriorityDispatchQueue(aging_seconds=0)
+        await queue.put("practice", priority=0)
+        clock.now += 3600
+        await queue.put("contest", priority=1)
+        return (await queue.get())[0]
+
+    assert run(scenario()) == "contest"
+
+
+def test_priority_is_clamped():
+    queue = PriorityDispatchQueue(max_priority=9)
+    assert queue.clamp_priority(42) == 9
+    assert queue.clamp_priority(-1) == 0
+    assert queue.clamp_priority("abc") == 0
+    assert queue.clamp_priority("3") == 3
+
+
+def test_round_robin_between_users():
+    async def scenario():
+        queue = PriorityDispatchQueue()
+        for i in range(4):
+            await queue.put(f"spam{i}", fair_key="spammer")
+        await queue.put("other0", fair_key="other")
+        return [(await queue.get())[0] for _ in range(5)]
+
+    order = run(scenario())
+    # User thứ 2 không phải chờ cả burst của spammer
+    assert order.index("other0") == 1
+    assert [x for x in order if x.startswith("spam")] == ["spam0", "spam1", "spam2", "spam3"]
+
+
+def test_weighted_round_robin():
+    async def scenario():
+        queue = PriorityDispatchQueue()
+        for i in range(4):
+            await queue.put(f"t{i}", fair_key="teacher", weight=2)
+            await queue.put(f"s{i}", fair_key="student", weight=1)
+        return [(await queue.get())[0] for _ in range(8)]
+
+    assert run(scenario()) == ["t0", "t1", "s0", "t2", "t3", "s1", "s2", "s3"]
+
+
+def test_parse_weights():
+    assert parse_weights("contest=4, teacher=2,student=1") == {"contest": 4, "teacher": 2, "student": 1}
+    assert parse_weights("bad,x=abc,y=0") == {"y": 1}
+    assert parse_weights("") == {}
+
+
+def test_per_user_cap_skips_user_at_limit():
+    async def scenario():
+        queue = PriorityDispatchQueue(max_per_user=2)
+        for i in range(3):
+            await queue.put(f"a{i}", fair_key="a")
+        await queue.put("b0", fair_key="b")
+        first = [(await queue.get())[0] for _ in range(3)]
+        # a đang chạy 2 → a2 phải chờ tới khi a xong 1 bài
+        blocked = asyncio.ensure_future(queue.get())
+        await asyncio.sleep(0.01)
+        assert not blocked.done()
+        assert queue.running_count("a") == 2
+        assert queue.blocked_count() == 1
+        await queue.task_done("a")
+        item = (await asyncio.wait_for(blocked, 1))[0]
+        return first, item
+
+    first, item = run(scenario())
+    assert sorted(first) == ["a0", "a1", "b0"]
+    assert item == "a2"
+
+
+def test_evict_blocked_keeps_oldest_items():
+    async def scenario():
+        queue = PriorityDispatchQueue(max_per_user=1)
+        for i in range(5):
+            await queue.put(f"a{i}", fair_key="a")
+        await queue.put("b0", fair_key="b")
+        assert (await queue.get())[0] == "a0"  # a chạm giới hạn, a1..a4 bị chặn
+        evicted = await queue.evict_blocked(keep=2)
+        remaining = [(await queue.get())[0]]
+        await queue.task_done("a")
+        remaining.append((await queue.get())[0])
+        await queue.task_done("a")
+        remaining.append((await queue.get())[0])
+        return [item for item, _, _ in evicted], remaining, len(queue)
+
+    evicted, remaining, size = run(scenario())
+    assert evicted == ["a4", "a3"]
+    assert remaining == ["b0", "a1", "a2"]
+    assert size == 0
+
+
+def test_evict_blocked_without_cap_is_noop():
+    async def scenario():
+        queue = PriorityDispatchQueue()
+        for i in range(3):
+            await queue.put(i, fair_key="a")
+        return await queue.evict_blocked(keep=0), len(queue)
+
+    assert run(scenario()) == ([], 3)
@@ -0,0 +1,82 @@
+"""
+Test MessageHandler._process_incremental: kết quả từng testcase được lưu đúng result key
+(testcase trùng IndexNo/thiếu TestCaseId không được lưu nhầm sang testcase khác).
+
+    python3 -m pytest tests
+"""
+import asyncio
+import os
+import sys
+from types import SimpleNamespace
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+import message_handler  # noqa: E402
+from message_handler import MessageHandler  # noqa: E402
+from testcase_store import result_key, source_hash  # noqa: E402
+
+
+class FakeStore:
+    enabled = True
+
+    def __init__(self):
+        self.saved = {}
+
+    def load(self, keys):
+        return {k: self.saved[k] for k in keys if k in self.saved}
+
+    def save(self, items):
+        self.saved.update(items)
+
+
+def run_incremental(monkeypatch, testcases, verdicts):
+    """Chạy _process_incremental với runner giả: verdicts[i] là status của testcases[i]"""
+    store = FakeStore()
+    monkeypatch.setattr(message_handler, "testcase_results", store)
+    monkeypatch.setattr(message_handler, "result_journal", SimpleNamespace(enabled=False))
+
+    async def fake_process_submission(data, language, code, timelimit, memorylimit, run, progress=None, attempt=None):
+        results = [{
+            "testcaseId": tc.get("TestCaseId") or tc.get("testcaseId", "unknown"),
+            "indexNo": tc.get("IndexNo", tc.get("indexNo", 0)),
+            "status": verdicts[testcases.index(tc)],
+        } for tc in run]
+        # Executor trả kết quả đã sắp theo IndexNo, không theo thứ tự gửi
+        return True, sorted(results, key=lambda r: r["indexNo"], reverse=True), None, None, ""
+
+    monkeypatch.setattr(MessageHandler, "_process_submission", staticmethod(fake_process_submission))
+    data = {"SubmissionId": "s1"}
+    asyncio.run(MessageHandler._process_incremental(data, "python", "print(1)", 1.0, 262144, testcases))
+    src_hash = source_hash("python", "print(1)")
+    return store.saved, [result_key(src_hash, tc, 1.0, 262144) for tc in testcases]
+
+
+def test_results_are_saved_under_their_own_testcase(monkeypatch):
+    testcases = [
+        {"TestCaseId": "a", "IndexNo": 0, "InputRef": "1", "OutputRef": "1"},
+        {"TestCaseId": "b", "IndexNo": 1, "InputRef": "2", "OutputRef": "2"},
+    ]
+    saved, keys = run_incremental(monkeypatch, testcases, ["Passed", "WrongAnswer"])
+    assert saved[keys[0]]["status"] == "Passed"
+    assert saved[keys[1]]["status"] == "WrongAnswer"
+
+
+def test_same_index_no_is_told_apart_by_testcase_id(monkeypatch):
+    testcases = [
+        {"TestCaseId": "a", "InputRef": "1", "OutputRef": "1"},
+        {"TestCaseId": "b", "InputRef": "2", "OutputRef": "2"},
+    ]
+    saved, keys = run_incremental(monkeypatch, testcases, ["Passed", "WrongAnswer"])
+    assert saved[keys[0]]["status"] == "Passed"
+    assert saved[keys[1]]["status"] == "WrongAnswer"
+
+
+def test_ambiguous_testcases_are_not_saved(monkeypatch):
+    testcases = [
+        {"InputRef": "1", "OutputRef": "1"},
+        {"InputRef": "2", "OutputRef": "2"},
+        {"TestCaseId": "c", "IndexNo": 2, "InputRef": "3", "OutputRef": "3"},
+    ]
+    saved, keys = run_incremental(monkeypatch, testcases, ["Passed", "WrongAnswer", "Passed"])
+    assert keys[0] not in saved and keys[1] not in saved
+    assert saved[keys[2]]["status"] == "Passed"
@@ -0,0 +1,62 @@
+"""
+Test decompress_body: giải nén gzip/zstd và giới hạn kích thước sau giải nén (MAX_MESSAGE_BODY_BYTES).
+
+    python3 -m pytest tests
+"""
+import gzip
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+import message_codec  # noqa: E402
+from message_codec import MessageTooLarge, compress_body, decompress_body  # noqa: E402
+
+BODY = b'{"SubmissionId": "s1", "Code": "' + b"x" * 5000 + b'"}'
+
+
+def test_identity_body_is_returned_unchanged():
+    assert decompress_body(BODY, None) is BODY
+    assert decompress_body(BODY, "identity", max_size=len(BODY)) is BODY
+
+
+def test_gzip_round_trip_with_multiple_members():
+    assert decompress_body(compress_body(BODY, "gzip"), "gzip") == BODY
+    assert decompress_body(gzip.compress(b"ab") + gzip.compress(b"cd"), "gzip") == b"abcd"
+
+
+@pytest.mark.parametrize("encoding", ["", "gzip", "zstd"])
+def test_body_over_limit_is_rejected(encoding):
+    if encoding == "zstd" and message_codec.zstandard is None:
+        pytest.skip("zstandard not installed")
+    data = compress_body(BODY, encoding)
+    assert decompress_body(data, encoding, max_size=len(BODY)) == BODY
+    with pytest.raises(MessageTooLarge):
+        decompress_body(data, encoding, max_size=len(BODY) - 1)
+
+
+def test_zstd_stream_without_content_size():
+    if message_codec.zstandard is None:
+        pytest.skip("zstandard not installed")
+    compressor = message_codec.zstandard.ZstdCompressor().compressobj()
+    data = compressor.compress(BODY) + compressor.flush()
+    assert decompress_body(data, "zstd", max_size=len(BODY)) == BODY
+    with pytest.raises(MessageTooLarge):
+        decompress_body(data, "zstd", max_size=100)
+
+
+def test_decompression_bomb_stops_at_limit():
+    bomb = gzip.compress(b"\0" * (64 * 1024 * 1024))
+    with pytest.raises(MessageTooLarge):
+        decompress_body(bomb, "gzip", max_size=1024 * 1024)
+
+
+def test_invalid_or_unsupported_body_raises_value_error():
+    with pytest.raises(ValueError):
+        decompress_body(b"not gzip", "gzip")
+    with pytest.raises(ValueError):
+        decompress_body(gzip.compress(BODY)[:-8], "gzip")
+    with pytest.raises(ValueError):
+        decompress_body(BODY, "br")
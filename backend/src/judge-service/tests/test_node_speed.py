@@ -0,0 +1,66 @@
+"""
+Test NodeSpeed.run_periodic: calibration chỉ chạy khi rảnh và trong lúc dispatch bị dừng.
+
+    python3 -m pytest tests
+"""
+import asyncio
+import contextlib
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+import node_speed as node_speed_module  # noqa: E402
+from node_speed import NodeSpeed, normalize_ms, scale_limit  # noqa: E402
+
+
+def test_scale_and_normalize():
+    assert scale_limit(1.5, 1.25) == 1.875
+    assert normalize_ms(1250, 1.25) == 1000
+    assert normalize_ms(700, 0) == 700
+
+
+def test_periodic_calibration_runs_with_dispatch_paused(monkeypatch):
+    monkeypatch.setattr(node_speed_module, "NODE_SPEED_FIXED", "")
+    monkeypatch.setattr(node_speed_module, "NODE_SPEED_RECALIBRATE_INTERVAL", 0.01)
+    state = {"paused": False, "inflight": 0, "pauses": 0, "calls": []}
+
+    @contextlib.asynccontextmanager
+    async def pause():
+        state["paused"] = True
+        state["pauses"] += 1
+        if state["pauses"] == 1:
+            state["inflight"] = 1  # 1 submission bắt đầu ngay trước khi dispatch dừng
+        try:
+            yield
+        finally:
+            state["paused"] = False
+
+    calibrated = None
+
+    async def fake_calibrate(self):
+        state["calls"].append((state["paused"], state["inflight"]))
+        calibrated.set()
+        return self.factor
+
+    async def finish_submission():
+        await asyncio.sleep(0.05)
+        state["inflight"] = 0
+
+    async def scenario():
+        nonlocal calibrated
+        calibrated = asyncio.Event()
+        task = asyncio.ensure_future(NodeSpeed().run_periodic(lambda: state["inflight"] == 0, pause=pause))
+        finisher = asyncio.ensure_future(finish_submission())
+        await asyncio.wait_for(calibrated.wait(), 2)
+        task.cancel()
+        await asyncio.gather(task, finisher, return_exceptions=True)
+
+    real_sleep = asyncio.sleep
+    monkeypatch.setattr(node_speed_module.asyncio, "sleep", lambda seconds: real_sleep(min(seconds, 0.01)))
+    monkeypatch.setattr(NodeSpeed, "calibrate", fake_calibrate)
+    asyncio.run(scenario())
+    # Lần 1 không rảnh sau khi dừng dispatch → thử lại; chỉ đo khi đã dừng dispatch và không có submission
+    assert state["pauses"] == 2
+    assert state["calls"] == [(True, 0)]
+
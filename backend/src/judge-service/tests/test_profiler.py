@@ -0,0 +1,73 @@
+"""
+Test Profiler.start: yêu cầu profile từ control message được validate (Seconds, Mode) và giới hạn thời gian.
+
+    python3 -m pytest tests
+"""
+import asyncio
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+import profiler as profiler_module  # noqa: E402
+from profiler import Profiler  # noqa: E402
+
+
+@pytest.fixture
+def profile_dir(monkeypatch, tmp_path):
+    monkeypatch.setattr(profiler_module, "PROFILE_DIR", str(tmp_path))
+    return tmp_path
+
+
+@pytest.mark.parametrize("seconds, mode", [
+    ("abc", "sample"),
+    ([30], "sample"),
+    (True, "sample"),
+    (-5, "sample"),
+    (0, "sample"),
+    (float("nan"), "sample"),
+    (float("inf"), "sample"),
+    (30, 42),
+    (30, ["sample"]),
+    (30, "unknown"),
+])
+def test_invalid_requests_are_ignored(seconds, mode, profile_dir):
+    async def scenario():
+        profiler = Profiler("test")
+        started = profiler.start(seconds, mode)
+        return started, profiler.active
+
+    assert asyncio.run(scenario()) == (False, False)
+
+
+def test_seconds_are_capped(profile_dir):
+    async def scenario():
+        profiler = Profiler("test")
+        assert profiler.start("1e9", "CPROFILE", max_seconds=5)
+        request = profiler.runner_request()
+        files = profiler.stop()
+        return request, files
+
+    request, files = asyncio.run(scenario())
+    assert request["mode"] == "cprofile"
+    assert 0 < request["seconds"] <= 5
+    assert any(f.endswith(".prof") for f in files)
+
+
+def test_defaults_are_used_when_missing(monkeypatch, profile_dir):
+    monkeypatch.setattr(profiler_module, "PROFILE_SECONDS", 12)
+    monkeypatch.setattr(profiler_module, "PROFILE_MODE", "sample")
+
+    async def scenario():
+        profiler = Profiler("test")
+        assert profiler.start()
+        assert not profiler.start()  # đang profile → bỏ qua
+        request = profiler.runner_request()
+        profiler.stop()
+        return request
+
+    request = asyncio.run(scenario())
+    assert request["mode"] == "sample"
+    assert 11 < request["seconds"] <= 12
@@ -0,0 +1,126 @@
+"""
+Test parse_spooled: cùng kết quả với codec.loads (JSON và MessagePack), testcase được ghi ra spool,
+body lỗi raise ValueError; new_spool_dir dọn thư mục spool cũ định kỳ.
+
+    python3 -m pytest tests
+"""
+import json
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+import submission_spool  # noqa: E402
+from message_codec import JsonCodec, MsgpackCodec, msgpack  # noqa: E402
+from submission_spool import parse_spooled  # noqa: E402
+
+SUBMISSION = {
+    "SubmissionId": "s-1",
+    "Language": "python",
+    "Code": "print(input())\n# \"quoted\" \\ backslash, unicode: đúng ✓",
+    "TimeLimit": 1000,
+    "Nested": {"a": [1, 2.5, None, True, False], "b": {"c": ""}},
+    "Testcases": [
+        {"TestCaseId": "t1", "IndexNo": 0, "InputRef": "  1 2\n", "OutputRef": "3\n"},
+        {"TestCaseId": "t2", "IndexNo": 1, "InputRef": "x" * 10000, "OutputRef": "đ☃\n"},
+        {"testcaseId": "t3", "indexNo": 2, "inputRef": "lower", "outputRef": "case"},
+    ],
+    "Rejudge": False,
+}
+
+
+def unspool(data):
+    """Thay metadata spool bằng nội dung file để so sánh với codec.loads"""
+    for key in ("Testcases", "testcases"):
+        for tc in data.get(key) or []:
+            with open(tc.pop("InputFile"), encoding="utf-8") as f:
+                tc["InputRef"] = f.read()
+            with open(tc.pop("OutputFile"), encoding="utf-8") as f:
+                tc["OutputRef"] = f.read()
+            tc.pop("InputHash")
+            tc.pop("ContentHash")
+    return data
+
+
+def expected(data):
+    """codec.loads + cùng chuẩn hoá như _spool_testcase (strip, key InputRef/OutputRef)"""
+    for key in ("Testcases", "testcases"):
+        for tc in data.get(key) or []:
+            tc["InputRef"] = str(tc.pop("InputRef", None) or tc.pop("inputRef", "") or "").strip()
+            tc["OutputRef"] = str(tc.pop("OutputRef", None) or tc.pop("outputRef", "") or "").strip()
+    return data
+
+
+JSON_BODIES = [
+    json.dumps(SUBMISSION).encode(),
+    json.dumps(SUBMISSION, indent=2, ensure_ascii=False).encode(),
+    json.dumps(SUBMISSION, separators=(",", ":")).encode(),
+    b' \n{ "testcases" : [ ] , "Code" : "a" } \n',
+    b'{}',
+    b'{"Testcases": null, "X": [{"InputRef": 1}]}',
+]
+
+
+@pytest.mark.parametrize("body", JSON_BODIES)
+def test_json_parity_with_codec(body, tmp_path):
+    assert unspool(parse_spooled(body, JsonCodec, str(tmp_path))) == expected(JsonCodec.loads(body))
+
+
+@pytest.mark.skipif(msgpack is None, reason="msgpack not installed")
+@pytest.mark.parametrize("obj", [SUBMISSION, {"testcases": []}, {}])
+def test_msgpack_parity_with_codec(obj, tmp_path):
+    body = MsgpackCodec.dumps(obj)
+    assert unspool(parse_spooled(body, MsgpackCodec, str(tmp_path))) == expected(MsgpackCodec.loads(body))
+
+
+def test_testcases_are_written_to_spool_files(tmp_path):
+    data = parse_spooled(json.dumps(SUBMISSION).encode(), JsonCodec, str(tmp_path))
+    tc = data["Testcases"][0]
+    assert tc["InputFile"] == str(tmp_path / "0.in")
+    assert (tmp_path / "0.in").read_text() == "1 2"
+    assert "InputRef" not in tc and len(tc["ContentHash"]) == 64
+
+
+@pytest.mark.parametrize("body", [
+    b'[1, 2]',
+    b'{"a": 1',
+    b'{"a": 1} trailing',
+    b'{"a" 1}',
+    b'{"a": 1,, "b": 2}',
+    b'{"Testcases": [{"InputRef": "1"} {"InputRef": "2"}]}',
+    b'{"Testcases": [1]}',
+    b'\xff\xfe',
+])
+def test_invalid_json_raises_value_error(body, tmp_path):
+    with pytest.raises(ValueError):
+        parse_spooled(body, JsonCodec, str(tmp_path))
+
+
+def test_unwritable_spool_raises_os_error(tmp_path):
+    with pytest.raises(OSError):
+        parse_spooled(json.dumps(SUBMISSION).encode(), JsonCodec, str(tmp_path / "missing"))
+
+
+def test_new_spool_dir_removes_stale_dirs_periodically(monkeypatch, tmp_path):
+    monkeypatch.setattr(submission_spool, "SPOOL_DIR", str(tmp_path))
+    monkeypatch.setattr(submission_spool, "_last_cleanup", None)
+    clock = [1000.0]
+    monkeypatch.setattr(submission_spool.time, "monotonic", lambda: clock[0])
+    stale = tmp_path / "stale"
+
+    def make_stale():
+        stale.mkdir()
+        os.utime(stale, (0, 0))
+
+    make_stale()
+    submission_spool.new_spool_dir()
+    assert not stale.exists()
+    make_stale()
+    clock[0] += submission_spool.SPOOL_CLEANUP_INTERVAL / 2
+    submission_spool.new_spool_dir()
+    assert stale.exists()  # chưa tới lượt quét
+    clock[0] += submission_spool.SPOOL_CLEANUP_INTERVAL
+    submission_spool.new_spool_dir()
+    assert not stale.exists()